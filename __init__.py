@@ -9,6 +9,9 @@ from .models import db
 # by importing controllers you expose the actions defined in it
 from . import controllers
 
+# by importing tasks you register the background jobs (see settings.RUN_SCHEDULER)
+from . import tasks
+
 # optional parameters
 __version__ = "0.0.0"
 __author__ = "you <you@example.com>"
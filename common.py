@@ -6,17 +6,25 @@ import os
 import sys
 import logging
 
-from py4web.utils.grid import GridClassStyleBulma
+from py4web.utils.grid import Grid, GridClassStyleBulma
 
 from py4web.utils.form import FormStyleBulma
 
 from py4web import Session, Cache, Translator, Flash, DAL, Field, action
 from py4web.utils.mailer import Mailer
-from py4web.utils.auth import Auth
+from py4web.utils.auth import Auth, AuthEnforcer
+from py4web.core import Template
 from py4web.utils.downloader import downloader
 from pydal.tools.tags import Tags
 from py4web.utils.factories import ActionFactory
 from . import settings
+from .lib.caching import TableVersions, FragmentCache, RowCounts
+from .lib.autocomplete import AutocompleteRegistry, OptionSets
+from .lib.search_index import SearchIndexes
+from .lib.grid_helpers import GRID_ROWS_HEADER, ScrollCursors, UsedReferences
+from .lib.jobs import JobRuns, ThreadScheduler, JobQueue
+from .lib.profiling import Profiler
+from .lib.slow_queries import SlowQueryLog
 
 # #######################################################
 # implement custom loggers form settings.LOGGERS
@@ -118,6 +126,23 @@ if settings.SMTP_SERVER:
 if auth.db:
     groups = Tags(db.auth_user, "groups")
 
+# #######################################################
+# Track writes per table and cache rendered grid fragments
+# #######################################################
+table_versions = TableVersions(db)
+grid_cache = FragmentCache(
+    cache,
+    table_versions,
+    permissions=lambda: groups.get(auth.user_id) if auth.user_id else [],
+    vary=[GRID_ROWS_HEADER],
+)
+scroll_cursors = ScrollCursors(settings.SESSION_SECRET_KEY)
+autocomplete_fields = AutocompleteRegistry()
+row_counts = RowCounts(cache, table_versions)
+option_sets = OptionSets(cache, table_versions)
+used_references = UsedReferences(cache, table_versions)
+search_indexes = SearchIndexes(table_versions, threshold=settings.FUZZY_THRESHOLD)
+
 # #######################################################
 # Enable optional auth plugin
 # #######################################################
@@ -181,7 +206,7 @@ if settings.UPLOAD_FOLDER:
     # field.download_url = lambda filename: URL('download/%s' % filename)
 
 # #######################################################
-# Optionally configure celery
+# Optionally configure celery, else run the tasks in a thread
 # #######################################################
 if settings.USE_CELERY:
     from celery import Celery
@@ -191,7 +216,45 @@ if settings.USE_CELERY:
     scheduler = Celery(
         "apps.%s.tasks" % settings.APP_NAME, broker=settings.CELERY_BROKER
     )
+else:
+    # same @scheduler.task / delay / conf.beat_schedule API, see tasks.py
+    scheduler = ThreadScheduler("apps.%s.tasks" % settings.APP_NAME, logger=logger)
+
+# history and locks of the background jobs
+job_runs = JobRuns(db)
 
+# durable queue for the long jobs started from actions, run by "py4web call" workers (tasks.py)
+job_queue = JobQueue(db, logger=logger)
+
+
+# #######################################################
+# Profile the actions of the app: set PROFILE
+# #######################################################
+profiler = None
+if settings.PROFILE:
+    profiler = Profiler(db, logger, repeat_threshold=settings.PROFILE_REPEAT_THRESHOLD)
+    profiler.instrument(session, "session")
+    profiler.instrument(db, "db")
+    profiler.instrument(auth, "auth")
+    profiler.instrument(AuthEnforcer, "auth.user")
+    profiler.instrument(flash, "flash")
+    profiler.instrument(T, "T")
+    profiler.instrument(Template, "template", methods=("on_success",))
+    profiler.instrument(Grid, "grid", methods=("process", "render"))
+    #  every action of the app uses the session, directly or through auth
+    profiler.profile(session)
+
+# statements slower than SLOW_QUERY_THRESHOLD, see the slow_queries action for the summary
+slow_queries = None
+if settings.SLOW_QUERY_LOG:
+    slow_queries = SlowQueryLog(
+        db,
+        settings.SLOW_QUERY_LOG,
+        threshold=settings.SLOW_QUERY_THRESHOLD,
+        large_table=settings.SLOW_QUERY_LARGE_TABLE,
+        max_bytes=settings.SLOW_QUERY_LOG_MAX_BYTES,
+        backups=settings.SLOW_QUERY_LOG_BACKUPS,
+    )
 
 # #######################################################
 # Enable authentication
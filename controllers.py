@@ -1,4 +1,5 @@
 import copy
+import datetime
 
 import ombott
 from dateutil.parser import parse
@@ -9,12 +10,12 @@ from py4web.utils.form import FormStyleBulma, Form, FormStyleFactory
 
 from py4web import action, request, abort, redirect, URL, Field
 from yatl.helpers import A
+from yatl.sanitizer import xmlescape
 
 from py4web.utils.grid import (
     Column,
     Grid,
     GridClassStyleBulma,
-    AttributesPluginHtmx,
     get_parent,
 )
 from .common import (
@@ -28,9 +29,42 @@ from .common import (
     unauthenticated,
     flash,
     GRID_DEFAULTS,
+    grid_cache,
+    table_versions,
+    scroll_cursors,
+    search_indexes,
+    used_references,
+    scheduler,
+    job_runs,
+    job_queue,
+    slow_queries,
+)
+from . import settings
+from .tasks import rebuild_sales_rollup, run_scheduled_job
+from .htmx import reference_widget
+from .lib.grid_helpers import (
+    GridSearchQuery,
+    GridSearch,
+    HtmxGrid,
+    AttributesPluginHtmxRows,
+    PrefetchColumn,
+    prefetch_columns,
+    GridSpec,
+    is_rows_request,
+    is_scroll_request,
+    InfiniteScroll,
+)
+from .lib.caching import conditional_get
+from .lib.table_views import table_view
+from .lib.fragments import render_template, oob_fragment
+from .lib.export import stream_export, EXPORT_FORMATS
+from .models import (
+    order_subtotals,
+    order_total,
+    load_order,
+    sales_rollup,
+    load_sales_dashboard,
 )
-from .htmx import HtmxAutocompleteWidget
-from .lib.grid_helpers import GridSearchQuery, GridSearch
 
 BUTTON = TAG.button
 
@@ -101,6 +135,23 @@ ORDER_DETAIL_FIELDS = [
 ORDER_DETAIL_DETAIL_FIELDS = ["product", "unit_price", "quantity", "discount"]
 
 
+def reference_formstyle(table):
+    """
+    FormStyleBulma, with the widget of each reference field of table picked by reference_widget
+
+    Small tables are filtered in the browser, large ones use autocomplete and the others keep
+    the IS_IN_DB dropdown, so the cost of rendering a form does not grow with the tables.
+    """
+    formstyle = FormStyleFactory()
+    formstyle.classes = FormStyleBulma.classes
+    formstyle.class_inner_exceptions = FormStyleBulma.class_inner_exceptions
+    for field in table:
+        widget = reference_widget(field)
+        if widget:
+            formstyle.widgets[field.name] = widget
+    return formstyle
+
+
 @unauthenticated("index", "index.html")
 def index():
     user = auth.get_user()
@@ -113,291 +164,591 @@ def setup():
     return dict()
 
 
-@action("setup/sales_regions", method=["POST", "GET"])
-@action("setup/sales_regions/<path:path>", method=["POST", "GET"])
-@action.uses(
-    "htmx/grid.html",
-    session,
-    db,
-    auth.user,
-)
-def sales_regions(path=None):
-    queries = [db.sales_region.id > 0]
-
-    search_queries = [
-        GridSearchQuery(
-            "Filter by sales_region", lambda value: db.sales_region.name.contains(value)
-        )
-    ]
-    search = GridSearch(
-        search_queries=search_queries,
-        queries=queries,
-        target_element="#sales-regions-target",
+@authenticated("dashboard", "dashboard.html")
+def dashboard():
+    """
+    Sales by month, employee, sales region, category and customer for a year, from the sales
+    rollup only
+    """
+    conditional_get(
+        auth.user_id,
+        table_versions.version(
+            db.order,
+            db.order_detail,
+            db.employee,
+            db.product,
+            db.customer,
+            db.category,
+            db.sales_region,
+            db.reorder_alert,
+        ),
     )
 
-    fields = [
-        db.sales_region.name,
-    ]
+    years = sorted({month.year for month, values in sales_rollup.monthly()})
+    year = request.params.get("year")
+    year = int(year) if year and year.isdigit() else years[-1] if years else None
 
-    gd = copy.deepcopy(GRID_DEFAULTS)
-    gd["rows_per_page"] = 10
+    start = end = None
+    if year:
+        start = datetime.date(year, 1, 1)
+        end = datetime.date(year + 1, 1, 1)
 
-    grid = Grid(
-        path,
-        search.query,
-        fields=fields,
-        orderby=db.sales_region.name,
-        details=False,
-        search_form=search.search_form,
-        auto_process=False,
-        include_action_button_text=False,
-        **gd,
+    reorder_alerts = db(db.reorder_alert.product == db.product.id).select(
+        db.product.name,
+        db.reorder_alert.in_stock,
+        db.reorder_alert.on_order,
+        db.reorder_alert.reorder_level,
+        orderby=db.product.name,
     )
 
-    grid.attributes_plugin = AttributesPluginHtmx("#sales-regions-target")
-    attrs = {
-        "_hx-get": URL("setup", "sales_regions"),
-        "_class": "button is-default",
-    }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.details_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
-
-    grid.process()
+    return dict(
+        years=years,
+        year=year,
+        reorder_alerts=reorder_alerts,
+        **load_sales_dashboard(start, end),
+    )
 
-    return dict(grid=grid)
 
+@authenticated("jobs", "jobs.html")
+def jobs():
+    """
+    The scheduled background jobs of tasks.py and their last runs
+    """
+    return dict(schedule=scheduler.conf.beat_schedule, runs=job_runs.history())
+
+
+@action("jobs/run/<entry>", method=["POST"])
+@action.uses(session, db, auth.user)
+def jobs_run(entry=None):
+    """
+    Queue a scheduled job now, in a job queue worker when this process runs no scheduler
+    """
+    spec = scheduler.conf.beat_schedule.get(entry)
+    if not spec:
+        abort(404)
+    if settings.USE_CELERY or settings.RUN_SCHEDULER:
+        scheduler.send_task(spec["task"], args=spec.get("args", ()))
+    else:
+        run_scheduled_job.delay(entry)
+    return "Queued"
+
+
+@authenticated("slow_queries", "slow_queries.html")
+def slow_queries_report():
+    """
+    The statements of the slow query log grouped by shape, the largest total time first
+    """
+    return dict(report=slow_queries.summary(limit=50) if slow_queries else [])
+
+
+@action("dashboard/rebuild", method=["POST"])
+@action.uses("htmx/job_status.html", session, db, auth.user)
+def dashboard_rebuild():
+    """
+    Queue a rebuild of the sales rollup, the response polls its status
+    """
+    job_id = job_queue.enqueue(rebuild_sales_rollup.name, user_id=auth.user_id)
+    return dict(job=job_queue.get(job_id))
+
+
+@action("jobs/status/<job_id:int>", method=["GET"])
+@action.uses("htmx/job_status.html", session, db, auth.user)
+def jobs_status(job_id=None):
+    """
+    Status of a queued job, for htmx polling: the fragment reloads itself until the job ended
+    """
+    job = job_queue.get(job_id)
+    if not job or job.user_id != auth.user_id:
+        abort(404)
+    return dict(job=job)
+
+
+#  the request independent parts of the setup and child grids, see GridSpec
+SETUP_GRID_ARGS = dict(
+    GRID_DEFAULTS,
+    rows_per_page=10,
+    details=False,
+    include_action_button_text=False,
+)
 
-@action("setup/territories", method=["POST", "GET"])
-@action("setup/territories/<path:path>", method=["POST", "GET"])
-@action.uses(
-    "htmx/grid.html",
-    session,
-    db,
-    auth,
+CHILD_GRID_ARGS = dict(
+    GRID_DEFAULTS,
+    details=False,
+    include_action_button_text=False,
 )
-def territories(path=None):
-    queries = [db.territory.id > 0]
 
-    search_queries = [
-        GridSearchQuery(
-            "Filter by territory", lambda value: db.territory.name.contains(value)
-        )
-    ]
-    search = GridSearch(
-        search_queries=search_queries,
-        queries=queries,
-        target_element="#territories-target",
-    )
+ORDER_GRID_ARGS = dict(
+    CHILD_GRID_ARGS,
+    show_id=True,
+    create=False,
+    editable=False,
+    deletable=False,
+)
 
-    fields = [
-        db.territory.name,
-        Column(
-            "sales_region",
-            lambda row: f"{row.sales_region.name}",
-            required_fields=[db.sales_region.name],
-            orderby=db.sales_region.name,
+GRIDS = dict(
+    sales_regions=GridSpec(
+        ("setup", "sales_regions"),
+        "#sales-regions-target",
+        [db.sales_region],
+        [db.sales_region.name],
+        query=db.sales_region.id > 0,
+        search_queries=[
+            GridSearchQuery(
+                "Filter by sales_region",
+                lambda value: db.sales_region.name.contains(value),
+            )
+        ],
+        orderby=db.sales_region.name,
+        **SETUP_GRID_ARGS,
+    ),
+    territories=GridSpec(
+        ("setup", "territories"),
+        "#territories-target",
+        [db.territory, db.sales_region],
+        [
+            db.territory.name,
+            Column(
+                "sales_region",
+                lambda row: f"{row.sales_region.name}",
+                required_fields=[db.sales_region.name],
+                orderby=db.sales_region.name,
+            ),
+        ],
+        query=db.territory.id > 0,
+        search_queries=[
+            GridSearchQuery(
+                "Filter by territory", lambda value: db.territory.name.contains(value)
+            )
+        ],
+        formstyle_factory=lambda: reference_formstyle(db.territory),
+        left=db.sales_region.on(db.territory.sales_region == db.sales_region.id),
+        orderby=[db.territory.name],
+        **SETUP_GRID_ARGS,
+    ),
+    customer_types=GridSpec(
+        ("setup", "customer_types"),
+        "#customer-types-target",
+        [db.customer_type],
+        [db.customer_type.name],
+        query=db.customer_type.id > 0,
+        search_queries=[
+            GridSearchQuery(
+                "Filter by customer type",
+                lambda value: db.customer_type.name.contains(value),
+            )
+        ],
+        orderby=[db.customer_type.name],
+        **SETUP_GRID_ARGS,
+    ),
+    categories=GridSpec(
+        ("setup", "categories"),
+        "#categories-target",
+        [db.category],
+        [db.category.name],
+        query=db.category.id > 0,
+        search_queries=[
+            GridSearchQuery(
+                "Filter by category", lambda value: db.category.name.contains(value)
+            )
+        ],
+        orderby=[db.category.name],
+        **SETUP_GRID_ARGS,
+    ),
+    shippers=GridSpec(
+        ("setup", "shippers"),
+        "#shippers-target",
+        [db.shipper],
+        [db.shipper.name, db.shipper.phone],
+        query=db.shipper.id > 0,
+        search_queries=[
+            GridSearchQuery(
+                "Filter by customer type",
+                lambda value: db.shipper.name.contains(value),
+            )
+        ],
+        orderby=[db.shipper.name],
+        **SETUP_GRID_ARGS,
+    ),
+    customer_notes=GridSpec(
+        ("customer_notes",),
+        "#notes-target",
+        [db.customer_note, db.customer],
+        [db.customer_note.timestamp, db.customer_note.note],
+        parent_field=db.customer_note.customer,
+        hidden=[db.customer_note.customer, db.customer_note.timestamp],
+        sidecars=("new", "edit"),
+        formatters={
+            "datetime": lambda value: value.strftime("%m/%d/%Y %I:%M%p")
+            if value
+            else ""
+        },
+        left=(db.customer.on(db.customer_note.customer == db.customer.id),),
+        orderby=~db.customer_note.timestamp,
+        **CHILD_GRID_ARGS,
+    ),
+    customer_customer_types=GridSpec(
+        ("customer_customer_types",),
+        "#types-target",
+        [db.customer_customer_type, db.customer_type],
+        [db.customer_type.name],
+        parent_field=db.customer_customer_type.customer,
+        hidden=[db.customer_customer_type.customer],
+        sidecars=("new", "edit"),
+        formstyle_factory=lambda: reference_formstyle(db.customer_customer_type),
+        left=(
+            db.customer_type.on(
+                db.customer_customer_type.customer_type == db.customer_type.id
+            ),
         ),
-    ]
-    left = db.sales_region.on(db.territory.sales_region == db.sales_region.id)
+        orderby=db.customer_type.name,
+        **CHILD_GRID_ARGS,
+    ),
+    customer_orders=GridSpec(
+        ("customer_orders",),
+        "#orders-target",
+        [db.order, db.order_detail],
+        [
+            db.order.id,
+            Column(
+                "Order Date",
+                represent=lambda row: row.order_date.strftime("%m/%d/%Y")
+                if row.order_date
+                else "",
+                required_fields=[db.order.order_date],
+            ),
+            PrefetchColumn("Subtotal", order_subtotals),
+            db.order.freight,
+            PrefetchColumn(
+                "Total",
+                order_subtotals,
+                represent=lambda row, subtotal: order_total(row, subtotal),
+            ),
+        ],
+        parent_field=db.order.customer,
+        sidecars=(),
+        orderby=[~db.order.order_date, ~db.order.id],
+        **ORDER_GRID_ARGS,
+    ),
+    employee_territories=GridSpec(
+        ("employee_territories",),
+        "#territories-target",
+        [db.employee_territory, db.territory],
+        [db.territory.name],
+        parent_field=db.employee_territory.employee,
+        hidden=[db.employee_territory.employee],
+        sidecars=("new", "edit"),
+        formstyle_factory=lambda: reference_formstyle(db.employee_territory),
+        left=(db.territory.on(db.employee_territory.territory == db.territory.id),),
+        orderby=db.territory.name,
+        **CHILD_GRID_ARGS,
+    ),
+    employee_orders=GridSpec(
+        ("employee_orders",),
+        "#orders-target",
+        [db.order, db.order_detail],
+        [
+            db.order.id,
+            Column(
+                "Order Date",
+                represent=lambda row: row.order_date.strftime("%m/%d/%Y")
+                if row.order_date
+                else "",
+                required_fields=[db.order.order_date],
+            ),
+            PrefetchColumn("Subtotal", order_subtotals),
+            db.order.freight,
+            PrefetchColumn(
+                "Total",
+                order_subtotals,
+                represent=lambda row, subtotal: order_total(row, subtotal),
+            ),
+        ],
+        parent_field=db.order.employee,
+        sidecars=(),
+        formatters={"date": lambda value: value.strftime("%m/%d/%Y") if value else ""},
+        orderby=[~db.order.order_date, ~db.order.id],
+        **ORDER_GRID_ARGS,
+    ),
+    product_orders=GridSpec(
+        ("product_orders",),
+        "#orders-target",
+        [db.order_detail, db.order],
+        [
+            db.order.id,
+            Column(
+                "Order Date",
+                represent=lambda row: row.order.order_date.strftime("%m/%d/%Y")
+                if row.order.order_date
+                else "",
+                required_fields=[db.order.order_date],
+            ),
+            PrefetchColumn("Subtotal", order_subtotals, key=lambda row: row.order.id),
+            db.order.freight,
+            PrefetchColumn(
+                "Total",
+                order_subtotals,
+                represent=lambda row, subtotal: order_total(row.order, subtotal),
+                key=lambda row: row.order.id,
+            ),
+        ],
+        parent_field=db.order_detail.product,
+        sidecars=(),
+        left=[db.order.on(db.order_detail.order == db.order.id)],
+        orderby=[~db.order.order_date, ~db.order.id],
+        **dict(ORDER_GRID_ARGS, rows_per_page=7),
+    ),
+)
 
-    gd = copy.deepcopy(GRID_DEFAULTS)
-    gd["rows_per_page"] = 10
 
-    grid = Grid(
-        path,
-        query=search.query,
-        fields=fields,
-        left=left,
-        orderby=[db.territory.name],
-        auto_process=False,
-        details=False,
-        search_form=search.search_form,
-        include_action_button_text=False,
-        **gd,
-    )
+def detail_view(table, record, fields):
+    """
+    The readonly form of a record for htmx/form.html, with its Edit button
 
-    grid.attributes_plugin = AttributesPluginHtmx("#territories-target")
+    Parameters
+    ----------
+    table: the pydal table
+    record: the record shown
+    fields: names of the fields shown
+    """
     attrs = {
-        "_hx-get": URL("setup", "territories"),
-        "_class": "button is-default",
+        "_hx-get": URL("%s_detail_edit/%s" % (table._tablename, record.id)),
+        "_hx-target": "#details-target",
     }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.details_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
 
-    grid.process()
+    form = Form(
+        table_view(table, fields=fields),
+        record=record,
+        readonly=True,
+        deletable=False,
+        formstyle=FormStyleBulma,
+        dbio=False,
+        submit_value="Edit",
+        **attrs,
+    )
 
-    return dict(grid=grid)
+    edit_button = BUTTON(
+        I(_class="fa fa-edit"), _class="submit-edit box-shadow-y", **attrs
+    )
 
+    return dict(form=form, form_fields=fields, edit_button=edit_button)
 
-@action("setup/customer_types", method=["POST", "GET"])
-@action("setup/customer_types/<path:path>", method=["POST", "GET"])
-@action.uses(
-    "htmx/grid.html",
-    session,
-    db,
-    auth.user,
-)
-def customer_types(path=None):
-    orderby = [db.customer_type.name]
 
-    queries = [db.customer_type.id > 0]
+def child_grid(name, path, parent_id, embedded=False):
+    """
+    Make a child grid of GRIDS for a parent record
 
-    search_queries = [
-        GridSearchQuery(
-            "Filter by customer type",
-            lambda value: db.customer_type.name.contains(value),
-        )
-    ]
-    search = GridSearch(
-        search_queries=search_queries,
-        queries=queries,
-        target_element="#customer-types-target",
+    The parent field defaults to parent_id and the hidden fields of the grid are hidden from its
+    forms.  embedded is for grids rendered by another action, see GridSpec.make.
+    """
+    spec = GRIDS[name]
+    view = table_view(
+        spec.parent_field.table,
+        hidden=[field.name for field in spec.hidden],
+        defaults={spec.parent_field.name: parent_id},
     )
 
-    fields = [
-        db.customer_type.name,
-    ]
+    return spec.make(path, parent_id=parent_id, embedded=embedded, views=[view])
 
-    gd = copy.deepcopy(GRID_DEFAULTS)
-    gd["rows_per_page"] = 10
 
-    grid = Grid(
-        path,
-        search.query,
-        fields=fields,
-        orderby=orderby,
-        details=False,
-        search_form=search.search_form,
-        auto_process=False,
-        include_action_button_text=False,
-        **gd,
-    )
+def grid_conditional_get(name, path):
+    """
+    The ETag of a grid of GRIDS listing its rows: the key of its cached fragment
+    """
+    if not path or path.split("/")[0] == "select":
+        conditional_get(grid_cache.make_key(name, GRIDS[name].tables))
 
-    grid.attributes_plugin = AttributesPluginHtmx("#customer-types-target")
-    attrs = {
-        "_hx-get": URL("setup", "customer_types"),
-        "_class": "button is-default",
-    }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.details_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
 
-    grid.process()
+def child_grid_action(name, path):
+    spec = GRIDS[name]
+    grid_conditional_get(name, path)
+    html = grid_cache.lookup(name, path, spec.tables)
+    if html:
+        return html
 
-    return dict(grid=grid)
+    parent_id = get_parent(path, parent_field=spec.parent_field)
+    return dict(grid=child_grid(name, path, parent_id))
 
 
-@action("setup/categories", method=["POST", "GET"])
-@action("setup/categories/<path:path>", method=["POST", "GET"])
+def setup_grid(name, path):
+    spec = GRIDS[name]
+    grid_conditional_get(name, path)
+    html = grid_cache.lookup(name, path, spec.tables)
+    if html:
+        return html
+
+    return dict(grid=spec.make(path))
+
+
+@action("setup/sales_regions", method=["POST", "GET"])
+@action("setup/sales_regions/<path:path>", method=["POST", "GET"])
 @action.uses(
+    grid_cache,
     "htmx/grid.html",
     session,
     db,
-    auth,
+    auth.user,
 )
-def categories(path=None):
-    queries = [db.category.id > 0]
-
-    search_queries = [
-        GridSearchQuery(
-            "Filter by category", lambda value: db.category.name.contains(value)
-        )
-    ]
-    search = GridSearch(
-        search_queries=search_queries,
-        queries=queries,
-        target_element="#categories-target",
-    )
+def sales_regions(path=None):
+    return setup_grid("sales_regions", path)
 
-    fields = [
-        db.category.name,
-    ]
 
-    gd = copy.deepcopy(GRID_DEFAULTS)
-    gd["rows_per_page"] = 10
+@action("setup/territories", method=["POST", "GET"])
+@action("setup/territories/<path:path>", method=["POST", "GET"])
+@action.uses(
+    grid_cache,
+    "htmx/grid.html",
+    session,
+    db,
+    auth,
+)
+def territories(path=None):
+    return setup_grid("territories", path)
 
-    grid = Grid(
-        path,
-        query=search.query,
-        fields=fields,
-        orderby=[db.category.name],
-        auto_process=False,
-        details=False,
-        search_form=search.search_form,
-        include_action_button_text=False,
-        **gd,
-    )
 
-    grid.attributes_plugin = AttributesPluginHtmx("#categories-target")
-    attrs = {
-        "_hx-get": URL("setup", "categories"),
-        "_class": "button is-default",
-    }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.details_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
+@action("setup/customer_types", method=["POST", "GET"])
+@action("setup/customer_types/<path:path>", method=["POST", "GET"])
+@action.uses(
+    grid_cache,
+    "htmx/grid.html",
+    session,
+    db,
+    auth.user,
+)
+def customer_types(path=None):
+    return setup_grid("customer_types", path)
 
-    grid.process()
 
-    return dict(grid=grid)
+@action("setup/categories", method=["POST", "GET"])
+@action("setup/categories/<path:path>", method=["POST", "GET"])
+@action.uses(
+    grid_cache,
+    "htmx/grid.html",
+    session,
+    db,
+    auth,
+)
+def categories(path=None):
+    return setup_grid("categories", path)
 
 
 @action("setup/shippers", method=["POST", "GET"])
 @action("setup/shippers/<path:path>", method=["POST", "GET"])
 @action.uses(
+    grid_cache,
     "htmx/grid.html",
     session,
     db,
     auth.user,
 )
 def shippers(path=None):
-    orderby = [db.shipper.name]
+    return setup_grid("shippers", path)
 
-    queries = [db.shipper.id > 0]
 
-    search_queries = [
-        GridSearchQuery(
-            "Filter by customer type",
-            lambda value: db.shipper.name.contains(value),
-        )
-    ]
-    search = GridSearch(
-        search_queries=search_queries,
-        queries=queries,
-        target_element="#shippers-target",
+def name_filter(table, value):
+    """
+    Rows whose name contains value, plus the most similar names when only a few do
+    """
+    index = search_indexes.get(
+        table, "%(name)s", [table.name], label_fields=[table.name]
     )
+    return index.contains_or_similar(table.name, value, settings.FUZZY_MIN_HITS)
 
-    fields = [db.shipper.name, db.shipper.phone]
 
-    gd = copy.deepcopy(GRID_DEFAULTS)
-    gd["rows_per_page"] = 10
+def get_types_for_customers(customer_ids):
+    types = dict()
+    for row in db(
+        db.customer_customer_type.customer.belongs(customer_ids)
+        & (db.customer_customer_type.customer_type == db.customer_type.id)
+    ).select(
+        db.customer_customer_type.customer,
+        db.customer_type.name,
+        orderby=db.customer_type.name,
+        distinct=True,
+    ):
+        types.setdefault(row.customer_customer_type.customer, []).append(
+            row.customer_type.name
+        )
 
-    grid = Grid(
-        path,
-        search.query,
-        fields=fields,
-        orderby=orderby,
-        details=False,
-        search_form=search.search_form,
-        auto_process=False,
-        include_action_button_text=False,
-        **gd,
+    return {
+        customer_id: XML(",<br />".join(xmlescape(name) for name in names))
+        for customer_id, names in types.items()
+    }
+
+
+#  the fragments of the detail pages, loaded by one request to fragments/<page>/<id>
+FRAGMENT_PAGES = dict(
+    customer=dict(
+        table=db.customer,
+        fields=CUSTOMER_DETAIL_FIELDS,
+        tables=[db.customer],
+        grids=["customer_notes", "customer_customer_types", "customer_orders"],
+    ),
+    employee=dict(
+        table=db.employee,
+        fields=EMPLOYEE_DETAIL_FIELDS,
+        tables=[db.employee, db.sales_region],
+        grids=["employee_territories", "employee_orders"],
+    ),
+    product=dict(
+        table=db.product,
+        fields=PRODUCT_DETAIL_FIELDS,
+        tables=[db.product, db.supplier, db.category],
+        grids=["product_orders"],
+    ),
+)
+
+
+@action("fragments/<name>/<record_id:int>", method=["GET"])
+@action.uses(
+    session,
+    db,
+    auth.user,
+)
+def fragments(name, record_id):
+    """
+    The details form and the child grids of a detail page in one response
+
+    Each fragment replaces its target element with an out-of-band swap, the page loads them with
+    a single hx-get (hx-swap="none").  They are rendered in one transaction from the record read
+    once, and the response is tagged with the versions of every table read.
+    """
+    page = FRAGMENT_PAGES.get(name)
+    if not page:
+        abort(404)
+
+    tables = list(page["tables"])
+    for grid_name in page["grids"]:
+        tables += GRIDS[grid_name].tables
+    conditional_get(
+        auth.user_id,
+        table_versions.version(*dict.fromkeys(t._tablename for t in tables)),
     )
 
-    grid.attributes_plugin = AttributesPluginHtmx("#shippers-target")
-    attrs = {
-        "_hx-get": URL("setup", "shippers"),
-        "_class": "button is-default",
-    }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.details_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
+    record = page["table"](record_id)
+    if not record:
+        ombott.abort(
+            code=401,
+            text="Could not retrieve %s.  Please contact support." % name,
+        )
 
-    grid.process()
+    html = [
+        oob_fragment(
+            "details-target",
+            render_template(
+                "htmx/form.html", detail_view(page["table"], record, page["fields"])
+            ),
+        )
+    ]
+    for grid_name in page["grids"]:
+        grid = child_grid(grid_name, None, record.id, embedded=True)
+        html.append(
+            oob_fragment(
+                GRIDS[grid_name].target,
+                render_template("htmx/grid.html", dict(grid=grid)),
+            )
+        )
 
-    return dict(grid=grid)
+    return "".join(html)
 
 
 @action("customers", method=["POST", "GET"])
@@ -411,7 +762,7 @@ def shippers(path=None):
 def customers(path=None):
     search_queries = [
         GridSearchQuery(
-            "Filter by Name", lambda value: db.customer.name.contains(value)
+            "Filter by Name", lambda value: name_filter(db.customer, value)
         ),
     ]
 
@@ -439,21 +790,7 @@ def customers(path=None):
             required_fields=[db.customer.contact, db.customer.title, db.customer.phone],
             orderby=db.customer.contact,
         ),
-        Column(
-            "Types",
-            represent=lambda row: XML(
-                ",<br />".join(
-                    x.name
-                    for x in db(
-                        db.customer_type.id.belongs(
-                            db(db.customer_customer_type.customer == row.id)._select(
-                                db.customer_customer_type.customer_type
-                            )
-                        )
-                    ).select(orderby=db.customer_type.name, distinct=True)
-                )
-            ),
-        ),
+        PrefetchColumn("Types", get_types_for_customers),
     ]
     orderby = [db.customer.name]
 
@@ -475,6 +812,7 @@ def customers(path=None):
 
     grid.param.details_submit_value = "Done"
     grid.process()
+    prefetch_columns(grid)
 
     parent_id = None
     customer = None
@@ -497,11 +835,9 @@ def customers(path=None):
     db,
 )
 def customer_new():
-    db.customer.id.readable = False
-
     form = Form(
-        db.customer,
-        formstyle=FormStyleBulma,
+        table_view(db.customer, hidden=["id"]),
+        formstyle=reference_formstyle(db.customer),
     )
 
     attrs = {
@@ -524,6 +860,8 @@ def customer_new():
     auth.user,
 )
 def customer_detail(customer_id=None):
+    conditional_get(auth.user_id, table_versions.version(db.customer))
+
     customer = db.customer(customer_id)
     if not customer:
         ombott.abort(
@@ -531,33 +869,7 @@ def customer_detail(customer_id=None):
             text="Could not retrieve customer.  Please contact support.",
         )
 
-    for field in db.customer.fields:
-        if field not in CUSTOMER_DETAIL_FIELDS:
-            db.customer[field].readable = False
-
-    db.customer.id.readable = True
-
-    attrs = {
-        "_hx-get": URL("customer_detail_edit/%s" % customer_id),
-        "_hx-target": "#details-target",
-    }
-
-    form = Form(
-        db.customer,
-        record=customer,
-        readonly=True,
-        deletable=False,
-        formstyle=FormStyleBulma,
-        dbio=False,
-        submit_value="Edit",
-        **attrs,
-    )
-
-    edit_button = BUTTON(
-        I(_class="fa fa-edit"), _class="submit-edit box-shadow-y", **attrs
-    )
-
-    return dict(form=form, form_fields=CUSTOMER_DETAIL_FIELDS, edit_button=edit_button)
+    return detail_view(db.customer, customer, CUSTOMER_DETAIL_FIELDS)
 
 
 @action(
@@ -578,22 +890,15 @@ def customer_detail_edit(customer_id=None):
             text="Could not retrieve customer.  Please contact support.",
         )
 
-    for field in db.customer.fields:
-        if field not in CUSTOMER_DETAIL_FIELDS:
-            db.customer[field].readable = False
-            db.customer[field].writable = False
-
-    db.customer.id.readable = True
-
     attrs = {
         "_hx-post": URL("customer_detail_edit/%s" % customer_id),
         "_hx-target": "#details-target",
     }
 
     form = Form(
-        db.customer,
+        table_view(db.customer, fields=CUSTOMER_DETAIL_FIELDS),
         record=customer,
-        formstyle=FormStyleBulma,
+        formstyle=reference_formstyle(db.customer),
         **attrs,
     )
 
@@ -613,183 +918,40 @@ def customer_detail_edit(customer_id=None):
 @action("customer_notes", method=["POST", "GET"])
 @action("customer_notes/<path:path>", method=["POST", "GET"])
 @action.uses(
+    grid_cache,
     "htmx/grid.html",
     session,
     db,
     auth,
 )
 def customer_notes(path=None):
-    #  set the default
-    customer_id = get_parent(
-        path,
-        parent_field=db.customer_note.customer,
-    )
-
-    customer = db.customer(customer_id)
-    db.customer_note.customer.default = customer_id
-
-    if path and path.split("/")[0] in ["new", "details", "edit"]:
-        db.customer_note.customer.readable = False
-        db.customer_note.customer.writable = False
-
-        db.customer_note.timestamp.readable = False
-        db.customer_note.timestamp.writable = False
-
-    query = db.customer_note.customer == customer_id
-
-    left = (db.customer.on(db.customer_note.customer == db.customer.id),)
-
-    grid = Grid(
-        path,
-        fields=[db.customer_note.timestamp, db.customer_note.note],
-        orderby=~db.customer_note.timestamp,
-        query=query,
-        left=left,
-        auto_process=False,
-        details=False,
-        include_action_button_text=False,
-        **GRID_DEFAULTS,
-    )
-
-    grid.formatters_by_type["datetime"] = (
-        lambda value: value.strftime("%m/%d/%Y %I:%M%p") if value else ""
-    )
-
-    grid.attributes_plugin = AttributesPluginHtmx("#notes-target")
-    attrs = {
-        "_hx-get": URL(
-            "customer_notes",
-            vars=dict(parent_id=customer_id),
-        ),
-        "_class": "button is-default",
-    }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
-
-    grid.process()
-
-    return dict(grid=grid)
+    return child_grid_action("customer_notes", path)
 
 
 @action("customer_customer_types", method=["POST", "GET"])
 @action("customer_customer_types/<path:path>", method=["POST", "GET"])
 @action.uses(
+    grid_cache,
     "htmx/grid.html",
     session,
     db,
     auth,
 )
 def customer_customer_types(path=None):
-    #  set the default
-    customer_id = get_parent(
-        path,
-        parent_field=db.customer_customer_type.customer,
-    )
-
-    customer = db.customer(customer_id)
-    db.customer_customer_type.customer.default = customer_id
-
-    if path and path.split("/")[0] in ["new", "details", "edit"]:
-        db.customer_customer_type.customer.readable = False
-        db.customer_customer_type.customer.writable = False
-
-    query = db.customer_customer_type.customer == customer_id
-
-    left = (
-        db.customer_type.on(
-            db.customer_customer_type.customer_type == db.customer_type.id
-        ),
-    )
-
-    grid = Grid(
-        path,
-        fields=[db.customer_type.name],
-        orderby=db.customer_type.name,
-        query=query,
-        left=left,
-        auto_process=False,
-        details=False,
-        include_action_button_text=False,
-        **GRID_DEFAULTS,
-    )
-
-    grid.attributes_plugin = AttributesPluginHtmx("#types-target")
-    attrs = {
-        "_hx-get": URL(
-            "customer_customer_types",
-            vars=dict(parent_id=customer_id),
-        ),
-        "_class": "button is-default",
-    }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
-
-    grid.process()
-
-    return dict(grid=grid)
-
-
-def get_products_for_row(row):
-    products = []
-    for od in db(db.order_detail.order == row.id).select():
-        if od.product.name not in products:
-            products.append(od.product.name)
-
-    return XML(",<br />".join(products))
+    return child_grid_action("customer_customer_types", path)
 
 
 @action("customer_orders", method=["POST", "GET"])
 @action("customer_orders/<path:path>", method=["POST", "GET"])
 @action.uses(
+    grid_cache,
     "htmx/grid.html",
     session,
     db,
     auth,
 )
 def customer_orders(path=None):
-    #  set the default
-    customer_id = get_parent(
-        path,
-        parent_field=db.order.customer,
-    )
-
-    query = db.order.customer == customer_id
-
-    grid = Grid(
-        path,
-        fields=[
-            db.order.id,
-            Column(
-                "Order Date",
-                represent=lambda row: row.order_date.strftime("%m/%d/%Y")
-                if row.order_date
-                else "",
-                required_fields=[db.order.order_date],
-            ),
-            db.order.subtotal,
-            db.order.freight,
-            db.order.total,
-        ],
-        orderby=[~db.order.order_date, ~db.order.id],
-        query=query,
-        show_id=True,
-        auto_process=False,
-        create=False,
-        details=False,
-        editable=False,
-        deletable=False,
-        include_action_button_text=False,
-        **GRID_DEFAULTS,
-    )
-
-    # grid.formatters_by_type["date"] = (
-    #     lambda value: value.strftime("%m/%d/%Y") if value else ""
-    # )
-
-    grid.attributes_plugin = AttributesPluginHtmx("#orders-target")
-    grid.process()
-
-    return dict(grid=grid)
+    return child_grid_action("customer_orders", path)
 
 
 @action("employees", method=["POST", "GET"])
@@ -870,11 +1032,9 @@ def employees(path=None):
     db,
 )
 def employee_new():
-    db.employee.id.readable = False
-
     form = Form(
-        db.employee,
-        formstyle=FormStyleBulma,
+        table_view(db.employee, hidden=["id"]),
+        formstyle=reference_formstyle(db.employee),
     )
 
     attrs = {
@@ -892,6 +1052,8 @@ def employee_new():
 @action("employee_detail/<employee_id>", method=["GET", "POST"])
 @action.uses("htmx/form.html", session, db, auth.user)
 def employee_detail(employee_id=None):
+    conditional_get(auth.user_id, table_versions.version(db.employee, db.sales_region))
+
     employee = db.employee(employee_id)
     if not employee:
         ombott.abort(
@@ -899,33 +1061,7 @@ def employee_detail(employee_id=None):
             text="Could not retrieve employee.  Please contact support.",
         )
 
-    for field in db.employee.fields:
-        if field not in EMPLOYEE_DETAIL_FIELDS:
-            db.employee[field].readable = False
-
-    db.employee.id.readable = True
-
-    attrs = {
-        "_hx-get": URL("employee_detail_edit/%s" % employee_id),
-        "_hx-target": "#details-target",
-    }
-
-    form = Form(
-        db.employee,
-        record=employee,
-        readonly=True,
-        deletable=False,
-        formstyle=FormStyleBulma,
-        dbio=False,
-        submit_value="Edit",
-        **attrs,
-    )
-
-    edit_button = BUTTON(
-        I(_class="fa fa-edit"), _class="submit-edit box-shadow-y", **attrs
-    )
-
-    return dict(form=form, form_fields=EMPLOYEE_DETAIL_FIELDS, edit_button=edit_button)
+    return detail_view(db.employee, employee, EMPLOYEE_DETAIL_FIELDS)
 
 
 @action(
@@ -946,22 +1082,15 @@ def employee_detail_edit(employee_id=None):
             text="Could not retrieve employee.  Please contact support.",
         )
 
-    for field in db.employee.fields:
-        if field not in EMPLOYEE_DETAIL_FIELDS:
-            db.employee[field].readable = False
-            db.employee[field].writable = False
-
-    db.employee.id.readable = True
-
     attrs = {
         "_hx-post": URL("employee_detail_edit/%s" % employee_id),
         "_hx-target": "#details-target",
     }
 
     form = Form(
-        db.employee,
+        table_view(db.employee, fields=EMPLOYEE_DETAIL_FIELDS),
         record=employee,
-        formstyle=FormStyleBulma,
+        formstyle=reference_formstyle(db.employee),
         **attrs,
     )
 
@@ -972,118 +1101,36 @@ def employee_detail_edit(employee_id=None):
     }
     form.param.sidecar.append(BUTTON("Cancel", **attrs))
 
-    if form.accepted:
-        redirect(URL("employee_detail/%s" % employee_id))
-
-    return dict(form=form, form_fields=EMPLOYEE_DETAIL_FIELDS)
-
-
-@action("employee_territories", method=["POST", "GET"])
-@action("employee_territories/<path:path>", method=["POST", "GET"])
-@action.uses(
-    "htmx/grid.html",
-    session,
-    db,
-    auth,
-)
-def employee_territories(path=None):
-    #  set the default
-    employee_id = get_parent(
-        path,
-        parent_field=db.employee_territory.employee,
-    )
-
-    employee = db.employee(employee_id)
-    db.employee_territory.employee.default = employee_id
-
-    if path and path.split("/")[0] in ["new", "details", "edit"]:
-        db.employee_territory.employee.readable = False
-        db.employee_territory.employee.writable = False
-
-    query = db.employee_territory.employee == employee_id
-
-    left = (db.territory.on(db.employee_territory.territory == db.territory.id),)
-
-    grid = Grid(
-        path,
-        fields=[db.territory.name],
-        orderby=db.territory.name,
-        query=query,
-        left=left,
-        auto_process=False,
-        details=False,
-        include_action_button_text=False,
-        **GRID_DEFAULTS,
-    )
-
-    grid.attributes_plugin = AttributesPluginHtmx("#territories-target")
-    attrs = {
-        "_hx-get": URL(
-            "employee_territories",
-            vars=dict(parent_id=employee_id),
-        ),
-        "_class": "button is-default",
-    }
-    grid.param.new_sidecar = BUTTON("Cancel", **attrs)
-    grid.param.edit_sidecar = BUTTON("Cancel", **attrs)
+    if form.accepted:
+        redirect(URL("employee_detail/%s" % employee_id))
 
-    grid.process()
+    return dict(form=form, form_fields=EMPLOYEE_DETAIL_FIELDS)
 
-    return dict(grid=grid)
+
+@action("employee_territories", method=["POST", "GET"])
+@action("employee_territories/<path:path>", method=["POST", "GET"])
+@action.uses(
+    grid_cache,
+    "htmx/grid.html",
+    session,
+    db,
+    auth,
+)
+def employee_territories(path=None):
+    return child_grid_action("employee_territories", path)
 
 
 @action("employee_orders", method=["POST", "GET"])
 @action("employee_orders/<path:path>", method=["POST", "GET"])
 @action.uses(
+    grid_cache,
     "htmx/grid.html",
     session,
     db,
     auth,
 )
 def employee_orders(path=None):
-    #  set the default
-    employee_id = get_parent(
-        path,
-        parent_field=db.order.employee,
-    )
-
-    query = db.order.employee == employee_id
-
-    grid = Grid(
-        path,
-        fields=[
-            db.order.id,
-            Column(
-                "Order Date",
-                represent=lambda row: row.order_date.strftime("%m/%d/%Y")
-                if row.order_date
-                else "",
-                required_fields=[db.order.order_date],
-            ),
-            db.order.subtotal,
-            db.order.freight,
-            db.order.total,
-        ],
-        orderby=[~db.order.order_date, ~db.order.id],
-        query=query,
-        show_id=True,
-        auto_process=False,
-        create=False,
-        details=False,
-        editable=False,
-        deletable=False,
-        include_action_button_text=False,
-        **GRID_DEFAULTS,
-    )
-
-    grid.formatters_by_type["date"] = (
-        lambda value: value.strftime("%m/%d/%Y") if value else ""
-    )
-
-    grid.attributes_plugin = AttributesPluginHtmx("#orders-target")
-    grid.process()
-
-    return dict(grid=grid)
+    return child_grid_action("employee_orders", path)
 
 
 @action("products", method=["POST", "GET"])
@@ -1099,42 +1146,14 @@ def products(path=None):
         GridSearchQuery(
             "Filter by Supplier",
             lambda value: db.product.supplier == value,
-            requires=IS_NULL_OR(
-                IS_IN_DB(
-                    db(
-                        db.supplier.id.belongs(
-                            db(db.product.id > 0)._select(
-                                db.product.supplier, distinct=True
-                            )
-                        )
-                    ),
-                    "supplier.id",
-                    "%(name)s",
-                    zero="..",
-                )
-            ),
+            requires=used_references.requires(db.product.supplier),
         ),
         GridSearchQuery(
             "Filter by Category",
             lambda value: db.product.category == value,
-            requires=IS_NULL_OR(
-                IS_IN_DB(
-                    db(
-                        db.category.id.belongs(
-                            db(db.product.id > 0)._select(
-                                db.product.category, distinct=True
-                            )
-                        )
-                    ),
-                    "category.id",
-                    "%(name)s",
-                    zero="..",
-                )
-            ),
-        ),
-        GridSearchQuery(
-            "Filter by Name", lambda value: db.product.name.contains(value)
+            requires=used_references.requires(db.product.category),
         ),
+        GridSearchQuery("Filter by Name", lambda value: name_filter(db.product, value)),
     ]
 
     queries = [(db.product.id > 0)]
@@ -1198,11 +1217,9 @@ def products(path=None):
     db,
 )
 def product_new():
-    db.product.id.readable = False
-
     form = Form(
-        db.product,
-        formstyle=FormStyleBulma,
+        table_view(db.product, hidden=["id"]),
+        formstyle=reference_formstyle(db.product),
     )
 
     attrs = {
@@ -1225,6 +1242,10 @@ def product_new():
     auth.user,
 )
 def product_detail(product_id=None):
+    conditional_get(
+        auth.user_id, table_versions.version(db.product, db.supplier, db.category)
+    )
+
     product = db.product(product_id)
     if not product:
         ombott.abort(
@@ -1232,33 +1253,7 @@ def product_detail(product_id=None):
             text="Could not retrieve product.  Please contact support.",
         )
 
-    for field in db.product.fields:
-        if field not in PRODUCT_DETAIL_FIELDS:
-            db.product[field].readable = False
-
-    db.product.id.readable = True
-
-    attrs = {
-        "_hx-get": URL("product_detail_edit/%s" % product_id),
-        "_hx-target": "#details-target",
-    }
-
-    form = Form(
-        db.product,
-        record=product,
-        readonly=True,
-        deletable=False,
-        formstyle=FormStyleBulma,
-        dbio=False,
-        submit_value="Edit",
-        **attrs,
-    )
-
-    edit_button = BUTTON(
-        I(_class="fa fa-edit"), _class="submit-edit box-shadow-y", **attrs
-    )
-
-    return dict(form=form, form_fields=PRODUCT_DETAIL_FIELDS, edit_button=edit_button)
+    return detail_view(db.product, product, PRODUCT_DETAIL_FIELDS)
 
 
 @action(
@@ -1279,22 +1274,15 @@ def product_detail_edit(product_id=None):
             text="Could not retrieve product.  Please contact support.",
         )
 
-    for field in db.product.fields:
-        if field not in PRODUCT_DETAIL_FIELDS:
-            db.product[field].readable = False
-            db.product[field].writable = False
-
-    db.product.id.readable = True
-
     attrs = {
         "_hx-post": URL("product_detail_edit/%s" % product_id),
         "_hx-target": "#details-target",
     }
 
     form = Form(
-        db.product,
+        table_view(db.product, fields=PRODUCT_DETAIL_FIELDS),
         record=product,
-        formstyle=FormStyleBulma,
+        formstyle=reference_formstyle(db.product),
         **attrs,
     )
 
@@ -1314,108 +1302,33 @@ def product_detail_edit(product_id=None):
 @action("product_orders", method=["POST", "GET"])
 @action("product_orders/<path:path>", method=["POST", "GET"])
 @action.uses(
+    grid_cache,
     "htmx/grid.html",
     session,
     db,
     auth,
 )
 def product_orders(path=None):
-    #  set the default
-    product_id = get_parent(
-        path,
-        parent_field=db.order_detail.product,
-    )
-
-    query = db.order_detail.product == product_id
-
-    gd = copy.deepcopy(GRID_DEFAULTS)
-    gd["rows_per_page"] = 7
-
-    grid = Grid(
-        path,
-        fields=[
-            db.order.id,
-            Column(
-                "Order Date",
-                represent=lambda row: row.order.order_date.strftime("%m/%d/%Y")
-                if row.order.order_date
-                else "",
-                required_fields=[db.order.order_date],
-            ),
-            db.order.subtotal,
-            db.order.freight,
-            db.order.total,
-        ],
-        orderby=[~db.order.order_date, ~db.order.id],
-        query=query,
-        left=[db.order.on(db.order_detail.order == db.order.id)],
-        show_id=True,
-        auto_process=False,
-        create=False,
-        details=False,
-        editable=False,
-        deletable=False,
-        include_action_button_text=False,
-        **gd,
-    )
-
-    grid.attributes_plugin = AttributesPluginHtmx("#orders-target")
-    grid.process()
-
-    return dict(grid=grid)
+    return child_grid_action("product_orders", path)
 
 
-@action("orders", method=["POST", "GET"])
-@action("orders/<path:path>", method=["POST", "GET"])
-@action.uses(
-    "orders.html",
-    session,
-    db,
-    auth.user,
-)
-def orders(path=None):
-    search_queries = [
+def order_search_queries():
+    return [
         GridSearchQuery(
             "Filter by Customer",
             lambda value: db.order.customer == value,
-            requires=IS_NULL_OR(
-                IS_IN_DB(
-                    db(
-                        db.customer.id.belongs(
-                            db(db.order.id > 0)._select(
-                                db.order.customer, distinct=True
-                            )
-                        )
-                    ),
-                    "customer.id",
-                    "%(name)s",
-                    zero="..",
-                )
-            ),
+            requires=used_references.requires(db.order.customer),
         ),
         GridSearchQuery(
             "Filter by Employee",
             lambda value: db.order.employee == value,
-            requires=IS_NULL_OR(
-                IS_IN_DB(
-                    db(
-                        db.employee.id.belongs(
-                            db(db.order.id > 0)._select(
-                                db.order.employee, distinct=True
-                            )
-                        )
-                    ),
-                    "employee.id",
-                    "%(last_name)s, %(first_name)s",
-                    zero="..",
-                )
-            ),
+            requires=used_references.requires(db.order.employee),
         ),
     ]
 
-    queries = [(db.order.id > 0)]
-    fields = [
-        db.order.id,
+
+def order_grid_columns():
+    return [
         Column(
             "Ordered",
             represent=lambda row: row.order.order_date,
@@ -1478,15 +1391,34 @@ def orders(path=None):
             orderby=[db.order.shipped_date],
         ),
     ]
-    orderby = [~db.order.order_date]
 
-    search = GridSearch(search_queries, queries)
 
-    left = [
+def order_grid_left():
+    return [
         db.customer.on(db.order.customer == db.customer.id),
         db.employee.on(db.order.employee == db.employee.id),
     ]
 
+
+@action("orders", method=["POST", "GET"])
+@action("orders/<path:path>", method=["POST", "GET"])
+@action.uses(
+    "orders.html",
+    session,
+    db,
+    auth.user,
+)
+def orders(path=None):
+    search_queries = order_search_queries()
+
+    queries = [(db.order.id > 0)]
+    fields = [db.order.id] + order_grid_columns()
+    orderby = [~db.order.order_date]
+
+    search = GridSearch(search_queries, queries)
+
+    left = order_grid_left()
+
     gd = copy.deepcopy(GRID_DEFAULTS)
     gd["rows_per_page"] = 5
 
@@ -1511,14 +1443,155 @@ def orders(path=None):
     grid.process()
 
     parent_id = None
-    order = None
     if grid.action in ["details", "edit"]:
+        #  the order itself is loaded by order_page
         parent_id = grid.record_id
-        order = db.order(parent_id)
     elif grid.action in ["new"]:
         redirect(URL("order_new"))
 
-    return dict(grid=grid, parent_id=parent_id, order=order)
+    return dict(grid=grid, parent_id=parent_id)
+
+
+@action("orders_scroll", method=["GET"])
+@action.uses(
+    "scroll.html",
+    session,
+    db,
+    auth.user,
+)
+def orders_scroll():
+    search = GridSearch(
+        order_search_queries(),
+        [(db.order.id > 0)],
+        build_form=not is_scroll_request(),
+    )
+
+    scroll = InfiniteScroll(
+        scroll_cursors,
+        search.query,
+        [db.order.id] + order_grid_columns(),
+        key=db.order.id,
+        left=order_grid_left(),
+        search=search.values,
+        user_id=auth.user_id,
+    )
+
+    if is_scroll_request():
+        return scroll.render_chunk()
+
+    return dict(scroll=scroll, search_form=search.search_form, title="ORDERS")
+
+
+def order_line_search_queries():
+    return [
+        GridSearchQuery(
+            "Filter by Product",
+            lambda value: db.order_detail.product == value,
+            requires=IS_NULL_OR(IS_IN_DB(db, "product.id", "%(name)s", zero="..")),
+        ),
+        GridSearchQuery(
+            "Filter by Order",
+            lambda value: db.order_detail.order == value,
+        ),
+    ]
+
+
+def order_line_columns():
+    return [
+        db.order_detail.order,
+        Column(
+            "Ordered",
+            represent=lambda row: row.order.order_date,
+            required_fields=[db.order.order_date],
+        ),
+        Column(
+            "Customer",
+            represent=lambda row: row.customer.name,
+            required_fields=[db.customer.name],
+        ),
+        db.product.name,
+        db.order_detail.unit_price,
+        db.order_detail.quantity,
+        db.order_detail.discount,
+    ]
+
+
+def order_line_left():
+    return [
+        db.order.on(db.order_detail.order == db.order.id),
+        db.customer.on(db.order.customer == db.customer.id),
+        db.product.on(db.order_detail.product == db.product.id),
+    ]
+
+
+@action("order_lines_scroll", method=["GET"])
+@action.uses(
+    "scroll.html",
+    session,
+    db,
+    auth.user,
+)
+def order_lines_scroll():
+    search = GridSearch(
+        order_line_search_queries(),
+        [(db.order_detail.id > 0)],
+        build_form=not is_scroll_request(),
+    )
+
+    scroll = InfiniteScroll(
+        scroll_cursors,
+        search.query,
+        order_line_columns(),
+        key=db.order_detail.id,
+        left=order_line_left(),
+        search=search.values,
+        user_id=auth.user_id,
+    )
+
+    if is_scroll_request():
+        return scroll.render_chunk()
+
+    return dict(scroll=scroll, search_form=search.search_form, title="ORDER LINES")
+
+
+#  grids that can be exported, name -> (search queries, base query, columns, left, orderby)
+#  the exports are ordered by primary key so the rows stream without a sort
+GRID_EXPORTS = {
+    "orders": lambda: (
+        order_search_queries(),
+        db.order.id > 0,
+        [db.order.id] + order_grid_columns(),
+        order_grid_left(),
+        db.order.id,
+    ),
+    "order_lines": lambda: (
+        order_line_search_queries(),
+        db.order_detail.id > 0,
+        [db.order_detail.id] + order_line_columns(),
+        order_line_left(),
+        db.order_detail.id,
+    ),
+}
+
+
+@action("export/<name>/<fmt>", method=["GET"])
+@action.uses(session, db, auth.user)
+def export(name=None, fmt=None):
+    if name not in GRID_EXPORTS or fmt not in EXPORT_FORMATS:
+        abort(404)
+
+    search_queries, query, columns, left, orderby = GRID_EXPORTS[name]()
+    search = GridSearch(search_queries, [query], build_form=False)
+
+    return stream_export(
+        db,
+        fmt,
+        name,
+        search.query,
+        columns,
+        left=left,
+        orderby=orderby,
+    )
 
 
 @action(
@@ -1531,11 +1604,9 @@ def orders(path=None):
     db,
 )
 def order_new():
-    db.order.id.readable = False
-
     form = Form(
-        db.order,
-        formstyle=FormStyleBulma,
+        table_view(db.order, hidden=["id"]),
+        formstyle=reference_formstyle(db.order),
     )
 
     attrs = {
@@ -1558,6 +1629,11 @@ def order_new():
     auth.user,
 )
 def order_detail(order_id=None):
+    conditional_get(
+        auth.user_id,
+        table_versions.version(db.order, db.customer, db.employee, db.shipper),
+    )
+
     order = db.order(order_id)
     if not order:
         ombott.abort(
@@ -1565,33 +1641,62 @@ def order_detail(order_id=None):
             text="Could not retrieve order.  Please contact support.",
         )
 
-    for field in db.order.fields:
-        if field not in ORDER_DETAIL_FIELDS:
-            db.order[field].readable = False
+    return detail_view(db.order, order, ORDER_DETAIL_FIELDS)
 
-    db.order.id.readable = True
-
-    attrs = {
-        "_hx-get": URL("order_detail_edit/%s" % order_id),
-        "_hx-target": "#details-target",
-    }
 
-    form = Form(
-        db.order,
-        record=order,
-        readonly=True,
-        deletable=False,
-        formstyle=FormStyleBulma,
-        dbio=False,
-        submit_value="Edit",
-        **attrs,
+def order_header(model):
+    """
+    Label and text of the ORDER_DETAIL_FIELDS of a load_order model
+    """
+    order = model["order"]
+    names = dict(
+        customer=model["customer"].name,
+        employee=" ".join(
+            filter(None, [model["employee"].first_name, model["employee"].last_name])
+        ),
+        shipper=model["shipper"].name,
     )
 
-    edit_button = BUTTON(
-        I(_class="fa fa-edit"), _class="submit-edit box-shadow-y", **attrs
+    header = []
+    for name in ORDER_DETAIL_FIELDS:
+        value = names[name] if name in names else order[name]
+        if hasattr(value, "strftime"):
+            value = value.strftime("%m/%d/%Y")
+        header.append((db.order[name].label, value if value is not None else ""))
+    return header
+
+
+@action("order_page/<order_id>", method=["GET"])
+@action.uses(
+    "order_details.html",
+    session,
+    db,
+    auth.user,
+)
+def order_page(order_id=None):
+    """
+    The details, lines and totals of an order in one fragment, from a single load_order
+    """
+    conditional_get(
+        auth.user_id,
+        table_versions.version(
+            db.order,
+            db.order_detail,
+            db.product,
+            db.customer,
+            db.employee,
+            db.shipper,
+        ),
     )
 
-    return dict(form=form, form_fields=ORDER_DETAIL_FIELDS, edit_button=edit_button)
+    model = load_order(order_id)
+    if not model:
+        ombott.abort(
+            code=401,
+            text="Could not retrieve order.  Please contact support.",
+        )
+
+    return dict(header=order_header(model), **model)
 
 
 @action(
@@ -1612,22 +1717,15 @@ def order_detail_edit(order_id=None):
             text="Could not retrieve order.  Please contact support.",
         )
 
-    for field in db.order.fields:
-        if field not in ORDER_DETAIL_FIELDS:
-            db.order[field].readable = False
-            db.order[field].writable = False
-
-    db.order.id.readable = True
-
     attrs = {
         "_hx-post": URL("order_detail_edit/%s" % order_id),
         "_hx-target": "#details-target",
     }
 
     form = Form(
-        db.order,
+        table_view(db.order, fields=ORDER_DETAIL_FIELDS),
         record=order,
-        formstyle=FormStyleBulma,
+        formstyle=reference_formstyle(db.order),
         **attrs,
     )
 
@@ -1653,33 +1751,32 @@ def order_detail_edit(order_id=None):
     auth,
 )
 def order_details(path=None):
+    if not path or path.split("/")[0] == "select":
+        conditional_get(
+            auth.user_id,
+            is_rows_request(),
+            table_versions.version(db.order_detail, db.product),
+        )
+
     #  set the default
     order_id = get_parent(
         path,
         parent_field=db.order_detail.order,
     )
 
-    db.order_detail.order.default = order_id
-
-    if path and path.split("/")[0] in ["new", "edit"]:
-        db.order_detail.order.readable = False
-        db.order_detail.order.writable = False
-
-        db.order_detail.unit_price.writable = False
+    view = table_view(
+        db.order_detail,
+        hidden=["order"],
+        readonly=["unit_price"],
+        defaults=dict(order=order_id),
+    )
 
     query = db.order_detail.order == order_id
     left = [
         db.product.on((db.order_detail.product == db.product.id)),
     ]
 
-    formstyle = FormStyleFactory()
-    formstyle.classes = FormStyleBulma.classes
-    formstyle.class_inner_exceptions = FormStyleBulma.class_inner_exceptions
-    formstyle.widgets["product"] = HtmxAutocompleteWidget(
-        simple_query=(db.product.id > 0)
-    )
-
-    grid = Grid(
+    grid = HtmxGrid(
         path,
         fields=[
             db.product.name,
@@ -1700,12 +1797,13 @@ def order_details(path=None):
         auto_process=False,
         details=False,
         grid_class_style=GridClassStyleBulma,
-        formstyle=formstyle,
+        formstyle=reference_formstyle(db.order_detail),
+        views=[view],
         rows_per_page=10,
         include_action_button_text=False,
     )
 
-    grid.attributes_plugin = AttributesPluginHtmx("#lines-target")
+    grid.attributes_plugin = AttributesPluginHtmxRows("#lines-target")
     attrs = {
         "_hx-get": URL(
             "order_details",
@@ -1,10 +1,50 @@
 import json
 from functools import reduce
 
-from yatl import DIV, INPUT, SCRIPT
+from yatl import DIV, INPUT
 
-from py4web import action, request, URL
-from .common import session, db, auth
+from py4web import action, request, response, abort, redirect, URL, Cache
+from .common import (
+    session,
+    db,
+    auth,
+    table_versions,
+    autocomplete_fields,
+    search_indexes,
+    option_sets,
+    row_counts,
+)
+from .lib.caching import ResultCache
+from .lib.autocomplete import AutocompleteLabels
+from .lib.search_index import normalise
+from . import settings
+
+#  autocomplete results, LRU, invalidated by writes to the referenced table
+autocomplete_cache = ResultCache(
+    Cache(size=settings.AUTOCOMPLETE_CACHE_SIZE), table_versions
+)
+
+#  labels of the values shown by the autocomplete widgets, batched per referenced table
+autocomplete_labels = AutocompleteLabels(
+    Cache(size=settings.AUTOCOMPLETE_CACHE_SIZE), table_versions
+)
+
+
+def get_search_index(entry):
+    return search_indexes.get(
+        entry.fk_table,
+        entry.label,
+        entry.search_fields,
+        label_fields=entry.label_fields if isinstance(entry.label, str) else None,
+    )
+
+
+def autocomplete_limit():
+    try:
+        limit = int(request.params.get("limit") or settings.AUTOCOMPLETE_LIMIT)
+    except ValueError:
+        limit = settings.AUTOCOMPLETE_LIMIT
+    return max(1, min(limit, settings.AUTOCOMPLETE_MAX_LIMIT))
 
 
 @action(
@@ -20,72 +60,132 @@ from .common import session, db, auth
 def autocomplete():
     tablename = request.params.tablename
     fieldname = request.params.fieldname
-    autocomplete_query = request.params.query
-
-    field = db[tablename][fieldname]
-    data = []
-    label = fieldname
-
-    fk_table = None
-
-    if field and field.requires:
-        queries = []
-        orderby = []
-        label = ""
-        if "ktable" in dir(field.requires):
-            fk_table = field.requires.ktable
-            fk_field = field.requires.kfield
-            orderby = field.requires.orderby
-            label = field.requires.label
-        elif field.requires.other:
-            fk_table = field.requires.other.ktable
-            fk_field = field.requires.other.kfield
-            orderby = field.requires.other.orderby
-            label = field.requires.other.label
-
-        search_value = request.params[f"{tablename}_{fieldname}_search"]
-        if "_autocomplete_search_fields" in dir(field):
-            for sf in field._autocomplete_search_fields:
-                queries.append(db[fk_table][sf].contains(search_value))
-            query = reduce(lambda a, b: (a | b), queries)
-        else:
-            for f in db[fk_table]:
-                if f.type in ["string", "text"]:
-                    queries.append(db[fk_table][f.name].contains(search_value))
-                elif f.type in ["integer", "id"] and search_value.isdigit():
-                    queries.append(db[fk_table][f.name] == search_value)
 
-            query = reduce(lambda a, b: (a | b), queries)
+    entry = autocomplete_fields.get(tablename, fieldname)
+    if not entry:
+        abort(400, "Autocomplete is not enabled for %s.%s" % (tablename, fieldname))
 
-        if len(queries) == 0 and fk_table:
-            queries = [db[fk_table].id > 0]
-            query = reduce(lambda a, b: (a & b), queries)
+    search_value = normalise(request.params.get(f"{tablename}_{fieldname}_search"))
+    limit = autocomplete_limit()
 
-        if autocomplete_query:
-            query = reduce(lambda a, b: (a & b), [autocomplete_query, query])
-        data = db(query).select(orderby=orderby)
+    def lookup():
+        #  prefix and word-prefix matches come from the in-memory index, topped up with the most
+        #  similar labels when there are only a few; the database is only searched for a
+        #  filtered field, an id or when the index finds nothing
+        data = []
+        if (
+            entry.key.type == "id"
+            and entry.search_fields
+            and entry.query is None
+            and not search_value.isdigit()
+        ):
+            index = get_search_index(entry)
+            data = index.search(search_value, limit)
+            if len(data) < settings.FUZZY_MIN_HITS:
+                data += index.fuzzy_search(
+                    search_value,
+                    limit - len(data),
+                    exclude=[key for key, label in data],
+                )
+
+        if not data:
+            data = search_database(entry, search_value, limit)
+        return data
+
+    data = autocomplete_cache.get(
+        (tablename, fieldname, search_value, str(entry.query), limit),
+        [entry.fk_table],
+        lookup,
+    )
 
     return dict(
         data=data,
         tablename=tablename,
         fieldname=fieldname,
-        fk_table=fk_table,
-        data_label=label,
+        fk_table=entry.fk_table._tablename,
     )
 
 
+@action("htmx/options/<tablename>/<version:int>", method=["GET"])
+@action.uses(db, auth.user)
+def options(tablename, version):
+    """
+    The whole option list of a small reference table, for HtmxOptionsWidget
+
+    The URL carries the table version, so the response never changes and the browser can keep it
+    for good.  An outdated version is redirected to the current one.
+    """
+    if not option_sets.get(tablename):
+        abort(404)
+
+    (current,) = table_versions.version(tablename)
+    if version != current:
+        redirect(URL("htmx/options", tablename, current))
+
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return dict(version=current, options=option_sets.options(tablename, current))
+
+
+def search_database(entry, search_value, limit):
+    """
+    Search the referenced table for the autocomplete values
+
+    Parameters
+    ----------
+    entry: the AutocompleteField
+    search_value: the normalised text typed by the user
+    limit: max number of matches
+
+    Returns
+    -------
+    list of (key, label) of the top matches, prefix matches first
+    """
+    fk_table = entry.fk_table
+    queries = [f.contains(search_value) for f in entry.search_fields]
+    prefix_queries = [f.startswith(search_value) for f in entry.search_fields]
+    if search_value.isdigit():
+        queries += [f == search_value for f in fk_table if f.type in ["integer", "id"]]
+
+    if len(queries) == 0:
+        queries = [fk_table.id > 0]
+    query = reduce(lambda a, b: (a | b), queries)
+
+    if entry.query is not None:
+        query = entry.query & query
+
+    #  only the key and the columns shown in the label, prefix matches first, top-N in SQL
+    columns = entry.label_fields
+    fields = [entry.key, fk_table.id] + columns
+    ranking = []
+    if prefix_queries:
+        ranking = [reduce(lambda a, b: (a | b), prefix_queries).case(0, 1)]
+    rows = db(query).select(
+        *{f.longname: f for f in fields}.values(),
+        orderby=ranking
+        + ([entry.orderby] if entry.orderby else columns or [fk_table.id]),
+        limitby=(0, limit),
+    )
+
+    return [(row[entry.key.name], entry.make_label(row)) for row in rows]
+
+
 class HtmxAutocompleteWidget:
-    def __init__(self, simple_query=None, url=None, **attrs):
-        self.query = simple_query
+    """
+    Text input with htmx autocomplete for a reference field
+
+    The field must be registered with autocomplete_fields (see models.py), which also holds the
+    query restricting the rows offered.
+    """
+
+    def __init__(self, url=None, **attrs):
         self.url = url if url else URL("htmx/autocomplete")
         self.attrs = attrs
 
-        self.attrs.pop("simple_query", None)
         self.attrs.pop("url", None)
 
     def make(self, field, value, error, title, placeholder="", readonly=False):
         #  TODO: handle readonly parameter
-        control = DIV()
+        control = DIV(**{"_data-autocomplete-widget": True})
         if "_table" in dir(field):
             tablename = field._table
         else:
@@ -97,6 +197,7 @@ class HtmxAutocompleteWidget:
             _id="%s_%s" % (tablename, field.name),
             _name=field.name,
             _value=value,
+            **{"_data-autocomplete-value": True},
         )
         hidden_div = DIV(hidden_input, _style="display: none;")
         control.append(hidden_div)
@@ -105,10 +206,15 @@ class HtmxAutocompleteWidget:
 
         #  set the htmx attributes
 
+        entry = autocomplete_fields.get(str(tablename), field.name)
+        if not entry:
+            raise ValueError(
+                "Autocomplete is not enabled for %s.%s" % (tablename, field.name)
+            )
+
         values = {
             "tablename": str(tablename),
             "fieldname": field.name,
-            "query": str(self.query) if self.query else "",
             **self.attrs,
         }
         attrs = {
@@ -119,14 +225,8 @@ class HtmxAutocompleteWidget:
             "_hx-vals": json.dumps(values),
         }
         search_value = None
-        if value and field.requires:
-            row = (
-                db(db[field.requires.ktable][field.requires.kfield] == value)
-                .select()
-                .first()
-            )
-            if row:
-                search_value = field.requires.label % row
+        if value:
+            search_value = autocomplete_labels.lazy(entry, value)
 
         control.append(
             INPUT(
@@ -138,31 +238,96 @@ class HtmxAutocompleteWidget:
                 _placeholder=placeholder if placeholder and placeholder != "" else "..",
                 _title=title,
                 _autocomplete="off",
+                **{"_data-autocomplete-search": True},
                 **attrs,
             )
         )
 
         control.append(DIV(_id="%s_%s_autocomplete_results" % (tablename, field.name)))
 
+        return control
+
+
+class HtmxOptionsWidget:
+    """
+    Text input filtering the options of a small reference table in the browser
+
+    The referenced table must be registered with option_sets (see models.py).  The options are
+    fetched once from htmx/options and kept by the browser until the table is written, so typing
+    costs no request at all.  Uses the same markup as HtmxAutocompleteWidget, static/js/options.js
+    fills the results and static/js/autocomplete.js handles the picking.
+    """
+
+    def make(self, field, value, error, title, placeholder="", readonly=False):
+        tablename = field._tablename
+        fk_tablename = field.type.split()[1]
+        if not option_sets.get(fk_tablename):
+            raise ValueError("No option set for %s" % fk_tablename)
+
+        control = DIV(**{"_data-autocomplete-widget": True})
+
+        hidden_input = INPUT(
+            _type="text",
+            _id="%s_%s" % (tablename, field.name),
+            _name=field.name,
+            _value=value,
+            **{"_data-autocomplete-value": True},
+        )
+        control.append(DIV(hidden_input, _style="display: none;"))
+
+        control.append(
+            INPUT(
+                _type="text",
+                _id="%s_%s_search" % (tablename, field.name),
+                _value=option_sets.label(fk_tablename, value) if value else None,
+                _class="input",
+                _placeholder=placeholder if placeholder else "..",
+                _title=title,
+                _autocomplete="off",
+                **{
+                    "_data-autocomplete-search": True,
+                    "_data-options-url": URL(
+                        "htmx/options", fk_tablename, option_sets.version(fk_tablename)
+                    ),
+                },
+            )
+        )
+
         control.append(
-            SCRIPT(
-                """
-        htmx.onLoad(function(elt) {
-            document.querySelector('#%(table)s_%(field)s_search').onkeydown = check_%(table)s_%(field)s_down_key;
-            \n
-            function check_%(table)s_%(field)s_down_key(e) {
-                if (e.keyCode == '40') {
-                    document.querySelector('#%(table)s_%(field)s_autocomplete').focus();
-                    document.querySelector('#%(table)s_%(field)s_autocomplete').selectedIndex = 0;
-                }
-            }
-        })
-            """
-                % {
-                    "table": tablename,
-                    "field": field.name,
-                }
+            DIV(
+                _id="%s_%s_autocomplete_results" % (tablename, field.name),
+                **{"_data-autocomplete-results": True},
             )
         )
 
         return control
+
+
+def reference_widget(field):
+    """
+    Pick the widget of a reference field from the size of the referenced table
+
+    Parameters
+    ----------
+    field: a field of a form
+
+    Returns
+    -------
+    HtmxOptionsWidget for a table registered with option_sets having at most
+    settings.CLIENT_OPTIONS_MAX_ROWS rows, HtmxAutocompleteWidget for a field registered with
+    autocomplete_fields whose table has more than settings.AUTOCOMPLETE_MIN_ROWS rows, None to
+    keep the IS_IN_DB dropdown
+    """
+    if not field.type.startswith("reference "):
+        return None
+
+    fk_tablename = field.type.split()[1]
+    count = row_counts.count(field._db[fk_tablename])
+    if option_sets.get(fk_tablename) and count <= settings.CLIENT_OPTIONS_MAX_ROWS:
+        return HtmxOptionsWidget()
+    if (
+        autocomplete_fields.get(field._tablename, field.name)
+        and count > settings.AUTOCOMPLETE_MIN_ROWS
+    ):
+        return HtmxAutocompleteWidget()
+    return None
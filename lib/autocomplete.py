@@ -0,0 +1,290 @@
+import re
+import threading
+
+from py4web.core import Fixture
+from yatl.sanitizer import xmlescape
+
+#  the fields referenced by an IS_IN_DB label format like "%(last_name)s, %(first_name)s"
+LABEL_FIELD_RE = re.compile(r"%\((\w+)\)")
+
+
+def label_fields(table, label):
+    """
+    Get the fields of a table used by an IS_IN_DB label
+
+    Parameters
+    ----------
+    table: the pydal table the label is applied to
+    label: the label format string, or a callable
+
+    Returns
+    -------
+    list of pydal fields - all the fields of the table if the label is not a format string
+    """
+    if not isinstance(label, str):
+        return list(table)
+    return [
+        table[name] for name in LABEL_FIELD_RE.findall(label) if name in table.fields
+    ]
+
+
+class AutocompleteField:
+    """
+    Everything htmx/autocomplete needs to know about a reference field, resolved once
+
+    Attributes
+    ----------
+    tablename, fieldname: the reference field
+    fk_table: the referenced pydal table
+    key: the referenced field stored in the reference field
+    label: the IS_IN_DB label, format string or callable
+    orderby: the IS_IN_DB orderby, or None
+    search_fields: the fields of fk_table searched for the typed value
+    label_fields: the fields of fk_table needed to build the label
+    query: a pydal query restricting the rows offered, or None
+    """
+
+    def __init__(self, field, search_fields=None, query=None):
+        requires = field.requires
+        if isinstance(requires, (list, tuple)):
+            requires = requires[0]
+        if not hasattr(requires, "ktable"):
+            requires = requires.other
+
+        db = field._db
+        self.tablename = field._tablename
+        self.fieldname = field.name
+        self.fk_table = db[requires.ktable]
+        self.key = self.fk_table[requires.kfield]
+        self.label = requires.label
+        self.orderby = requires.orderby
+        if search_fields:
+            self.search_fields = [self.fk_table[name] for name in search_fields]
+        else:
+            self.search_fields = [
+                f for f in self.fk_table if f.type in ["string", "text"]
+            ]
+        self.label_fields = label_fields(self.fk_table, self.label)
+        self.query = query
+
+    def make_label(self, row):
+        return self.label(row) if callable(self.label) else self.label % row
+
+
+class AutocompleteRegistry:
+    """
+    The reference fields that can be used with htmx/autocomplete
+
+    Register the fields at model load, the action and HtmxAutocompleteWidget look them up instead
+    of introspecting the validators on every request, and the action refuses any other
+    table/field pair.
+    """
+
+    def __init__(self):
+        self.fields = dict()
+
+    def register(self, field, search_fields=None, query=None):
+        """
+        Enable autocomplete for a reference field
+
+        Parameters
+        ----------
+        field: the reference field, its requires must be IS_IN_DB or IS_NULL_OR(IS_IN_DB)
+        search_fields: names of the fields of the referenced table to search, default all string/text fields
+        query: a pydal query restricting the rows offered
+        """
+        entry = AutocompleteField(field, search_fields=search_fields, query=query)
+        self.fields[(entry.tablename, entry.fieldname)] = entry
+        return entry
+
+    def get(self, tablename, fieldname):
+        return self.fields.get((tablename, fieldname))
+
+
+class LazyLabel:
+    """
+    Placeholder for the label of a value, rendered as the escaped label once the labels are resolved
+
+    yatl renders attribute values that are not strings with str() and no escaping, so __str__
+    escapes the label itself.
+    """
+
+    def __init__(self, labels, entry, value):
+        self.labels = labels
+        self.entry = entry
+        self.value = value
+
+    def __str__(self):
+        return xmlescape(self.labels.get(self.entry, self.value) or "")
+
+
+class AutocompleteLabels:
+    """
+    The labels of the current values of autocomplete widgets
+
+    Widgets ask for a lazy label while the form is built.  When the first one is rendered, every
+    label asked for so far in this request is resolved at once, with one belongs query per
+    referenced table.  Resolved labels are kept in storage, keyed by the version of the referenced
+    table, so later forms showing the same values cost no query.
+
+    storage can be the py4web Cache or any object with the same get(key, callback, expiration)
+    signature.
+    """
+
+    def __init__(self, storage, versions, expiration=3600):
+        self.storage = storage
+        self.versions = versions
+        self.expiration = expiration
+        self.local = threading.local()
+
+    def lazy(self, entry, value):
+        """
+        Get a placeholder for the label of value, to use as a helper attribute or content
+
+        Parameters
+        ----------
+        entry: the AutocompleteField of the widget
+        value: the current value of the reference field
+        """
+        self._pending().append((entry, value))
+        return LazyLabel(self, entry, value)
+
+    def get(self, entry, value):
+        key = self._key(entry, value)
+        label = self.storage.get(key, lambda: None, self.expiration)
+        if label is None:
+            self.resolve()
+            label = self.storage.get(key, lambda: None, self.expiration)
+        return label
+
+    def resolve(self):
+        """
+        Resolve all the pending labels of this request, one query per referenced table
+        """
+        pending = list(self._pending())
+        self._pending().clear()
+
+        groups = dict()
+        for entry, value in pending:
+            group = (entry.key.longname, str(entry.label))
+            groups.setdefault(group, (entry, set()))[1].add(value)
+
+        for entry, values in groups.values():
+            fields = {f.longname: f for f in [entry.key] + entry.label_fields}
+            db = entry.fk_table._db
+            for row in db(entry.key.belongs(values)).select(*fields.values()):
+                label = entry.make_label(row)
+                #  negative expiration forces the callback and stores the label
+                self.storage.get(
+                    self._key(entry, row[entry.key.name]), lambda: label, -1
+                )
+
+    def _pending(self):
+        #  kept in the py4web request context, which is reset when a request starts: the values of
+        #  a form built but never rendered do not pile up in the thread
+        context = getattr(Fixture.__request_master_ctx__, "request_ctx", None)
+        if context is None:
+            #  not in a request: a job or a script
+            if not hasattr(self.local, "pending"):
+                self.local.pending = []
+            return self.local.pending
+        return context.setdefault(self, [])
+
+    def _key(self, entry, value):
+        (version,) = self.versions.recent(entry.fk_table)
+        return "label:%s:%s:%s:%s" % (
+            entry.key.longname,
+            hash(str(entry.label)),
+            version,
+            value,
+        )
+
+
+class OptionSets:
+    """
+    Small reference tables sent whole to the browser, which filters them locally
+
+    The options of a table are served as JSON from a URL carrying the table version, so the
+    browser can keep them for as long as it likes: a write moves the version and the next form
+    points to a new URL.  The server side copy is kept in storage, keyed by the same version, and
+    also gives the label of the current value of a widget without a query.
+
+    storage can be the py4web Cache or any object with the same get(key, callback, expiration)
+    signature.
+    """
+
+    def __init__(self, storage, versions, expiration=3600):
+        self.storage = storage
+        self.versions = versions
+        self.expiration = expiration
+        self.tables = dict()
+
+    def register(self, table, label="%(name)s", orderby=None):
+        """
+        Allow a table to be sent to the browser
+
+        Parameters
+        ----------
+        table: the pydal table, it must be watched by versions
+        label: IS_IN_DB style label, a format string or a callable receiving the row
+        orderby: the order of the options, default the label fields
+        """
+        fields = label_fields(table, label)
+        self.tables[table._tablename] = dict(
+            table=table,
+            label=label,
+            fields=[table.id] + [f for f in fields if f.name != "id"],
+            orderby=orderby or fields or table.id,
+        )
+
+    def get(self, tablename):
+        return self.tables.get(tablename)
+
+    def version(self, tablename):
+        (version,) = self.versions.recent(tablename)
+        return version
+
+    def options(self, tablename, version=None):
+        """
+        Get the options of a registered table
+
+        Parameters
+        ----------
+        tablename: the name of the registered table
+        version: the table version to load, default the recent one (see TableVersions.recent)
+
+        Returns
+        -------
+        list of (id, label), in the order of the option set
+        """
+        return self._load(tablename, version)[0]
+
+    def label(self, tablename, value):
+        """
+        Get the label of one option, None if there is no such row
+        """
+        try:
+            return self._load(tablename)[1].get(int(value))
+        except (TypeError, ValueError):
+            return None
+
+    def _load(self, tablename, version=None):
+        option_set = self.tables[tablename]
+
+        def select():
+            table = option_set["table"]
+            label = option_set["label"]
+            options = [
+                (row.id, label(row) if callable(label) else label % row)
+                for row in table._db(table.id > 0).select(
+                    *option_set["fields"], orderby=option_set["orderby"]
+                )
+            ]
+            return options, dict(options)
+
+        return self.storage.get(
+            "options:%s:%s"
+            % (tablename, self.version(tablename) if version is None else version),
+            select,
+            self.expiration,
+        )
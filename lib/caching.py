@@ -0,0 +1,360 @@
+import hashlib
+import threading
+import time
+
+from py4web import request, response, Field, HTTP
+from py4web.core import Fixture
+
+
+class TableVersions:
+    """
+    Keep a write counter per table in the database.
+
+    The counters are bumped from the after insert/update/delete callbacks of
+    the watched tables, in the same transaction as the write itself, so every
+    process sees the same version and a rolled back write does not bump it.
+    Anything derived from a table (rendered fragments, option lists, ...) can
+    be stamped with the version it was built from and thrown away as soon as
+    the version moves.
+
+    The names are not checked against the tables: bump() and version() take
+    any name, for versions kept by their own hooks.  UsedReferences keeps one
+    per watched reference field, named table.field, which no table name can
+    clash with.
+    """
+
+    def __init__(self, db, tablename="table_version"):
+        self.db = db
+        self.table = db.define_table(
+            tablename,
+            Field("tablename", length=64, unique=True),
+            Field("version", "integer", default=0),
+        )
+        self.watched = set()
+        self.recent_versions = dict()
+
+    def watch(self, *tables):
+        """
+        Add the callbacks that bump the version of each table on every write
+
+        Parameters
+        ----------
+        tables: the pydal tables to watch
+        """
+        for table in tables:
+            tablename = table._tablename
+            if tablename in self.watched:
+                continue
+            self.watched.add(tablename)
+
+            table._after_insert.append(lambda f, i, t=tablename: self.bump(t))
+            table._after_update.append(lambda s, f, t=tablename: self.bump(t))
+            table._after_delete.append(lambda s, t=tablename: self.bump(t))
+
+    def bump(self, tablename):
+        tv = self.table
+        if not self.db(tv.tablename == tablename).update(version=tv.version + 1):
+            tv.insert(tablename=tablename, version=1)
+        self.recent_versions.pop(tablename, None)
+
+    def version(self, *tablenames):
+        """
+        Get the current version of the tables in a single query
+
+        Parameters
+        ----------
+        tablenames: table names or pydal tables
+
+        Returns
+        -------
+        a tuple with the version of each table, in the order requested
+        """
+        names = [getattr(t, "_tablename", t) for t in tablenames]
+        tv = self.table
+        versions = {
+            row.tablename: row.version
+            for row in self.db(tv.tablename.belongs(names)).select(
+                tv.tablename, tv.version
+            )
+        }
+        return tuple(versions.get(name, 0) for name in names)
+
+    def recent(self, *tablenames, max_age=5):
+        """
+        Get the version of the tables from memory, for lookups too cheap to pay a query
+
+        The versions are read from the database at most every max_age seconds, and again right
+        after a write made by this process, so only writes from other processes can go unnoticed
+        for up to max_age seconds.
+
+        Parameters
+        ----------
+        tablenames: table names or pydal tables
+        max_age: seconds a version read from the database is trusted
+
+        Returns
+        -------
+        a tuple with the version of each table, in the order requested
+        """
+        now = time.time()
+        names = [getattr(t, "_tablename", t) for t in tablenames]
+        stale = [
+            name
+            for name in names
+            if now - self.recent_versions.get(name, (0, 0))[1] > max_age
+        ]
+        if stale:
+            for name, version in zip(stale, self.version(*stale)):
+                self.recent_versions[name] = (version, now)
+        return tuple(self.recent_versions[name][0] for name in names)
+
+
+class RowCounts:
+    """
+    Row count of tables, cached until the table is written
+
+    storage can be the py4web Cache or any object with the same get(key, callback, expiration)
+    signature.
+    """
+
+    def __init__(self, storage, versions, expiration=3600):
+        self.storage = storage
+        self.versions = versions
+        self.expiration = expiration
+
+    def count(self, table):
+        """
+        Get the number of rows of a table, at most one count query per table version
+
+        Parameters
+        ----------
+        table: the pydal table, it must be watched by versions
+
+        Returns
+        -------
+        the number of rows
+        """
+        (version,) = self.versions.recent(table)
+        return self.storage.get(
+            "count:%s:%s" % (table._tablename, version),
+            lambda: table._db(table.id > 0).count(),
+            self.expiration,
+        )
+
+
+class SingleFlight:
+    """
+    Run a callable once for concurrent callers asking for the same key
+
+    The first caller runs it, the others wait and get the same result (or exception).
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict()
+
+    def do(self, key, callback):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = callback()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+class ResultCache:
+    """
+    Cache the result of a lookup until one of the tables it reads is written
+
+    Entries are keyed by the caller's key and the recent versions of the tables (see
+    TableVersions.recent), so a write throws away every result built from the table.  Concurrent
+    misses for the same key run the lookup once.
+
+    storage can be the py4web Cache - LRU with a fixed size - or any object with the same
+    get(key, callback, expiration) signature.
+    """
+
+    def __init__(self, storage, versions, expiration=300, max_age=5):
+        self.storage = storage
+        self.versions = versions
+        self.expiration = expiration
+        self.max_age = max_age
+        self.flights = SingleFlight()
+
+    def get(self, key, tables, callback):
+        """
+        Get the cached result, or compute it
+
+        Parameters
+        ----------
+        key: anything with a stable repr() identifying the lookup
+        tables: the tables the lookup reads from
+        callback: computes the result on a miss
+
+        Returns
+        -------
+        the result of callback
+        """
+        parts = (key, self.versions.recent(*tables, max_age=self.max_age))
+        digest = hashlib.sha1(repr(parts).encode("utf8")).hexdigest()
+        return self.storage.get(
+            "result:%s" % digest,
+            lambda: self.flights.do(digest, callback),
+            self.expiration,
+        )
+
+
+class FragmentCache(Fixture):
+    """
+    Cache the rendered output of an htmx grid action.
+
+    Add the fixture to action.uses() BEFORE the template so that its
+    on_success runs after the template has been rendered, then call lookup()
+    at the top of the action:
+
+        @action.uses(grid_cache, "htmx/grid.html", session, db, auth.user)
+        def shippers(path=None):
+            html = grid_cache.lookup("shippers", path, [db.shipper])
+            if html:
+                return html
+            ...
+
+    Entries are keyed by the action, the scheme and host of the request (the
+    fragments hold absolute URLs), the normalised query string, the page, the
+    sort order, the permissions of the user and the versions of the tables the
+    grid reads from, so a write to any of those tables invalidates the
+    fragments built from it.  Only GET requests listing rows are cached.
+    The ETag of the response is left to the action, see conditional_get.
+
+    storage can be the py4web Cache or any object with the same
+    get(key, callback, expiration) signature.  vary lists the request headers
+    that change the rendered output.
+    """
+
+    def __init__(self, storage, versions, expiration=3600, permissions=None, vary=None):
+        self.storage = storage
+        self.versions = versions
+        self.expiration = expiration
+        self.permissions = permissions
+        self.vary = vary or []
+
+    def on_request(self, context):
+        self._safe_local = dict(key=None)
+
+    def on_success(self, context):
+        key = self._safe_local.get("key")
+        output = context.get("output")
+        if key and isinstance(output, str):
+            self._store(key, output)
+
+    def lookup(self, name, path, tables):
+        """
+        Get the rendered fragment for this request
+
+        Parameters
+        ----------
+        name: name of the action, used as part of the key
+        path: the path var of the grid action - only the row listing is cached
+        tables: the tables the grid reads from
+
+        Returns
+        -------
+        the cached html or None - on None the output of the action is stored when the request succeeds
+        """
+        if request.method != "GET" or (path and path.split("/")[0] != "select"):
+            return None
+
+        key = self.make_key(name, tables)
+        if self.vary:
+            response.headers["Vary"] = ", ".join(self.vary)
+
+        html = self.storage.get(key, lambda: None, self.expiration)
+        if html is None:
+            self._safe_local["key"] = key
+        return html
+
+    def make_key(self, name, tables):
+        params = sorted(
+            (k, str(v))
+            for k, v in request.query.items()
+            if k not in ("page", "orderby")
+        )
+        parts = (
+            name,
+            request.urlparts.scheme,
+            request.urlparts.netloc,
+            tuple(params),
+            request.query.get("page", "1"),
+            request.query.get("orderby", ""),
+            tuple(request.headers.get(header, "") for header in self.vary),
+            tuple(sorted(self.permissions())) if self.permissions else (),
+            self.versions.version(*tables),
+        )
+        return "fragment:%s:%s" % (
+            name,
+            hashlib.sha1(repr(parts).encode("utf8")).hexdigest(),
+        )
+
+    def _store(self, key, value):
+        #  the storage only has a get-or-compute interface, a negative
+        #  expiration forces the callback and refreshes the stored value
+        self.storage.get(key, lambda: value, -1)
+
+
+def conditional_get(*parts):
+    """
+    Tag the response with a strong ETag and answer 304 if the client already has it
+
+    Call it at the top of a GET action, before anything is rendered, with
+    everything the response depends on - typically the record id, the user
+    and the versions of the tables read.  The request path and query string
+    are always part of the tag.  The response is marked private/no-cache so the browser
+    keeps it but revalidates every time, which htmx requests get for free.
+
+    Parameters
+    ----------
+    parts: values the response depends on, they must have a stable repr()
+
+    Returns
+    -------
+    the ETag, or None for non GET requests
+    """
+    if request.method != "GET":
+        return None
+
+    etag = (
+        '"%s"'
+        % hashlib.sha1(
+            repr((request.fullpath, request.query_string, parts)).encode("utf8")
+        ).hexdigest()
+    )
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        raise HTTP(304)
+
+    return etag
@@ -0,0 +1,117 @@
+import csv
+import datetime
+import html
+import io
+import json
+import re
+from decimal import Decimal
+
+from py4web import response
+
+from .grid_helpers import column_label, column_value, column_fields, _prefetch
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+
+#  rows are handed to PrefetchColumns in batches of this size
+EXPORT_BATCH_SIZE = 1000
+
+TAG_RE = re.compile(r"<[^>]+>")
+BR_RE = re.compile(r"<br\s*/?>", re.IGNORECASE)
+
+
+def as_text(value):
+    """
+    Turn the output of a represent function into plain text for an export
+
+    yatl helpers and XML are rendered and stripped of their tags, <br /> becomes a newline.
+    """
+    if value is None:
+        return ""
+    if hasattr(value, "xml"):
+        value = value.xml()
+        if isinstance(value, bytes):
+            value = value.decode("utf8")
+        return html.unescape(TAG_RE.sub("", BR_RE.sub("\n", value))).strip()
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def stream_export(db, fmt, filename, query, columns, left=None, orderby=None):
+    """
+    Stream the rows of a grid query as CSV or NDJSON
+
+    The rows are read with iterselect and written out one at a time, so the export runs in
+    constant memory and the first bytes go out as soon as the database returns the first row.
+    The DAL fixture gives its connection back when the action returns, before the body is sent,
+    so the generator takes its own connection and releases it when done.
+
+    Parameters
+    ----------
+    db: the DAL
+    fmt: csv or ndjson
+    filename: name of the download, without extension
+    query: the grid query
+    columns: the grid columns - pydal Fields or Columns, the represent functions give the values
+    left: the grid left joins
+    orderby: the order of the rows, prefer an indexed column so the database doesn't sort first
+
+    Returns
+    -------
+    a generator to return from the action
+    """
+    response.headers["Content-Type"] = EXPORT_FORMATS[fmt]
+    response.headers["Content-Disposition"] = 'attachment; filename="%s.%s"' % (
+        filename,
+        fmt,
+    )
+    response.headers["Cache-Control"] = "no-store"
+
+    labels = [column_label(column) for column in columns]
+    fields = column_fields(columns)
+
+    def lines():
+        db.get_connection_from_pool_or_new()
+        try:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            if fmt == "csv":
+                writer.writerow(labels)
+                yield flush(buffer)
+
+            batch = []
+            rows = db(query).iterselect(*fields, left=left, orderby=orderby)
+            for row in rows:
+                batch.append(row)
+                if len(batch) < EXPORT_BATCH_SIZE:
+                    continue
+                yield write_batch(batch, writer, buffer)
+                batch = []
+            if batch:
+                yield write_batch(batch, writer, buffer)
+        finally:
+            db.recycle_connection_in_pool_or_close("rollback")
+
+    def write_batch(batch, writer, buffer):
+        _prefetch(columns, batch)
+        for row in batch:
+            values = [as_text(column_value(column, row)) for column in columns]
+            if fmt == "csv":
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(labels, values)), default=str))
+                buffer.write("\n")
+        return flush(buffer)
+
+    def flush(buffer):
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data.encode("utf8")
+
+    return lines()
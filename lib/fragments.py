@@ -0,0 +1,33 @@
+from yatl import DIV, XML
+
+from py4web.core import Template
+
+
+def render_template(filename, output):
+    """
+    Render a template the way the action fixture would, for actions returning several fragments
+
+    Parameters
+    ----------
+    filename: the template, relative to the templates folder of the app
+    output: the dict an action would return to the template
+
+    Returns
+    -------
+    the rendered html
+    """
+    context = dict(output=output)
+    Template(filename).on_success(context)
+    return context["output"]
+
+
+def oob_fragment(target, html):
+    """
+    Wrap html in an element replacing target with an htmx out-of-band swap
+
+    Parameters
+    ----------
+    target: the id of the element replaced, with or without the leading #
+    html: the rendered content
+    """
+    return DIV(XML(html), _id=target.lstrip("#"), **{"_hx-swap-oob": "true"}).xml()
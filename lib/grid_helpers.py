@@ -1,16 +1,46 @@
 import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
 from dataclasses import asdict
 from functools import reduce
 from urllib.parse import unquote_plus
 
-from yatl import TAG
+from yatl import TAG, CAT, TABLE, THEAD, TBODY, TR, TH, TD, DIV, IMG, A
 
-from py4web import request, Field, response
+from pydal.validators import IS_IN_SET, IS_NULL_OR
+
+from py4web import request, Field, response, URL
 from py4web.utils.form import Form, FormStyleBulma
-from py4web.utils.grid import AttributesPluginHtmx
+from py4web.utils.grid import (
+    AttributesPluginHtmx,
+    Column,
+    Grid,
+    GridClassStyleBulma,
+)
+
+from .autocomplete import label_fields
+from .table_views import DALView
 
 BUTTON = TAG.button
 
+#  htmx request header asking a grid to return only its rows and pager
+GRID_ROWS_HEADER = "X-Grid-Rows"
+
+
+#  query string parameter carrying the cursor token of an infinite scroll chunk request
+SCROLL_CURSOR_PARAM = "cursor"
+
+
+def is_rows_request():
+    return request.headers.get(GRID_ROWS_HEADER) == "true"
+
+
+def is_scroll_request():
+    return SCROLL_CURSOR_PARAM in request.query
+
 
 class GridSearchQuery:
     def __init__(self, name, query, requires=None, datatype="str", default=None):
@@ -25,11 +55,20 @@ class GridSearchQuery:
 
 class GridSearch:
     def __init__(
-        self, search_queries, queries=None, target_element=None, formname="search_form"
+        self,
+        search_queries,
+        queries=None,
+        target_element=None,
+        formname="search_form",
+        build_form=None,
     ):
         self.search_queries = search_queries
         self.queries = queries
 
+        #  rows-only htmx requests re-use the search values from the query string but never show the form
+        if build_form is None:
+            build_form = not is_rows_request()
+
         field_names = []
         field_requires = dict()
         field_datatype = dict()
@@ -62,6 +101,56 @@ class GridSearch:
 
                 field_values[field] = unquote_plus(value)
 
+        self.search_form = None
+        if build_form:
+            self.search_form = self._make_search_form(
+                field_names,
+                field_requires,
+                field_datatype,
+                field_default,
+                field_values,
+                target_element,
+                formname,
+            )
+
+        if self.search_form and self.search_form.accepted:
+            for field in field_names:
+                if (
+                    field in field_datatype
+                    and field_datatype[field].lower() == "boolean"
+                ):
+                    if field in self.search_form.vars:
+                        field_values[field] = self.search_form.vars[field]
+                    else:
+                        field_values[field] = False
+                else:
+                    field_values[field] = self.search_form.vars[field]
+
+        if not self.queries:
+            self.queries = []
+
+        #  the search values applied, as query string values (see InfiniteScroll)
+        self.values = dict()
+        for sq in self.search_queries:
+            field_name = "sq_" + sq.name.replace(" ", "_").replace("/", "_").lower()
+            if field_name in field_values and field_values[field_name]:
+                self.queries.append(sq.query(field_values[field_name]))
+                self.values[field_name] = str(field_values[field_name])
+            elif field_name in field_default and field_default[field_name]:
+                self.queries.append(sq.query(field_default[field_name]))
+
+        self.query = reduce(lambda a, b: (a & b), self.queries)
+
+    def _make_search_form(
+        self,
+        field_names,
+        field_requires,
+        field_datatype,
+        field_default,
+        field_values,
+        target_element,
+        formname,
+    ):
         form_fields = []
         for field in field_names:
             label = field.replace("sq_", "").replace("_", " ").title()
@@ -120,7 +209,7 @@ class GridSearch:
         else:
             attrs = {"_method": "GET"}
 
-        self.search_form = Form(
+        return Form(
             form_fields,
             keep_values=True,
             formstyle=FormStyleBulma,
@@ -128,30 +217,105 @@ class GridSearch:
             **attrs,
         )
 
-        if self.search_form.accepted:
-            for field in field_names:
-                if (
-                    field in field_datatype
-                    and field_datatype[field].lower() == "boolean"
-                ):
-                    if field in self.search_form.vars:
-                        field_values[field] = self.search_form.vars[field]
-                    else:
-                        field_values[field] = False
-                else:
-                    field_values[field] = self.search_form.vars[field]
 
-        if not self.queries:
-            self.queries = []
+class UsedReferences:
+    """
+    Cached option lists of the rows a reference field actually points to, for the IS_IN_SET
+    dropdowns of GridSearchQuery filters ("Filter by Customer" only offers customers with orders)
 
-        for sq in self.search_queries:
-            field_name = "sq_" + sq.name.replace(" ", "_").replace("/", "_").lower()
-            if field_name in field_values and field_values[field_name]:
-                self.queries.append(sq.query(field_values[field_name]))
-            elif field_name in field_default and field_default[field_name]:
-                self.queries.append(sq.query(field_default[field_name]))
+    Each list is built with one DISTINCT query and kept in storage, keyed by the version of the
+    list and the version of the referenced table (for the labels).  The version of the list, a
+    TableVersions entry named after the field (table.field), is bumped by write hooks on the
+    table of the field: on every update of the field and every delete, and on inserts only when
+    no other row has the value yet - so adding orders for known customers does not throw the list
+    away.  watch() indexes the field for that check.
 
-        self.query = reduce(lambda a, b: (a & b), self.queries)
+    storage can be the py4web Cache or any object with the same get(key, callback, expiration)
+    signature.
+    """
+
+    def __init__(self, storage, versions, expiration=86400):
+        self.storage = storage
+        self.versions = versions
+        self.expiration = expiration
+        self.fields = dict()
+
+    def watch(self, field, label, orderby=None):
+        """
+        Keep the option list of a reference field
+
+        Parameters
+        ----------
+        field: the reference field
+        label: IS_IN_DB style label of the referenced rows, a format string or a callable
+        orderby: the order of the options, default the label fields
+        """
+        db = field._db
+        fk_table = db[field.type.split()[1]]
+        fields = label_fields(fk_table, label)
+        self.fields[field.longname] = dict(
+            field=field,
+            fk_table=fk_table,
+            label=label,
+            select=[fk_table.id] + [f for f in fields if f.name != "id"],
+            orderby=orderby or fields or fk_table.id,
+        )
+
+        table = field.table
+        try:
+            table.create_index("%s_%s_used" % (table._tablename, field.name), field)
+        except RuntimeError:
+            #  the index is already there
+            pass
+        table._after_insert.append(lambda f, i: self._inserted(field, f, i))
+        table._after_update.append(
+            lambda s, f: self.versions.bump(field.longname) if field.name in f else None
+        )
+        table._after_delete.append(lambda s: self.versions.bump(field.longname))
+
+    def options(self, field):
+        """
+        Get the option list of a watched field
+
+        Returns
+        -------
+        list of (id, label), in the order of the list
+        """
+        entry = self.fields[field.longname]
+        key = self._key(field, self.versions.recent(field.longname, entry["fk_table"]))
+        options = self.storage.get(key, lambda: None, self.expiration)
+        if options is None:
+            options = self._select(entry)
+            #  negative expiration forces the callback and stores the list
+            self.storage.get(key, lambda: options, -1)
+        return options
+
+    def requires(self, field, zero=".."):
+        """
+        Optional IS_IN_SET validator over the option list of a watched field, for GridSearchQuery
+        """
+        return IS_NULL_OR(IS_IN_SET(self.options(field), zero=zero))
+
+    def _select(self, entry):
+        field, fk_table, label = entry["field"], entry["fk_table"], entry["label"]
+        db = field._db
+        rows = db(
+            fk_table.id.belongs(db(field != None)._select(field, distinct=True))
+        ).select(*entry["select"], orderby=entry["orderby"])
+        return [
+            (row.id, label(row) if callable(label) else label % row) for row in rows
+        ]
+
+    def _inserted(self, field, fields, id):
+        value = fields.get(field.name)
+        if value is None:
+            return
+        table = field.table
+        if field._db((field == value) & (table._id != id)).isempty():
+            self.versions.bump(field.longname)
+
+    def _key(self, field, versions):
+        return "used:%s:%s:%s" % (field.longname, *versions)
 
 
 def apply_htmx_attrs(grid, target):
@@ -233,6 +397,501 @@ def enable_htmx_grid(htmx_grid, target, default_referrer, after_swap=None):
             response.headers["HX-Trigger-After-Swap"] = after_swap
 
 
+class AttributesPluginHtmxRows(AttributesPluginHtmx):
+    """
+    htmx attributes for a HtmxGrid
+
+    Pager and sort links send the X-Grid-Rows header and don't swap the target themselves,
+    the rows-only response replaces the table and the footer with out-of-band swaps.
+    """
+
+    def link(self, url):
+        attrs = super().link(url)
+        path = url.split("?")[0].split("/")
+        if not any(action in path for action in ["new", "details", "edit", "delete"]):
+            attrs["_hx-headers"] = json.dumps({GRID_ROWS_HEADER: "true"})
+            attrs["_hx-swap"] = "none"
+        return attrs
+
+
+class HtmxGrid(Grid):
+    """
+    A Grid that answers htmx paging and sorting requests with only its rows
+
+    The table and the footer get ids derived from the htmx target element so that a rows-only
+    request (see AttributesPluginHtmxRows) can return just those two elements with hx-swap-oob,
+    skipping the search form, header buttons and the rest of the template.
+
+    views is a list of table views (see table_view) used instead of their tables by the
+    new/details/edit forms of the grid - the rows are selected from the tables, pydal does not
+    mix the fields of a table and of its view in one select.
+    """
+
+    def __init__(self, path, query, views=None, **kwargs):
+        super().__init__(path, query, **kwargs)
+        if views and self.path.split("/")[0] in ["new", "details", "edit"]:
+            self.db = DALView(self.db, views)
+        self.rows_only = is_rows_request() and self.path.split("/")[0] in [
+            "",
+            "select",
+        ]
+
+    def _make_table(self):
+        html = super()._make_table()
+
+        target = self.attributes_plugin.target_element
+        target = target.lstrip("#") if isinstance(target, str) else "grid"
+        table = html.find("table")[0]
+        table["_id"] = "%s-table" % target
+        footer_class = self.param.grid_class_style.classes.get("grid-footer")
+        footer = html.find(".%s" % footer_class.split()[0])[0]
+        footer["_id"] = "%s-footer" % target
+
+        if self.rows_only:
+            table["_hx-swap-oob"] = "true"
+            footer["_hx-swap-oob"] = "true"
+            return CAT(table, footer)
+
+        return html
+
+
+class GridSpec:
+    """
+    The parts of an HtmxGrid that do not depend on the request, declared once at import
+
+    Fields, joins, order, search queries and grid arguments are built when the controllers are
+    loaded, make() only binds the request to them: the path, the parent record, the search
+    values and the Cancel buttons.
+
+    Parameters
+    ----------
+    url: the URL parts of the action, for the Cancel buttons
+    target: the htmx target element of the grid
+    tables: the tables the grid reads from, for the grid cache
+    fields: the Fields/Columns listed
+    query: the query of the rows, None for all the rows of the parent record
+    parent_field: for child grids, the field pointing to the parent record
+    hidden: for child grids, the fields hidden from the new/details/edit forms
+    search_queries: list of GridSearchQuery, None for no search form
+    sidecars: the forms getting a Cancel button, out of new, details and edit
+    formstyle_factory: callable returning the formstyle of the grid forms, called on every
+        request - the formstyle grid argument, if any, is used otherwise
+    formatters: formatters_by_type added to the ones of the grid
+    grid_args: the other HtmxGrid arguments
+    """
+
+    def __init__(
+        self,
+        url,
+        target,
+        tables,
+        fields,
+        query=None,
+        parent_field=None,
+        hidden=(),
+        search_queries=None,
+        sidecars=("new", "details", "edit"),
+        formstyle_factory=None,
+        formatters=None,
+        **grid_args,
+    ):
+        self.url = url
+        self.target = target
+        self.tables = tables
+        self.fields = fields
+        self.query = query
+        self.parent_field = parent_field
+        self.hidden = hidden
+        self.search_queries = search_queries
+        self.sidecars = sidecars
+        self.formstyle_factory = formstyle_factory
+        self.formatters = formatters or {}
+        self.grid_args = dict(grid_args, auto_process=False)
+        self.prefetch = any(isinstance(f, PrefetchColumn) for f in fields)
+
+    def make(self, path, parent_id=None, embedded=False, views=None):
+        """
+        Build and process the grid for this request
+
+        Parameters
+        ----------
+        path: the path var of the grid action
+        parent_id: for child grids, the id of the parent record
+        views: table views for the forms of the grid, see HtmxGrid
+        embedded: True when the grid is rendered by another action (see fragments in
+            controllers.py), its links then point to its own action instead of the request URL
+
+        Returns
+        -------
+        the processed HtmxGrid
+        """
+        query = self.query
+        cancel_vars = None
+        if self.parent_field is not None:
+            parent_query = self.parent_field == parent_id
+            query = parent_query if query is None else query & parent_query
+            cancel_vars = dict(parent_id=parent_id)
+
+        search_form = None
+        if self.search_queries:
+            search = GridSearch(
+                self.search_queries, [query], target_element=self.target
+            )
+            query, search_form = search.query, search.search_form
+
+        grid_args = dict(self.grid_args)
+        if self.formstyle_factory:
+            grid_args["formstyle"] = self.formstyle_factory()
+
+        grid = HtmxGrid(
+            path,
+            query,
+            fields=list(self.fields),
+            search_form=search_form,
+            views=views,
+            **grid_args,
+        )
+        grid.formatters_by_type.update(self.formatters)
+
+        url = URL(*self.url, vars=cancel_vars)
+        grid.attributes_plugin = AttributesPluginHtmxRows(self.target)
+        attrs = {
+            "_hx-get": url,
+            "_class": "button is-default",
+        }
+        for sidecar in self.sidecars:
+            grid.param["%s_sidecar" % sidecar] = BUTTON("Cancel", **attrs)
+
+        if embedded:
+            #  the sort and page links keep parent_id, not the query of the embedding page
+            grid.endpoint = URL(*self.url)
+            grid.query_parms = dict(cancel_vars or {})
+
+        grid.process()
+        if embedded and grid.action == "select":
+            grid.referrer = "_referrer=%s" % base64.b16encode(
+                url.encode("utf8")
+            ).decode("utf8")
+        if self.prefetch:
+            prefetch_columns(grid)
+
+        return grid
+
+
+class PrefetchColumn(Column):
+    """
+    A Column whose values are loaded for the whole page at once instead of one query per row.
+
+    prefetch receives the list of ids of the rows on the page and returns a dict of id -> value,
+    represent receives the row and its prefetched value.  Columns sharing the same prefetch
+    callable share the query.  Call prefetch_columns(grid) after grid.process().
+    """
+
+    def __init__(
+        self,
+        name,
+        prefetch,
+        represent=None,
+        key=lambda row: row.id,
+        required_fields=None,
+        orderby=None,
+        td_class_style=None,
+    ):
+        super().__init__(
+            name,
+            self.represent_value,
+            required_fields=required_fields,
+            orderby=orderby,
+            td_class_style=td_class_style,
+        )
+        self.prefetch = prefetch
+        self.value_represent = represent or (
+            lambda row, value: value if value is not None else ""
+        )
+        self.key = key
+        self.local = threading.local()
+
+    @property
+    def values(self):
+        #  per thread, so one column can be shared by the grids of concurrent requests
+        return getattr(self.local, "values", {})
+
+    @values.setter
+    def values(self, values):
+        self.local.values = values
+
+    def represent_value(self, row):
+        return self.value_represent(row, self.values.get(self.key(row)))
+
+
+def prefetch_columns(grid):
+    """
+    Load the values of all the PrefetchColumns of the grid for the current page
+
+    Parameters
+    ----------
+    grid: the grid, after process() has been called
+    """
+    if grid.action != "select" or not grid.rows:
+        return
+
+    _prefetch(grid.param.columns, grid.rows)
+
+
+def _prefetch(columns, rows):
+    prefetched = dict()
+    for column in columns:
+        if isinstance(column, PrefetchColumn):
+            ids = list(dict.fromkeys(column.key(row) for row in rows))
+            cache_key = (column.prefetch, tuple(ids))
+            if cache_key not in prefetched:
+                prefetched[cache_key] = column.prefetch(ids)
+            column.values = prefetched[cache_key]
+
+
+def column_label(column):
+    return column.name if isinstance(column, Column) else column.label
+
+
+def column_value(column, row):
+    """
+    Value of a listing column for a row - the Column represent or the field value with its represent
+    """
+    if isinstance(column, Column):
+        return column.render(row)
+
+    value = row[column]
+    return column.represent(value) if column.represent else value
+
+
+def column_fields(columns, *extra):
+    """
+    The fields to select for a list of Fields/Columns, without duplicates
+
+    Parameters
+    ----------
+    columns: list of pydal Fields or Columns
+    extra: fields that must be selected as well, they come first
+
+    Returns
+    -------
+    list of pydal Fields
+    """
+    fields = list(extra)
+    for column in columns:
+        for field in column.required_fields if isinstance(column, Column) else [column]:
+            if field.longname not in [f.longname for f in fields]:
+                fields.append(field)
+    return fields
+
+
+class ScrollCursors:
+    """
+    Signed cursor tokens of the infinite scroll listings
+
+    A token carries the key of the last row sent, the search values of the listing and the user,
+    signed with secret: any process can serve the next chunk, nothing is kept server side.  The
+    query is rebuilt from the search values of the request, which must match the signed ones.
+    Fetching the next chunk is a keyset select on an indexed key - no count and no offset - so it
+    costs the same a million rows down as on the first chunk.
+
+    A token is valid for expiration seconds, a chunk request with a tampered or expired token
+    answers with a row asking the user to reload the listing.
+    """
+
+    def __init__(self, secret, expiration=900):
+        self.secret = secret.encode("utf8")
+        self.expiration = expiration
+
+    def dumps(self, state):
+        """
+        The token of a cursor state, a JSON serialisable dict
+        """
+        payload = base64.urlsafe_b64encode(
+            json.dumps(
+                dict(state, expires=int(time.time()) + self.expiration),
+                separators=(",", ":"),
+            ).encode("utf8")
+        )
+        return "%s.%s" % (payload.decode("ascii"), self._sign(payload))
+
+    def loads(self, token):
+        """
+        The cursor state of a token, None if the token is invalid or expired
+        """
+        payload, _, signature = (token or "").encode("ascii", "ignore").partition(b".")
+        if not hmac.compare_digest(self._sign(payload), signature.decode("ascii")):
+            return None
+        try:
+            state = json.loads(base64.urlsafe_b64decode(payload))
+        except ValueError:
+            return None
+        return state if state.get("expires", 0) >= time.time() else None
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).hexdigest()
+
+
+class InfiniteScroll:
+    """
+    A listing that appends keyset paginated chunks of rows to the same table as the user scrolls
+
+    The last row of every chunk is a sentinel with an htmx revealed trigger that fetches the next
+    chunk through a ScrollCursors token and replaces itself with it.  The tbody carries
+    data-scroll-window so that static/js/scroll.js drops the rows scrolled past once there are
+    more than max_rows of them in the DOM.
+
+    columns are pydal Fields or Columns (PrefetchColumns are loaded per chunk), key is the unique
+    indexed field the listing is ordered by, search the values of the GridSearch the query is
+    built with (GridSearch.values) - chunk requests carry them in their query string.  Call
+    render_chunk() instead of rendering the page when is_scroll_request() is true.
+    """
+
+    def __init__(
+        self,
+        cursors,
+        query,
+        columns,
+        key,
+        left=None,
+        descending=True,
+        chunk_size=50,
+        max_rows=500,
+        search=None,
+        user_id=None,
+        endpoint=None,
+        grid_class_style=GridClassStyleBulma,
+    ):
+        self.cursors = cursors
+        self.query = query
+        self.columns = columns
+        self.key = key
+        self.left = left
+        self.descending = descending
+        self.chunk_size = chunk_size
+        self.max_rows = max_rows
+        self.search = search or dict()
+        self.user_id = user_id
+        self.endpoint = endpoint or request.fullpath
+        self.grid_class_style = grid_class_style
+
+        self.fields = column_fields(columns, key)
+
+    def render(self):
+        """
+        Render the table with the header and the first chunk of rows
+        """
+        header = TR(
+            *[
+                TH(column_label(column), **self.grid_class_style.get("grid-th"))
+                for column in self.columns
+            ]
+        )
+        return DIV(
+            TABLE(
+                THEAD(header, **self.grid_class_style.get("grid-thead")),
+                TBODY(
+                    *self._make_chunk(
+                        dict(last=None, search=self.search, user_id=self.user_id)
+                    ),
+                    **{"_data-scroll-window": self.max_rows},
+                ),
+                **self.grid_class_style.get("grid-table"),
+            ),
+            **self.grid_class_style.get("grid-table-wrapper"),
+        )
+
+    def render_chunk(self):
+        """
+        Render the next chunk of rows for the cursor in the query string
+
+        Returns
+        -------
+        the html of the rows, followed by the sentinel row if there are more
+        """
+        state = self.cursors.loads(request.query.get(SCROLL_CURSOR_PARAM))
+        return CAT(*self._make_chunk(state)).xml()
+
+    def _make_chunk(self, state):
+        if (
+            not state
+            or state["user_id"] != self.user_id
+            or state["search"] != self.search
+        ):
+            return [
+                TR(
+                    TD(
+                        A(
+                            "This listing has expired, reload it",
+                            _href=URL(self.endpoint),
+                        ),
+                        _colspan=len(self.columns),
+                    )
+                )
+            ]
+
+        query = self.query
+        if state["last"] is not None:
+            query &= (
+                (self.key < state["last"])
+                if self.descending
+                else (self.key > state["last"])
+            )
+        rows = self.key.table._db(query).select(
+            *self.fields,
+            left=self.left,
+            orderby=~self.key if self.descending else self.key,
+            limitby=(0, self.chunk_size + 1),
+        )
+
+        more = len(rows) > self.chunk_size
+        rows = rows[: self.chunk_size]
+        _prefetch(self.columns, rows)
+
+        trs = [self._make_row(row) for row in rows]
+        if more:
+            token = self.cursors.dumps(dict(state, last=rows.last()[self.key]))
+            trs.append(
+                TR(
+                    TD(
+                        IMG(
+                            _class="htmx-indicator",
+                            _src=URL("static", "images/spinner.gif"),
+                            _height="20",
+                        ),
+                        _colspan=len(self.columns),
+                    ),
+                    _class="scroll-sentinel",
+                    **{
+                        "_hx-get": URL(
+                            self.endpoint,
+                            vars=dict(self.search, **{SCROLL_CURSOR_PARAM: token}),
+                        ),
+                        "_hx-trigger": "revealed",
+                        "_hx-swap": "outerHTML",
+                    },
+                )
+            )
+        return trs
+
+    def _make_row(self, row):
+        tr = TR(_class="scroll-row")
+        for column in self.columns:
+            if isinstance(column, Column):
+                td_class = self.grid_class_style.classes.get(
+                    column.td_class_style,
+                    self.grid_class_style.classes.get("grid-td"),
+                )
+            else:
+                td_class = "%s grid-cell-type-%s" % (
+                    self.grid_class_style.classes.get("grid-td"),
+                    str(column.type).split(":")[0].split("(")[0],
+                )
+            value = column_value(column, row)
+            tr.append(TD(value if value is not None else "", _class=td_class))
+        return tr
+
+
 class DataclassGridFilter:
     def __init__(self, column_name, operator, value):
         self.column_name = column_name
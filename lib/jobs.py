@@ -0,0 +1,476 @@
+import datetime
+import functools
+import os
+import queue
+import socket
+import threading
+import time
+import traceback
+from types import SimpleNamespace
+
+from py4web import Field
+
+
+class JobRuns:
+    """
+    History and locks of the background jobs, kept in the database so every process sees them
+
+    A job is a function decorated with job(): each call takes the lock of the job, runs the
+    function in its own transaction and records the run (start, duration, status, error).  A call
+    finding the lock taken by another worker does not run the function, so two workers never
+    rebuild the same artefact at once.  A lock is released when the run ends, or expires after
+    ttl seconds if the worker died.
+    """
+
+    def __init__(
+        self, db, tablename="job_run", lock_tablename="job_lock", keep_days=30
+    ):
+        self.db = db
+        self.keep_days = keep_days
+        self.table = db.define_table(
+            tablename,
+            Field("name", length=128),
+            Field("started", "datetime"),
+            Field("duration", "double"),
+            Field("status", length=16),
+            Field("worker", length=128),
+            Field("error", "text"),
+        )
+        self.locks = db.define_table(
+            lock_tablename,
+            Field("name", length=128, unique=True),
+            Field("owner", length=128),
+            Field("expires", "datetime"),
+        )
+
+    def job(self, func=None, name=None, ttl=3600, local=False):
+        """
+        Decorator running a function as a job, usable under @scheduler.task
+
+        Parameters
+        ----------
+        func: the function
+        name: name of the job in the history and the locks, defaults to the function name
+        ttl: seconds after which the lock of a crashed run expires
+        local: the job refreshes data kept in the memory of the process (indexes, caches), every
+               process runs it and the lock only keeps one process from running it twice
+
+        Returns
+        -------
+        the wrapped function, it returns the result of the function or None when it did not run
+        """
+
+        def decorator(func):
+            job_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if local:
+                    lock_name = "%s:%s:%s" % (
+                        job_name,
+                        socket.gethostname(),
+                        os.getpid(),
+                    )
+                    return self.run(lock_name, func, args, kwargs, ttl)
+                return self.run(job_name, func, args, kwargs, ttl)
+
+            wrapper.job_name = job_name
+            return wrapper
+
+        return decorator(func) if func else decorator
+
+    def run(self, name, func, args=(), kwargs=None, ttl=3600):
+        """
+        Run func under the lock of the job name and record the run, see job()
+        """
+        db = self.db
+        owner = "%s:%s:%s" % (socket.gethostname(), os.getpid(), threading.get_ident())
+        started = datetime.datetime.utcnow()
+        start = time.time()
+
+        if not self.acquire(name, owner, ttl):
+            self._record(name, started, 0, "skipped", owner)
+            return None
+
+        try:
+            result = func(*args, **(kwargs or {}))
+            db.commit()
+        except Exception:
+            db.rollback()
+            self._record(
+                name,
+                started,
+                time.time() - start,
+                "failed",
+                owner,
+                traceback.format_exc(),
+            )
+            raise
+        finally:
+            self.release(name, owner)
+
+        self._record(name, started, time.time() - start, "done", owner)
+        return result
+
+    def acquire(self, name, owner, ttl):
+        """
+        Take the lock of a job, committed at once so the other workers see it
+
+        Returns
+        -------
+        True if the lock was taken
+        """
+        db, locks = self.db, self.locks
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=ttl)
+        try:
+            taken = db((locks.name == name) & (locks.expires < now)).update(
+                owner=owner, expires=expires
+            ) or locks.insert(name=name, owner=owner, expires=expires)
+            db.commit()
+            return bool(taken)
+        except Exception:
+            #  unique name: another worker inserted the lock first
+            db.rollback()
+            return False
+
+    def release(self, name, owner):
+        db, locks = self.db, self.locks
+        db((locks.name == name) & (locks.owner == owner)).delete()
+        db.commit()
+
+    def history(self, name=None, limit=50):
+        """
+        The last runs, of one job or of all of them, most recent first
+        """
+        query = self.table.name == name if name else self.table.id > 0
+        return self.db(query).select(orderby=~self.table.id, limitby=(0, limit))
+
+    def _record(self, name, started, duration, status, worker, error=None):
+        table = self.table
+        table.insert(
+            name=name,
+            started=started,
+            duration=round(duration, 3),
+            status=status,
+            worker=worker,
+            error=error,
+        )
+        self.db(
+            table.started < started - datetime.timedelta(days=self.keep_days)
+        ).delete()
+        self.db.commit()
+
+
+class ThreadScheduler:
+    """
+    The subset of the Celery API tasks.py uses, run by a thread of the web process
+
+    For deployments without a broker: @scheduler.task registers a task, task.delay(...) queues a
+    call and scheduler.conf.beat_schedule = {entry: dict(task=name, schedule=seconds, args=())}
+    runs tasks periodically, once start() was called.  The tasks run one at a time, in the
+    scheduler thread.  Every process running the app runs its own scheduler, jobs use
+    JobRuns locks so only one of them does the work.
+
+    Parameters
+    ----------
+    main: prefix of the task names, as the Celery main name ("apps.<app>.tasks")
+    logger: where failed tasks are logged
+    tick: seconds between two checks of the schedule
+    """
+
+    #  one running scheduler per main name, the previous one stops when the app is reloaded
+    running = dict()
+
+    def __init__(self, main, logger=None, tick=1.0):
+        self.main = main
+        self.logger = logger
+        self.tick = tick
+        self.tasks = dict()
+        self.conf = SimpleNamespace(beat_schedule=dict())
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def task(self, func=None, name=None, **options):
+        """
+        Register a task, as @scheduler.task or @scheduler.task(name=...)
+        """
+
+        def decorator(func):
+            task_name = name or "%s.%s" % (func.__module__, func.__name__)
+            self.tasks[task_name] = func
+            func.name = task_name
+            func.delay = lambda *args, **kwargs: self.send_task(task_name, args, kwargs)
+            func.apply_async = lambda args=(), kwargs=None, **o: self.send_task(
+                task_name, args, kwargs
+            )
+            return func
+
+        return decorator(func) if func else decorator
+
+    def send_task(self, name, args=(), kwargs=None, **options):
+        """
+        Queue a call of a task by name
+        """
+        if name not in self.tasks:
+            raise KeyError("unknown task %s" % name)
+        self.queue.put((name, tuple(args), kwargs or {}))
+
+    def start(self):
+        previous = self.running.get(self.main)
+        if previous:
+            previous.stop()
+        self.running[self.main] = self
+        self.thread = threading.Thread(
+            target=self._loop, name="scheduler:%s" % self.main, daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _loop(self):
+        due = dict()
+        while not self.stopped.is_set():
+            now = time.time()
+            for entry, spec in list(self.conf.beat_schedule.items()):
+                schedule = spec["schedule"]
+                if isinstance(schedule, datetime.timedelta):
+                    schedule = schedule.total_seconds()
+                due.setdefault(entry, now + schedule)
+                if now >= due[entry]:
+                    due[entry] = now + schedule
+                    self.queue.put(
+                        (spec["task"], spec.get("args", ()), spec.get("kwargs", {}))
+                    )
+            try:
+                task_name, args, kwargs = self.queue.get(timeout=self.tick)
+            except queue.Empty:
+                continue
+            self._run(task_name, args, kwargs)
+
+    def _run(self, task_name, args, kwargs):
+        try:
+            self.tasks[task_name](*args, **kwargs)
+        except Exception:
+            if self.logger:
+                self.logger.exception("task %s failed", task_name)
+
+
+class JobQueue:
+    """
+    Durable job queue stored in the database, for work too long for a request handler
+
+    Tasks are registered with @job_queue.task and queued with task.delay(...), which returns
+    the id of the job.  The job is written in the transaction of the request, so it only exists
+    once the request committed.  Worker processes (work()) claim the jobs one at a time: a claimed
+    job is invisible to the other workers for visibility_timeout seconds, after which a worker
+    that died is assumed and the job is claimed again.  A failed job is retried after
+    retry_delay, doubled at each attempt, until it used its attempts.  The result (JSON) or the
+    error of the last attempt is kept with the job.
+
+    A task running longer than its visibility timeout can run twice, tasks must be idempotent or
+    use a generous timeout.
+    """
+
+    QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+    def __init__(self, db, tablename="job_queue", logger=None):
+        self.db = db
+        self.logger = logger
+        self.tasks = dict()
+        self.options = dict()
+        self.table = db.define_table(
+            tablename,
+            Field("task", length=128),
+            Field("args", "json"),
+            Field("kwargs", "json"),
+            Field("status", length=16, default=self.QUEUED),
+            Field("attempts", "integer", default=0),
+            Field("max_attempts", "integer", default=3),
+            Field("retry_delay", "integer", default=10),
+            Field("visibility_timeout", "integer", default=300),
+            Field("available_at", "datetime"),
+            Field("worker", length=128),
+            Field("user_id", "integer"),
+            Field("result", "json"),
+            Field("error", "text"),
+            Field("created", "datetime"),
+            Field("started", "datetime"),
+            Field("finished", "datetime"),
+        )
+
+    def task(
+        self, func=None, name=None, retries=2, retry_delay=10, visibility_timeout=300
+    ):
+        """
+        Register a task, as @job_queue.task or @job_queue.task(retries=..., ...)
+
+        Parameters
+        ----------
+        func: the function, its arguments and result must be JSON serialisable
+        name: name of the task, defaults to module.function like celery
+        retries: attempts after the first one
+        retry_delay: seconds before the first retry, doubled at each retry
+        visibility_timeout: seconds a claimed job is hidden from the other workers
+        """
+
+        def decorator(func):
+            task_name = name or "%s.%s" % (func.__module__, func.__name__)
+            self.tasks[task_name] = func
+            self.options[task_name] = dict(
+                max_attempts=retries + 1,
+                retry_delay=retry_delay,
+                visibility_timeout=visibility_timeout,
+            )
+            func.name = task_name
+            func.delay = lambda *args, **kwargs: self.enqueue(task_name, args, kwargs)
+            return func
+
+        return decorator(func) if func else decorator
+
+    def enqueue(self, task, args=(), kwargs=None, user_id=None):
+        """
+        Queue a call of a registered task, in the current transaction
+
+        Parameters
+        ----------
+        task: name of the task
+        args: positional arguments of the call
+        kwargs: keyword arguments of the call
+        user_id: the user allowed to see the status of the job
+
+        Returns
+        -------
+        the id of the job
+        """
+        if task not in self.tasks:
+            raise KeyError("unknown task %s" % task)
+        now = datetime.datetime.utcnow()
+        return self.table.insert(
+            task=task,
+            args=list(args),
+            kwargs=kwargs or {},
+            user_id=user_id,
+            available_at=now,
+            created=now,
+            **self.options[task],
+        )
+
+    def get(self, job_id):
+        return self.table(job_id)
+
+    def claim(self, worker):
+        """
+        Claim the oldest job available, committed at once
+
+        Returns
+        -------
+        the job row, None when there is nothing to do
+        """
+        db, table = self.db, self.table
+        now = datetime.datetime.utcnow()
+        #  available_at of a running job is the end of its visibility timeout
+        db(
+            (table.status == self.RUNNING)
+            & (table.available_at <= now)
+            & (table.attempts >= table.max_attempts)
+        ).update(status=self.FAILED, error="visibility timeout expired", finished=now)
+        available = table.status.belongs((self.QUEUED, self.RUNNING)) & (
+            table.available_at <= now
+        )
+        for row in db(available).select(
+            table.id, table.visibility_timeout, orderby=table.id, limitby=(0, 10)
+        ):
+            #  the same condition again, a job claimed meanwhile by another worker is skipped
+            claimed = db((table.id == row.id) & available).update(
+                status=self.RUNNING,
+                worker=worker,
+                attempts=table.attempts + 1,
+                started=now,
+                available_at=now + datetime.timedelta(seconds=row.visibility_timeout),
+            )
+            db.commit()
+            if claimed:
+                return table(row.id)
+        return None
+
+    def execute(self, job):
+        """
+        Run a claimed job and store its result, or schedule its retry
+
+        The outcome is only written while the job is still this run of this worker: a job whose
+        visibility timeout expired may have been claimed again meanwhile, its new run owns it.
+        """
+        db, table = self.db, self.table
+        owned = (
+            (table.id == job.id)
+            & (table.worker == job.worker)
+            & (table.attempts == job.attempts)
+            & (table.status == self.RUNNING)
+        )
+        try:
+            result = self.tasks[job.task](*(job.args or []), **(job.kwargs or {}))
+            db.commit()
+        except Exception:
+            db.rollback()
+            now = datetime.datetime.utcnow()
+            if job.attempts < job.max_attempts:
+                values = dict(
+                    status=self.QUEUED,
+                    available_at=now
+                    + datetime.timedelta(
+                        seconds=job.retry_delay * 2 ** (job.attempts - 1)
+                    ),
+                )
+            else:
+                values = dict(status=self.FAILED, finished=now)
+            updated = db(owned).update(error=traceback.format_exc(), **values)
+            db.commit()
+            if self.logger:
+                self.logger.exception("job %s (%s) failed", job.id, job.task)
+            if not updated:
+                self._lost(job)
+            return
+        updated = db(owned).update(
+            status=self.DONE,
+            result=result,
+            error=None,
+            finished=datetime.datetime.utcnow(),
+        )
+        db.commit()
+        if not updated:
+            self._lost(job)
+
+    def _lost(self, job):
+        if self.logger:
+            self.logger.warning(
+                "job %s (%s) attempt %s outlived its visibility timeout, "
+                "its outcome is dropped (the job was claimed again or failed)",
+                job.id,
+                job.task,
+                job.attempts,
+            )
+
+    def work(self, poll=1.0, once=False):
+        """
+        Worker loop: claim and run jobs until interrupted
+
+        Parameters
+        ----------
+        poll: seconds to wait when there is nothing to do
+        once: return when the queue is empty instead of waiting
+        """
+        worker = "%s:%s" % (socket.gethostname(), os.getpid())
+        try:
+            while True:
+                job = self.claim(worker)
+                if job:
+                    self.execute(job)
+                elif once:
+                    return
+                else:
+                    time.sleep(poll)
+        except KeyboardInterrupt:
+            pass
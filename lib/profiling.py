@@ -0,0 +1,220 @@
+import functools
+import json
+import re
+import threading
+import time
+
+from pydal.helpers.classes import ExecutionHandler
+
+from py4web import request, response
+from py4web.core import Fixture
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+IN_LIST_RE = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+SPACES_RE = re.compile(r"\s+")
+
+#  the profiler the instrumented methods report to, the one created last: the wrappers set on
+#  py4web classes outlive an app reload, which must not leave them with the previous profiler
+_active = None
+
+
+def normalise_sql(sql):
+    """
+    The shape of a statement: literals replaced by ?, IN lists collapsed, single spaces
+
+    pydal writes the values into the SQL, so the statements of an N+1 loop only differ by their
+    literals and share the same shape.
+    """
+    sql = STRING_RE.sub("?", sql)
+    sql = NUMBER_RE.sub("?", sql)
+    sql = IN_LIST_RE.sub("IN (...)", sql)
+    return SPACES_RE.sub(" ", sql).strip()
+
+
+def watch_statements(db, callback):
+    """
+    Call callback(sql, seconds) after every statement run by db, in the thread running it
+
+    Parameters
+    ----------
+    db: the DAL
+    callback: receives the SQL text and its duration, statements raising an error are not seen
+    """
+
+    class StatementTimer(ExecutionHandler):
+        def before_execute(self, command):
+            self.start = time.perf_counter()
+
+        def after_execute(self, command):
+            callback(command, time.perf_counter() - self.start)
+
+    db._adapter.execution_handlers.append(StatementTimer)
+
+
+def _timed(func, phase):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        record = _active._record() if _active else None
+        if record is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phases = record["phases"]
+            phases[phase] = phases.get(phase, 0) + time.perf_counter() - start
+            if args and record.get("finish_with") is args[0]:
+                _active._finish(args[1])
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+class Profiler(Fixture):
+    """
+    Per request timings: phases (fixtures, grid processing, templates...), SQL statements and
+    N+1 patterns
+
+    Add it to action.uses(...), or call profile(fixture) to profile every action using the
+    fixture.  Each request gets a Server-Timing header (shown by the browser dev tools) and one
+    JSON log line:
+
+        {"action": "customers", "status": 200, "total_ms": 48.1, "sql_count": 12,
+         "sql_ms": 9.3, "phases": {"session.on_request": 0.4, ...}, "repeated": []}
+
+    The phases are the methods wrapped with instrument(), they can nest (the grid rendering is
+    part of the template rendering).  Statements of the same shape (see normalise_sql) run more
+    than repeat_threshold times in a request are reported as likely N+1 queries, in the log line
+    and as a warning.
+
+    Parameters
+    ----------
+    db: the DAL whose statements are timed
+    logger: where the log lines go
+    repeat_threshold: max number of statements of the same shape before a warning
+    """
+
+    def __init__(self, db, logger, repeat_threshold=10):
+        global _active
+        self.logger = logger
+        self.repeat_threshold = repeat_threshold
+        self.local = threading.local()
+        watch_statements(db, self._statement)
+        _active = self
+
+    def profile(self, fixture):
+        """
+        Profile every action using fixture (the session of the app, which auth uses too)
+
+        The profiler becomes a prerequisite of the fixture, action.uses(...) runs it before the
+        fixture and after the fixtures listed first, as the template.  The other apps, using
+        their own fixtures, are not profiled.
+        """
+        prerequisites = list(getattr(fixture, "__prerequisites__", None) or ())
+        fixture.__prerequisites__ = [self] + prerequisites
+
+    def instrument(self, target, name=None, methods=("on_request", "on_success")):
+        """
+        Time methods of a fixture, or of a class, as phases of the requests being profiled
+
+        Parameters
+        ----------
+        target: an instance, or a class to time the methods of all its instances
+        name: prefix of the phase names, default the lower case class name
+        methods: names of the methods timed
+        """
+        cls = target if isinstance(target, type) else type(target)
+        name = name or cls.__name__.lower()
+        for method in methods:
+            #  a method wrapped before an app reload is wrapped again from its original
+            original = getattr(target, method)
+            if getattr(original, "__profiled__", False):
+                original = original.__wrapped__
+            setattr(target, method, _timed(original, "%s.%s" % (name, method)))
+
+    def _record(self):
+        return getattr(self.local, "record", None)
+
+    def _statement(self, sql, seconds):
+        record = self._record()
+        if record is not None:
+            record["sql_count"] += 1
+            record["sql_time"] += seconds
+            shape = normalise_sql(sql)
+            record["shapes"][shape] = record["shapes"].get(shape, 0) + 1
+
+    def on_request(self, context):
+        #  nested action.uses(...) share the record of the outer one
+        self.local.depth = getattr(self.local, "depth", 0) + 1
+        if self.local.depth == 1:
+            self.local.record = dict(
+                start=time.perf_counter(),
+                phases=dict(),
+                sql_count=0,
+                sql_time=0.0,
+                shapes=dict(),
+            )
+
+    def on_error(self, context):
+        self._finish(context)
+
+    def on_success(self, context):
+        #  the fixtures before the profiler (the template) end after it, when the first of them
+        #  is instrumented the record is closed once it ran, so the rendering is counted
+        fixtures = context["fixtures"]
+        before = [
+            fixture
+            for fixture in fixtures[: fixtures.index(self)]
+            if fixture in context["processed"]
+        ]
+        if (
+            self.local.depth == 1
+            and before
+            and getattr(before[0].on_success, "__profiled__", False)
+        ):
+            self.local.record["finish_with"] = before[0]
+        else:
+            self._finish(context)
+
+    def _finish(self, context):
+        self.local.depth -= 1
+        if self.local.depth:
+            return
+        record = self.local.record
+        self.local.record = None
+        total = time.perf_counter() - record["start"]
+
+        repeated = [
+            dict(sql=shape, count=count)
+            for shape, count in record["shapes"].items()
+            if count > self.repeat_threshold
+        ]
+        phases = {name: round(t * 1000, 2) for name, t in record["phases"].items()}
+
+        timings = ["total;dur=%.2f" % (total * 1000)]
+        timings.append(
+            'sql;dur=%.2f;desc="%s statements"'
+            % (record["sql_time"] * 1000, record["sql_count"])
+        )
+        timings.extend("%s;dur=%s" % (name, ms) for name, ms in phases.items())
+        response.headers["Server-Timing"] = ", ".join(timings)
+
+        line = dict(
+            action=request.fullpath,
+            method=request.method,
+            status=context.get("status"),
+            total_ms=round(total * 1000, 2),
+            sql_count=record["sql_count"],
+            sql_ms=round(record["sql_time"] * 1000, 2),
+            phases=phases,
+            repeated=repeated,
+        )
+        self.logger.info("profile %s", json.dumps(line))
+        for entry in repeated:
+            self.logger.warning(
+                "possible N+1 in %s: %s statements like %s",
+                request.fullpath,
+                entry["count"],
+                entry["sql"],
+            )
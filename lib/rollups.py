@@ -0,0 +1,200 @@
+import datetime
+import threading
+
+from pydal import Field
+
+
+class Rollup:
+    """
+    Daily sums of a fact table by member of a few dimensions, kept up to date from the table
+    callbacks so reports never have to aggregate the facts
+
+    The rollup table has one row per (dimension, member, day) with the sum of each measure, e.g.
+    ("employee", 5, 1997-03-12) -> amount, quantity, lines.  The dimension "all" (member 0) holds
+    the daily totals.  A write to a watched table subtracts the contribution of the fact rows it
+    touches before the write and adds it back after, so the sums stay exact in the transaction of
+    the write.  Writes made outside of pydal (or with the callbacks disabled) need a rebuild().
+
+    Parameters
+    ----------
+    db: the DAL
+    tablename: name of the rollup table, defined here
+    fact: the table summed up
+    lines: callable receiving a query on fact and yielding (day, {dimension: member},
+           {measure: value}) for each fact row it selects
+    measures: dict of measure name -> field type
+    """
+
+    ALL = "all"
+
+    def __init__(self, db, tablename, fact, lines, measures):
+        self.db = db
+        self.fact = fact
+        self.lines = lines
+        self.measures = measures
+        self.pending = threading.local()
+
+        self.table = db.define_table(
+            tablename,
+            Field("dimension", length=32),
+            Field("member", "integer"),
+            Field("day", "date"),
+            *[Field(name, type, default=0) for name, type in measures.items()],
+        )
+        try:
+            self.table.create_index(
+                "%s_lookup" % tablename,
+                self.table.dimension,
+                self.table.member,
+                self.table.day,
+            )
+        except RuntimeError:
+            #  the index is already there
+            pass
+
+    def watch(self, table, facts=None, fields=None):
+        """
+        Keep the rollup up to date with the writes to a table
+
+        Parameters
+        ----------
+        table: the fact table, or a table the fact rows depend on
+        facts: callable receiving a Set of table and returning the query of the fact rows it
+               affects, defaults to the rows of the Set itself (for the fact table)
+        fields: only updates of these field names change the rollup, None for all
+        """
+        facts = facts or (lambda dbset: dbset.query)
+        fields = set(fields) if fields else None
+
+        def relevant(values):
+            return fields is None or fields & set(values)
+
+        def remember(dbset, values):
+            #  the fact rows are selected by id after the update, it may change the query
+            if relevant(values):
+                ids = [row.id for row in self.db(facts(dbset)).select(self.fact.id)]
+                self._apply(self.fact.id.belongs(ids), -1)
+                setattr(self.pending, table._tablename, ids)
+
+        def restore(dbset, values):
+            if relevant(values):
+                ids = getattr(self.pending, table._tablename, [])
+                setattr(self.pending, table._tablename, [])
+                self._apply(self.fact.id.belongs(ids), 1)
+
+        table._after_insert.append(
+            lambda f, i: self._apply(facts(table._db(table.id == i)), 1)
+        )
+        table._before_update.append(remember)
+        table._after_update.append(restore)
+        table._before_delete.append(lambda s: self._apply(facts(s), -1))
+
+    def rebuild(self):
+        """
+        Recompute the whole rollup from the fact table, for the backfill of a new rollup or after
+        writes that bypassed the callbacks.  The caller commits.
+
+        Returns
+        -------
+        number of rollup rows written
+        """
+        sums = self._sums(self.fact.id > 0, 1)
+        self.db(self.table.id > 0).delete()
+        self.table.bulk_insert(
+            [
+                dict(dimension=dimension, member=member, day=day, **values)
+                for (dimension, member, day), values in sums.items()
+            ]
+        )
+        return len(sums)
+
+    def totals(self, dimension, start=None, end=None):
+        """
+        Sums of the measures by member of a dimension over a period
+
+        Parameters
+        ----------
+        dimension: the dimension name
+        start: first day included, None for no limit
+        end: first day excluded, None for no limit
+
+        Returns
+        -------
+        dict of member -> {measure: sum}
+        """
+        sums = [self.table[name].sum() for name in self.measures]
+        rows = self.db(self._query(dimension, start, end)).select(
+            self.table.member, *sums, groupby=self.table.member
+        )
+        totals = dict()
+        for row in rows:
+            values = {name: row[total] or 0 for name, total in zip(self.measures, sums)}
+            #  the rows of members whose facts were all moved or deleted are left at zero
+            if any(values.values()):
+                totals[row[self.table.member]] = values
+        return totals
+
+    def monthly(self, start=None, end=None, dimension=ALL, member=0):
+        """
+        Sums of the measures by month, for the totals or for one member of a dimension
+
+        Parameters
+        ----------
+        start: first day included, None for no limit
+        end: first day excluded, None for no limit
+        dimension: the dimension name
+        member: the member of the dimension
+
+        Returns
+        -------
+        list of (first day of the month, {measure: sum}), oldest first
+        """
+        query = self._query(dimension, start, end) & (self.table.member == member)
+        months = dict()
+        for row in self.db(query).select(
+            self.table.day, *[self.table[name] for name in self.measures]
+        ):
+            if not row.day:
+                continue
+            month = months.setdefault(
+                row.day.replace(day=1), {name: 0 for name in self.measures}
+            )
+            for name in self.measures:
+                month[name] += row[name] or 0
+        return sorted(months.items())
+
+    def _query(self, dimension, start, end):
+        query = self.table.dimension == dimension
+        if start:
+            query &= self.table.day >= start
+        if end:
+            query &= self.table.day < end
+        return query
+
+    def _sums(self, query, sign):
+        sums = dict()
+        for day, members, values in self.lines(query):
+            if isinstance(day, datetime.datetime):
+                day = day.date()
+            for dimension, member in [(self.ALL, 0)] + list(members.items()):
+                total = sums.setdefault(
+                    (dimension, member, day), {name: 0 for name in self.measures}
+                )
+                for name in self.measures:
+                    total[name] += sign * (values.get(name) or 0)
+        return sums
+
+    def _apply(self, query, sign):
+        #  runs from the callbacks, returns None so the write goes on
+        table = self.table
+        for (dimension, member, day), values in self._sums(query, sign).items():
+            row_query = (
+                (table.dimension == dimension)
+                & (table.member == member)
+                & (table.day == day)
+            )
+            updated = self.db(row_query).update(
+                **{name: table[name] + value for name, value in values.items()}
+            )
+            if not updated:
+                table.insert(dimension=dimension, member=member, day=day, **values)
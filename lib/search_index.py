@@ -0,0 +1,372 @@
+import bisect
+import re
+import threading
+import time
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalise(value):
+    """
+    Normalise a label or a search value for lookups - lower case, single spaces
+    """
+    return " ".join(str(value or "").lower().split())
+
+
+class PrefixIndex:
+    """
+    Sorted in-memory index of the labels of one table, for autocomplete prefix lookups
+
+    Two sorted lists of (normalised text, id) are kept: the full value of every search field and
+    every later word of those values.  A lookup is a bisect into each list, so matches whose value
+    starts with the search come first, then the ones with a word starting with it ("token prefix").
+
+    The index is built on first use.  Writes made through this process update it from the table
+    callbacks, writes from other processes are picked up by checking the table version every
+    check_interval seconds.
+
+    Parameters
+    ----------
+    table: the pydal table
+    label: IS_IN_DB style label, a format string or a callable receiving the row
+    search_fields: the fields whose values are indexed
+    label_fields: the fields the label needs, None for the whole row
+    versions: optional TableVersions, to notice writes made by other processes
+    check_interval: seconds between two version checks
+    """
+
+    def __init__(
+        self,
+        table,
+        label,
+        search_fields,
+        label_fields=None,
+        versions=None,
+        check_interval=30,
+    ):
+        self.table = table
+        self.label = label
+        self.search_fields = search_fields
+        self.fields = None
+        if label_fields is not None:
+            self.fields = {
+                f.longname: f for f in [table.id] + search_fields + label_fields
+            }.values()
+        self.versions = versions
+        self.check_interval = check_interval
+
+        self.lock = threading.RLock()
+        self.pending = threading.local()
+        self.labels = None
+        self.prefixes = []
+        self.words = []
+        self.entries = dict()
+        self.version = None
+        self.local_writes = 0
+        self.checked = 0
+
+        table._after_insert.append(lambda f, i: self._refresh([i]))
+        table._before_update.append(lambda s, f: self._remember(s))
+        table._after_update.append(lambda s, f: self._refresh(self._forget()))
+        table._before_delete.append(lambda s: self._remember(s))
+        table._after_delete.append(lambda s: self._remove(self._forget(), True))
+
+    def search(self, value, limit):
+        """
+        Find the rows whose search fields start with value, or have a word starting with it
+
+        Parameters
+        ----------
+        value: the text typed by the user
+        limit: max number of matches
+
+        Returns
+        -------
+        list of (id, label), prefix matches first
+        """
+        self._ensure_fresh()
+        value = normalise(value)
+
+        with self.lock:
+            found = dict()
+            for entries in (self.prefixes, self.words):
+                index = bisect.bisect_left(entries, (value,))
+                while len(found) < limit and index < len(entries):
+                    text, row_id = entries[index]
+                    if not text.startswith(value):
+                        break
+                    found.setdefault(row_id, self.labels[row_id])
+                    index += 1
+            return list(found.items())
+
+    def warm(self):
+        """
+        Build the index, or catch up with the writes of other processes, ahead of the next lookup
+        """
+        with self.lock:
+            self.checked = 0
+        self._ensure_fresh()
+
+    def _ensure_fresh(self):
+        now = time.time()
+        with self.lock:
+            if self.labels is not None and (
+                not self.versions or now - self.checked < self.check_interval
+            ):
+                return
+            self.checked = now
+            if self.versions:
+                (version,) = self.versions.version(self.table)
+                #  every write statement bumps the version once, the ones made here are applied
+                if (
+                    self.labels is not None
+                    and version == self.version + self.local_writes
+                ):
+                    self.version = version
+                    self.local_writes = 0
+                    return
+                self.version = version
+            self._build()
+
+    def _build(self):
+        self.labels = dict()
+        self.prefixes = []
+        self.words = []
+        self.entries = dict()
+        self.local_writes = 0
+        fields = self.fields or []
+        for row in self.table._db(self.table.id > 0).iterselect(*fields):
+            self._add(row)
+        self.prefixes.sort()
+        self.words.sort()
+
+    def _add(self, row, keep_sorted=False):
+        insert = bisect.insort if keep_sorted else list.append
+        self.labels[row.id] = (
+            self.label(row) if callable(self.label) else self.label % row
+        )
+        entries = []
+        for field in self.search_fields:
+            text = normalise(row[field.name])
+            if not text:
+                continue
+            entries.append((self.prefixes, (text, row.id)))
+            for word in WORD_RE.finditer(text):
+                if word.start() > 0:
+                    entries.append((self.words, (text[word.start() :], row.id)))
+        for entry_list, entry in entries:
+            insert(entry_list, entry)
+        self.entries[row.id] = entries
+
+    def _remove(self, ids, write=False):
+        with self.lock:
+            if self.labels is None:
+                return
+            self.local_writes += write
+            for row_id in ids:
+                self.labels.pop(row_id, None)
+                for entry_list, entry in self.entries.pop(row_id, []):
+                    index = bisect.bisect_left(entry_list, entry)
+                    if index < len(entry_list) and entry_list[index] == entry:
+                        del entry_list[index]
+
+    def _refresh(self, ids):
+        with self.lock:
+            if self.labels is None:
+                return
+            self.local_writes += 1
+            if not ids:
+                return
+            self._remove(ids)
+            fields = self.fields or []
+            for row in self.table._db(self.table.id.belongs(ids)).select(*fields):
+                self._add(row, keep_sorted=True)
+
+    def _remember(self, dbset):
+        #  ids touched by an update/delete, read before the write; returns None so the write goes on
+        if self.labels is not None:
+            self.pending.ids = [row.id for row in dbset.select(self.table.id)]
+
+    def _forget(self):
+        ids = getattr(self.pending, "ids", [])
+        self.pending.ids = []
+        return ids
+
+
+def trigrams(text):
+    """
+    The trigrams of the words of a normalised text, padded like pg_trgm ("  w", " wo", "wor", ...)
+    """
+    grams = set()
+    for word in WORD_RE.findall(text):
+        padded = "  %s " % word
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex(PrefixIndex):
+    """
+    A PrefixIndex that also answers fuzzy lookups, ranked by trigram similarity
+
+    Each row keeps the set of trigrams of its search fields and every trigram keeps the set of ids
+    of the rows using it.  A row with a similarity of at least threshold shares at least
+    threshold * len(search trigrams) trigrams with the search, so it is in one of the
+    (len - shared + 1) rarest posting lists: only those lists produce candidates, which are then
+    ranked by Jaccard similarity.  Common trigrams ("  s", "er ") never have to be scanned.
+
+    Measured by tests/bench_search_index.py on 1M synthetic labels, on one CPU: prefix lookups
+    take about 0.05 ms, fuzzy lookups about 155 ms (p95 250 ms) for a 12 character search with
+    a typo.  The build takes about a minute on first use, in one pass over the table, and its
+    peak memory is close to 4 GB.  At that size fuzzy matching is a fallback for a search with
+    too few hits, not something to run on every keystroke.
+    """
+
+    #  max number of contains_or_similar results kept
+    MAX_HITS = 1000
+
+    def __init__(self, *args, threshold=0.3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+        self.trigrams = dict()
+        self.row_trigrams = dict()
+        #  (field name, normalised value, min_hits) -> enough substring matches, see
+        #  contains_or_similar - cleared on every change of the index
+        self.hits = dict()
+
+    def fuzzy_search(self, value, limit, exclude=()):
+        """
+        Find the rows most similar to value
+
+        Parameters
+        ----------
+        value: the text typed by the user
+        limit: max number of matches
+        exclude: ids already found by an exact or prefix search
+
+        Returns
+        -------
+        list of (id, label), most similar first
+        """
+        self._ensure_fresh()
+        grams = trigrams(normalise(value))
+        if not grams:
+            return []
+
+        with self.lock:
+            postings = sorted((self.trigrams.get(gram, ()) for gram in grams), key=len)
+            shared = max(1, int(self.threshold * len(grams)))
+            candidates = set().union(*postings[: len(grams) - shared + 1])
+            candidates.difference_update(exclude)
+
+            scored = []
+            for row_id in candidates:
+                row_grams = self.row_trigrams[row_id]
+                common = len(grams & row_grams)
+                similarity = common / (len(grams) + len(row_grams) - common)
+                if similarity >= self.threshold:
+                    scored.append((-similarity, self.labels[row_id], row_id))
+
+            scored.sort()
+            return [(row_id, label) for _, label, row_id in scored[:limit]]
+
+    def contains_or_similar(self, field, value, min_hits=5, limit=50):
+        """
+        Query for the rows whose field contains value, widened with the most similar rows when
+        fewer than min_hits contain it - for GridSearchQuery name filters
+
+        Whether min_hits rows contain value is read once per version of the table, the grid
+        building the query for each of its requests (pages, sorting) does not count them again.
+
+        Parameters
+        ----------
+        field: the field searched, one of the search fields of the index
+        value: the text typed by the user
+        min_hits: below this number of substring matches, similar rows are added
+        limit: max number of similar rows added
+
+        Returns
+        -------
+        a pydal query
+        """
+        query = field.contains(value)
+        self._ensure_fresh()
+        key = (field.name, normalise(value), min_hits)
+        with self.lock:
+            enough = self.hits.get(key)
+        if enough is None:
+            #  at most min_hits ids are read, not a count of every match
+            rows = self.table._db(query).select(self.table.id, limitby=(0, min_hits))
+            enough = len(rows) >= min_hits
+            with self.lock:
+                if len(self.hits) >= self.MAX_HITS:
+                    self.hits.clear()
+                self.hits[key] = enough
+        if enough:
+            return query
+
+        ids = [row_id for row_id, label in self.fuzzy_search(value, limit)]
+        return (query | self.table.id.belongs(ids)) if ids else query
+
+    def _build(self):
+        self.trigrams = dict()
+        self.row_trigrams = dict()
+        self.hits = dict()
+        super()._build()
+
+    def _add(self, row, keep_sorted=False):
+        super()._add(row, keep_sorted)
+        grams = set()
+        for field in self.search_fields:
+            grams.update(trigrams(normalise(row[field.name])))
+        self.row_trigrams[row.id] = grams
+        for gram in grams:
+            self.trigrams.setdefault(gram, set()).add(row.id)
+
+    def _remove(self, ids, write=False):
+        with self.lock:
+            #  inserts and updates go through _remove too (see _refresh)
+            self.hits.clear()
+            if self.labels is not None:
+                for row_id in ids:
+                    for gram in self.row_trigrams.pop(row_id, ()):
+                        postings = self.trigrams[gram]
+                        postings.discard(row_id)
+                        if not postings:
+                            del self.trigrams[gram]
+            super()._remove(ids, write)
+
+
+class SearchIndexes:
+    """
+    The TrigramIndexes of the app, one per (table, label, search fields), created on first use
+    """
+
+    def __init__(self, versions=None, threshold=0.3):
+        self.versions = versions
+        self.threshold = threshold
+        self.indexes = dict()
+        self.lock = threading.Lock()
+
+    def get(self, table, label, search_fields, label_fields=None):
+        """
+        Get the index of a table
+
+        Parameters
+        ----------
+        table: the pydal table
+        label: IS_IN_DB style label, a format string or a callable receiving the row
+        search_fields: the fields whose values are indexed
+        label_fields: the fields the label needs, None for the whole row
+        """
+        key = (table._tablename, str(label), tuple(f.name for f in search_fields))
+        with self.lock:
+            if key not in self.indexes:
+                self.indexes[key] = TrigramIndex(
+                    table,
+                    label,
+                    search_fields,
+                    label_fields=label_fields,
+                    versions=self.versions,
+                    threshold=self.threshold,
+                )
+            return self.indexes[key]
@@ -0,0 +1,244 @@
+import datetime
+import glob
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from py4web import request
+
+from .profiling import watch_statements, normalise_sql, STRING_RE, NUMBER_RE
+
+PLANNED_RE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+SCAN_RE = re.compile(r"^SCAN (?:TABLE )?\"?(\w+)\"?")
+
+
+def sql_literals(sql):
+    """
+    The values pydal wrote into a statement, in the order normalise_sql replaces them
+    """
+    strings = [value[1:-1].replace("''", "'") for value in STRING_RE.findall(sql)]
+    numbers = NUMBER_RE.findall(STRING_RE.sub("?", sql))
+    return strings + numbers
+
+
+class SlowQueryLog:
+    """
+    Log every statement slower than threshold seconds, one JSON line per statement
+
+    Each line has the SQL, its parameters (the literals pydal wrote into it), the duration, the
+    action running it and, for SQLite databases, the EXPLAIN QUERY PLAN output.  The tables of
+    more than large_table rows the plan scans (SCAN TABLE) are listed in "scans".
+
+    The thread running a slow statement only queues it: the plans, the row counts and the
+    writes to the file are done by a logger thread, on a connection of its own (the cursor of
+    the statement still holds its rows).  When the logger falls behind by more than backlog
+    statements the new ones are dropped, and counted in "dropped".
+
+    The file is rotated at max_bytes, keeping backups files, and summary() groups the logged
+    statements by shape (see normalise_sql).
+
+    Parameters
+    ----------
+    db: the DAL
+    filename: the log file
+    threshold: seconds above which a statement is logged
+    large_table: row count from which a scanned table is flagged
+    max_bytes: size of the log file before it is rotated
+    backups: number of rotated files kept
+    backlog: statements waiting for the logger thread before the new ones are dropped
+    """
+
+    #  seconds a table row count used to flag scans is trusted
+    COUNT_TTL = 600
+
+    #  one logger thread per file, the previous one stops when the app is reloaded
+    running = dict()
+
+    def __init__(
+        self,
+        db,
+        filename,
+        threshold=0.2,
+        large_table=10000,
+        max_bytes=10 * 1024 * 1024,
+        backups=5,
+        backlog=1000,
+    ):
+        self.filename = filename
+        self.threshold = threshold
+        self.large_table = large_table
+        #  plans are only read from SQLite database files
+        self.dbpath = None
+        if db._adapter.dbengine == "sqlite" and "memory" not in db._adapter.dbpath:
+            self.dbpath = db._adapter.dbpath
+        self.local = threading.local()
+        self.counts = dict()
+        self.queue = queue.Queue(maxsize=backlog)
+        self.dropped = 0
+
+        self.logger = logging.getLogger("slow_queries:%s" % filename)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                filename, maxBytes=max_bytes, backupCount=backups
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+        previous = self.running.get(filename)
+        if previous:
+            previous.stop()
+        self.running[filename] = self
+        self.thread = threading.Thread(
+            target=self._loop, name="slow_queries:%s" % filename, daemon=True
+        )
+        self.thread.start()
+
+        watch_statements(db, self._statement)
+
+    def _statement(self, sql, seconds):
+        if seconds < self.threshold:
+            return
+        entry = dict(
+            time=datetime.datetime.utcnow().isoformat(timespec="seconds"),
+            action=self._action(),
+            duration_ms=round(seconds * 1000, 2),
+            sql=sql,
+        )
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _loop(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                if entry is None:
+                    return
+                self._write(entry)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, entry):
+        plan, scans = self.explain(entry["sql"])
+        dropped, self.dropped = self.dropped, 0
+        self.logger.info(
+            json.dumps(
+                dict(
+                    entry,
+                    params=sql_literals(entry["sql"]),
+                    plan=plan,
+                    scans=scans,
+                    dropped=dropped,
+                )
+            )
+        )
+
+    def flush(self):
+        """
+        Wait for the logger thread to write the statements queued so far
+        """
+        self.queue.join()
+
+    def stop(self):
+        self.queue.put(None)
+
+    def _action(self):
+        #  ombott answers "GET /" outside a request, its environ is then None or not a WSGI one
+        if "REQUEST_METHOD" not in (request.environ or {}):
+            #  not in a request: a job or a script
+            return threading.current_thread().name
+        return "%s %s" % (request.method, request.fullpath)
+
+    def explain(self, sql):
+        """
+        The query plan of a statement and the large tables it scans
+
+        Returns
+        -------
+        (list of plan lines, list of table names), empty when the plan is not available
+        """
+        if not self.dbpath or not PLANNED_RE.match(sql):
+            return [], []
+        try:
+            connection = self._connection()
+            plan = [
+                row[-1]
+                for row in connection.execute("EXPLAIN QUERY PLAN %s" % sql.rstrip(";"))
+            ]
+            scans = []
+            for line in plan:
+                match = SCAN_RE.match(line)
+                if match and self._count(connection, match.group(1)) > self.large_table:
+                    scans.append(match.group(1))
+            return plan, scans
+        except sqlite3.Error:
+            return [], []
+
+    def _connection(self):
+        if getattr(self.local, "connection", None) is None:
+            #  never wait for a lock held by a write in progress
+            self.local.connection = sqlite3.connect(
+                "file:%s?mode=ro" % self.dbpath, uri=True, timeout=0.1
+            )
+        return self.local.connection
+
+    def _count(self, connection, table):
+        now = time.time()
+        count, checked = self.counts.get(table, (None, 0))
+        if now - checked > self.COUNT_TTL:
+            (count,) = connection.execute(
+                'SELECT COUNT(*) FROM "%s"' % table
+            ).fetchone()
+            self.counts[table] = (count, now)
+        return count
+
+    def summary(self, limit=20):
+        """
+        The logged statements grouped by shape, from the log file and its rotated copies
+
+        Returns
+        -------
+        list of dicts with sql (the shape), count, total_ms, max_ms, mean_ms, scans and actions,
+        the largest total first
+        """
+        groups = dict()
+        for filename in glob.glob(self.filename + "*"):
+            with open(filename, encoding="utf8") as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    shape = normalise_sql(entry["sql"])
+                    group = groups.setdefault(
+                        shape,
+                        dict(
+                            sql=shape,
+                            count=0,
+                            total_ms=0,
+                            max_ms=0,
+                            scans=set(),
+                            actions=set(),
+                        ),
+                    )
+                    group["count"] += 1
+                    group["total_ms"] += entry["duration_ms"]
+                    group["max_ms"] = max(group["max_ms"], entry["duration_ms"])
+                    group["scans"].update(entry.get("scans", []))
+                    group["actions"].add(entry.get("action"))
+
+        report = sorted(groups.values(), key=lambda g: g["total_ms"], reverse=True)
+        for group in report[:limit]:
+            group["total_ms"] = round(group["total_ms"], 2)
+            group["mean_ms"] = round(group["total_ms"] / group["count"], 2)
+            group["scans"] = sorted(group["scans"])
+            group["actions"] = sorted(str(a) for a in group["actions"])
+        return report[:limit]
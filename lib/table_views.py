@@ -0,0 +1,80 @@
+import copy
+
+from pydal.objects import SQLALL
+
+
+def table_view(table, fields=None, hidden=(), readonly=(), defaults=None):
+    """
+    A copy of a table for the forms of one request, with its own readable/writable/default
+
+    The fields of the model are shared by every action, an action hiding a field with
+    db.table.field.readable = False hides it from the other forms built in the request (and
+    relies on py4web to restore it for the next request).  Actions give their forms a view of
+    the table instead:
+
+        form = Form(table_view(db.customer, fields=CUSTOMER_DETAIL_FIELDS), record=customer)
+
+    The view has the fields of the table cloned (the same name, type, validators and
+    represent), the same tablename and the same insert/update/delete callbacks, so the forms
+    read and write the table as usual.
+
+    Parameters
+    ----------
+    table: the pydal table
+    fields: names of the fields shown, the others but the id are hidden - None for all
+    hidden: names of the fields hidden
+    readonly: names of the fields shown but not writable
+    defaults: dict of field name -> default value
+
+    Returns
+    -------
+    the view, a pydal Table
+    """
+    defaults = defaults or {}
+    view = copy.copy(table)
+    view["ALL"] = SQLALL(view)
+    for name in table.fields:
+        field = table[name]
+        flags = dict()
+        if name in hidden or (
+            fields is not None and name not in fields and field.type != "id"
+        ):
+            flags.update(readable=False, writable=False)
+        elif fields is not None and field.type == "id":
+            flags.update(readable=True)
+        if name in readonly:
+            flags.update(writable=False)
+        if name in defaults:
+            flags.update(default=defaults[name])
+        clone = field.clone()
+        #  set one by one, py4web makes them thread safe descriptors that clone(**flags) bypasses
+        for key, value in flags.items():
+            setattr(clone, key, value)
+        clone.bind(view)
+        view[name] = clone
+    if "id" in table and "id" not in table.fields:
+        view["id"] = view[table._id.name]
+    view._id = view[table._id.name]
+    return view
+
+
+class DALView:
+    """
+    A DAL giving table views (see table_view) in place of some of its tables
+
+    For the Grid, which builds its forms from db[tablename]: HtmxGrid(..., views=[view]) uses the
+    view for the new/details/edit forms of the request, everything else goes to the DAL.
+    """
+
+    def __init__(self, db, views):
+        self._dal = db
+        self._views = {view._tablename: view for view in views}
+
+    def __getitem__(self, key):
+        return self._views.get(key) or self._dal[key]
+
+    def __getattr__(self, key):
+        return self._views.get(key) or getattr(self._dal, key)
+
+    def __call__(self, *args, **kwargs):
+        return self._dal(*args, **kwargs)
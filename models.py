@@ -6,7 +6,15 @@ from decimal import Decimal, ROUND_HALF_UP
 
 from dateutil.parser import parse
 
-from .common import db, Field
+from .common import (
+    db,
+    Field,
+    table_versions,
+    autocomplete_fields,
+    option_sets,
+    used_references,
+)
+from .lib.rollups import Rollup
 from pydal.validators import *
 
 
@@ -285,6 +293,15 @@ db.order_detail._before_insert.append(lambda f: order_detail_before_update(f))
 db.order_detail._before_update.append(lambda s, f: order_detail_before_update(f))
 
 
+def line_amount(od):
+    """
+    Unit price * quantity of an order line, both rounded to cents
+    """
+    return Decimal(od.unit_price).quantize(
+        Decimal("0.00"), rounding=ROUND_HALF_UP
+    ) * Decimal(od.quantity).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
+
+
 def order_subtotal(row):
     price = 0
 
@@ -294,17 +311,41 @@ def order_subtotal(row):
 
     if row_id:
         for od in db(db.order_detail.order == row_id).select():
-            price += Decimal(od.unit_price).quantize(
-                Decimal("0.00"), rounding=ROUND_HALF_UP
-            ) * Decimal(od.quantity).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
+            price += line_amount(od)
 
     return Decimal(price).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
 
 
-def order_total(row):
+def order_subtotals(order_ids):
+    """
+    Get the subtotal of many orders with a single query, rounded the same way as order_subtotal
+
+    Parameters
+    ----------
+    order_ids: list of order ids
+
+    Returns
+    -------
+    dict of order id -> subtotal
+    """
+    prices = {order_id: 0 for order_id in order_ids}
+
+    for od in db(db.order_detail.order.belongs(order_ids)).select(
+        db.order_detail.order, db.order_detail.unit_price, db.order_detail.quantity
+    ):
+        prices[od.order] += line_amount(od)
+
+    return {
+        order_id: Decimal(price).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
+        for order_id, price in prices.items()
+    }
+
+
+def order_total(row, subtotal=None):
     total = 0
 
-    subtotal = order_subtotal(row)
+    if subtotal is None:
+        subtotal = order_subtotal(row)
     freight = (
         row["freight"]
         if "freight" in row
@@ -319,4 +360,320 @@ def order_total(row):
     return Decimal(total).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
 
 
+def load_order(order_id):
+    """
+    Everything the order page shows, in two queries: the order with its customer, employee and
+    shipper, then its lines with their product
+
+    Parameters
+    ----------
+    order_id: id of the order
+
+    Returns
+    -------
+    dict with order, customer, employee, shipper (rows, the last three empty when not set),
+    lines (rows with order_detail and product), subtotal and total - None if there is no such order
+    """
+    row = (
+        db(db.order.id == order_id)
+        .select(
+            *[db.order[name] for name in db.order.fields],
+            db.customer.id,
+            db.customer.name,
+            db.employee.id,
+            db.employee.first_name,
+            db.employee.last_name,
+            db.shipper.id,
+            db.shipper.name,
+            left=[
+                db.customer.on(db.order.customer == db.customer.id),
+                db.employee.on(db.order.employee == db.employee.id),
+                db.shipper.on(db.order.shipper == db.shipper.id),
+            ],
+        )
+        .first()
+    )
+    if not row:
+        return None
+
+    lines = db(db.order_detail.order == order_id).select(
+        db.order_detail.id,
+        db.order_detail.unit_price,
+        db.order_detail.quantity,
+        db.order_detail.discount,
+        db.product.id,
+        db.product.name,
+        left=db.product.on(db.order_detail.product == db.product.id),
+        orderby=[db.product.name, db.order_detail.quantity],
+    )
+
+    subtotal = Decimal(
+        sum((line_amount(line.order_detail) for line in lines), Decimal(0))
+    ).quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)
+
+    return dict(
+        order=row.order,
+        customer=row.customer,
+        employee=row.employee,
+        shipper=row.shipper,
+        lines=lines,
+        subtotal=subtotal,
+        total=order_total(row.order, subtotal),
+    )
+
+
+def sales_lines(query):
+    """
+    The contribution of order lines to the sales rollup, see Rollup
+
+    Parameters
+    ----------
+    query: query on order_detail
+
+    Returns
+    -------
+    generator of (order date, {dimension: member}, {measure: value}), one per line
+    """
+    rows = db(query & (db.order_detail.order == db.order.id)).select(
+        db.order.order_date,
+        db.order.employee,
+        db.order.customer,
+        db.order_detail.product,
+        db.order_detail.unit_price,
+        db.order_detail.quantity,
+    )
+    for row in rows:
+        od = row.order_detail
+        amount = (
+            line_amount(od)
+            if od.unit_price is not None and od.quantity is not None
+            else Decimal(0)
+        )
+        yield (
+            row.order.order_date,
+            dict(
+                employee=row.order.employee,
+                customer=row.order.customer,
+                product=od.product,
+            ),
+            dict(amount=amount, quantity=od.quantity or 0, lines=1),
+        )
+
+
+#  daily sales by employee, customer and product, maintained by the order/order_detail callbacks
+sales_rollup = Rollup(
+    db,
+    "sales_rollup",
+    db.order_detail,
+    sales_lines,
+    dict(amount="decimal(13,2)", quantity="integer", lines="integer"),
+)
+sales_rollup.watch(
+    db.order_detail, fields=["order", "product", "unit_price", "quantity"]
+)
+sales_rollup.watch(
+    db.order,
+    facts=lambda s: db.order_detail.order.belongs(s._select(db.order.id)),
+    fields=["order_date", "employee", "customer"],
+)
+
+
+def rebuild_sales_rollup():
+    """
+    Recompute the sales rollup from the orders, to backfill it or after bulk writes made without
+    the callbacks:
+
+        py4web call apps southbreeze.models.rebuild_sales_rollup
+
+    Importing the models never rebuilds it, a new database gets its rollup from this command,
+    the Rebuild button of the dashboard or the hourly refresh_sales_rollup job of tasks.py.
+
+    Returns
+    -------
+    number of rollup rows written
+    """
+    count = sales_rollup.rebuild()
+    db.commit()
+    return count
+
+
+def sales_members(dimension, start, end, groups=None, limit=None):
+    """
+    Sales by member of a rollup dimension over a period, optionally grouped
+
+    Parameters
+    ----------
+    dimension: employee, customer or product
+    start: first day included, None for no limit
+    end: first day excluded, None for no limit
+    groups: optional dict of member -> group (e.g. product -> category), the totals are then
+            by group
+    limit: keep only the largest amounts
+
+    Returns
+    -------
+    list of (member or group, {measure: sum}), largest amount first
+    """
+    totals = sales_rollup.totals(dimension, start, end)
+    if groups is not None:
+        grouped = dict()
+        for member, values in totals.items():
+            group = grouped.setdefault(groups.get(member), {name: 0 for name in values})
+            for name, value in values.items():
+                group[name] += value
+        totals = grouped
+    ranked = sorted(totals.items(), key=lambda item: item[1]["amount"], reverse=True)
+    return ranked[:limit] if limit else ranked
+
+
+def load_sales_dashboard(start=None, end=None, top=10):
+    """
+    Sales by month, employee, sales region, category and customer, read from the sales rollup
+    and the labels of the members - order and order_detail are not read
+
+    Parameters
+    ----------
+    start: first day included, None for no limit
+    end: first day excluded, None for no limit
+    top: number of customers shown
+
+    Returns
+    -------
+    dict of report name -> list of (label, {measure: sum})
+    """
+    employees = db(db.employee.id > 0).select(
+        db.employee.id,
+        db.employee.first_name,
+        db.employee.last_name,
+        db.employee.sales_region,
+    )
+    products = db(db.product.id > 0).select(db.product.id, db.product.category)
+    regions = {r.id: r.name for r in db(db.sales_region.id > 0).select()}
+    categories = {
+        r.id: r.name
+        for r in db(db.category.id > 0).select(db.category.id, db.category.name)
+    }
+
+    customer_sales = sales_members("customer", start, end, limit=top)
+    customers = {
+        r.id: r.name
+        for r in db(
+            db.customer.id.belongs([member for member, values in customer_sales])
+        ).select(db.customer.id, db.customer.name)
+    }
+
+    def labelled(sales, labels):
+        return [(labels.get(member) or "None", values) for member, values in sales]
+
+    return dict(
+        months=[
+            (month.strftime("%Y-%m"), values)
+            for month, values in sales_rollup.monthly(start, end)
+        ],
+        employees=labelled(
+            sales_members("employee", start, end),
+            {e.id: f"{e.first_name} {e.last_name}" for e in employees},
+        ),
+        sales_regions=labelled(
+            sales_members(
+                "employee", start, end, {e.id: e.sales_region for e in employees}
+            ),
+            regions,
+        ),
+        categories=labelled(
+            sales_members("product", start, end, {p.id: p.category for p in products}),
+            categories,
+        ),
+        customers=labelled(customer_sales, customers),
+    )
+
+
+#  products to reorder, materialised by the refresh_reorder_alerts job of tasks.py
+db.define_table(
+    "reorder_alert",
+    Field("product", "reference product"),
+    Field("in_stock", "integer"),
+    Field("on_order", "integer"),
+    Field("reorder_level", "integer"),
+    Field("refreshed", "datetime"),
+)
+
+
+def refresh_reorder_alerts():
+    """
+    Replace the reorder alerts by the active products whose stock plus quantity on order is at or
+    below their reorder level.  The caller commits.
+
+    Returns
+    -------
+    number of alerts
+    """
+    p = db.product
+    rows = db(
+        ((p.discontinued == False) | (p.discontinued == None))
+        & (p.reorder_level > 0)
+        & (p.in_stock.coalesce_zero() + p.on_order.coalesce_zero() <= p.reorder_level)
+    ).select(p.id, p.in_stock, p.on_order, p.reorder_level)
+
+    refreshed = datetime.datetime.utcnow()
+    db(db.reorder_alert.id > 0).delete()
+    for row in rows:
+        db.reorder_alert.insert(
+            product=row.id,
+            in_stock=row.in_stock,
+            on_order=row.on_order,
+            reorder_level=row.reorder_level,
+            refreshed=refreshed,
+        )
+    return len(rows)
+
+
+#  reference fields that can use HtmxAutocompleteWidget / htmx/autocomplete
+autocomplete_fields.register(db.order_detail.product)
+autocomplete_fields.register(db.order.customer)
+autocomplete_fields.register(
+    db.order.employee, search_fields=["last_name", "first_name"]
+)
+autocomplete_fields.register(db.customer_note.customer)
+autocomplete_fields.register(db.customer_customer_type.customer)
+autocomplete_fields.register(
+    db.employee_territory.employee, search_fields=["last_name", "first_name"]
+)
+autocomplete_fields.register(db.product.supplier)
+autocomplete_fields.register(
+    db.employee.supervisor, search_fields=["last_name", "first_name"]
+)
+
+#  small reference tables sent whole to the browser by htmx/options
+option_sets.register(db.shipper)
+option_sets.register(db.category)
+option_sets.register(db.sales_region)
+option_sets.register(db.customer_type)
+option_sets.register(db.territory)
+
+#  option lists of the filter dropdowns of the orders and products grids
+used_references.watch(db.order.customer, "%(name)s")
+used_references.watch(db.order.employee, "%(last_name)s, %(first_name)s")
+used_references.watch(db.product.supplier, "%(name)s")
+used_references.watch(db.product.category, "%(name)s")
+
+#  bump the table version on every write so cached fragments are invalidated
+table_versions.watch(
+    db.sales_region,
+    db.territory,
+    db.customer,
+    db.customer_note,
+    db.shipper,
+    db.supplier,
+    db.category,
+    db.product,
+    db.employee,
+    db.customer_type,
+    db.customer_customer_type,
+    db.employee_territory,
+    db.order,
+    db.order_detail,
+    db.reorder_alert,
+)
+
 db.commit()
@@ -87,9 +87,46 @@ LDAP_SETTINGS = {
 # i18n settings
 T_FOLDER = required_folder(APP_FOLDER, "translations")
 
+# autocomplete settings
+# number of matches returned by htmx/autocomplete, widgets can ask for up to AUTOCOMPLETE_MAX_LIMIT
+AUTOCOMPLETE_LIMIT = 20
+AUTOCOMPLETE_MAX_LIMIT = 100
+# number of autocomplete results kept in memory
+AUTOCOMPLETE_CACHE_SIZE = 5000
+# fuzzy (trigram) matching for autocomplete and name filters kicks in below FUZZY_MIN_HITS
+# exact/prefix matches, and keeps rows with a similarity of at least FUZZY_THRESHOLD
+FUZZY_MIN_HITS = 5
+FUZZY_THRESHOLD = 0.3
+# reference fields pointing to a table registered with option_sets (see models.py) get a widget
+# filtering the whole option list in the browser while the table has at most this many rows
+CLIENT_OPTIONS_MAX_ROWS = 200
+# reference fields registered with autocomplete_fields switch from a dropdown to the autocomplete
+# widget once the referenced table has more than this many rows
+AUTOCOMPLETE_MIN_ROWS = 100
+
+# log the phase and SQL timings of the actions (see Profiler in lib/profiling.py)
+# and warn about statements of the same shape run more than PROFILE_REPEAT_THRESHOLD times (N+1)
+PROFILE = False
+PROFILE_REPEAT_THRESHOLD = 10
+
+# log the statements slower than SLOW_QUERY_THRESHOLD seconds with their query plan, flagging
+# scans of tables over SLOW_QUERY_LARGE_TABLE rows, to turn it on:
+#    SLOW_QUERY_LOG = os.path.join(DB_FOLDER, "slow_queries.log")
+SLOW_QUERY_LOG = None
+SLOW_QUERY_THRESHOLD = 0.2
+SLOW_QUERY_LARGE_TABLE = 10000
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+
 # Celery settings
 USE_CELERY = False
 CELERY_BROKER = "redis://localhost:6379/0"
+# without celery the scheduled jobs of tasks.py run in the job queue workers
+#    py4web call apps southbreeze.tasks.worker
+# set True to also run them in a thread of every web process, for a deployment without a
+# worker (their locks keep two processes from running the same job at once).  Without it the
+# search indexes and the row counts are built by the first request needing them.
+RUN_SCHEDULER = False
 
 # try import private settings
 try:
@@ -0,0 +1,58 @@
+"use strict";
+
+// Autocomplete widgets (HtmxAutocompleteWidget in htmx.py), one set of delegated
+// listeners for every widget on the page and every htmx/autocomplete response.
+//
+//   [data-autocomplete-widget]       wraps one widget
+//   [data-autocomplete-value]        the hidden input holding the key
+//   [data-autocomplete-search]       the text input the user types in
+//   select[data-autocomplete-options] the results returned by htmx/autocomplete
+(function () {
+    function widget(el) {
+        return el.closest("[data-autocomplete-widget]");
+    }
+
+    function options(el) {
+        return Q("select[data-autocomplete-options]", widget(el))[0];
+    }
+
+    function pick(select) {
+        var option = select.options[select.selectedIndex];
+        if (!option) return;
+        var w = widget(select);
+        Q("[data-autocomplete-value]", w)[0].value = option.value;
+        Q("[data-autocomplete-search]", w)[0].value = option.text.trim();
+        select.remove();
+    }
+
+    document.addEventListener("keydown", function (e) {
+        var target = e.target;
+        if (target.matches("[data-autocomplete-search]") && e.key === "ArrowDown") {
+            var select = options(target);
+            if (select) {
+                e.preventDefault();
+                select.focus();
+                select.selectedIndex = 0;
+            }
+        } else if (target.matches("select[data-autocomplete-options]") && e.key === "Enter") {
+            e.preventDefault();
+            pick(target);
+        }
+    });
+
+    document.addEventListener("click", function (e) {
+        var option = e.target.closest("select[data-autocomplete-options] option");
+        if (option) {
+            option.selected = true;
+            pick(option.parentElement);
+        }
+    });
+
+    document.addEventListener("focusout", function (e) {
+        if (!e.target.matches("[data-autocomplete-search]")) return;
+        var select = options(e.target);
+        if (select && e.relatedTarget !== select) {
+            select.remove();
+        }
+    });
+})();
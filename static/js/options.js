@@ -0,0 +1,60 @@
+"use strict";
+
+// Option widgets (HtmxOptionsWidget in htmx.py): the whole option list of a small
+// reference table is fetched once from htmx/options and filtered here, as the user
+// types.  The results use the autocomplete markup, so picking one is handled by
+// autocomplete.js.
+//
+//   [data-options-url]               the search input, with the URL of its option list
+//   [data-autocomplete-results]      where the matching options are shown
+(function () {
+    var MAX_OPTIONS = 15;
+    var loaded = {};
+
+    // the URL carries the table version, the browser cache keeps the response
+    function load(url) {
+        if (!loaded[url]) {
+            loaded[url] = fetch(url, {credentials: "same-origin"})
+                .then(function (res) { return res.json(); })
+                .then(function (data) { return data.options; });
+        }
+        return loaded[url];
+    }
+
+    function show(input) {
+        load(input.dataset.optionsUrl).then(function (options) {
+            var value = input.value.trim().toLowerCase();
+            var widget = input.closest("[data-autocomplete-widget]");
+            if (!value) Q("[data-autocomplete-value]", widget)[0].value = "";
+
+            // matches starting with the value first, then the ones containing it
+            var starts = [], contains = [];
+            options.forEach(function (option) {
+                var index = option[1].toLowerCase().indexOf(value);
+                if (index === 0) starts.push(option);
+                else if (index > 0) contains.push(option);
+            });
+            var matches = starts.concat(contains).slice(0, MAX_OPTIONS);
+
+            var results = Q("[data-autocomplete-results]", widget)[0];
+            results.innerHTML = "";
+            if (!matches.length || document.activeElement !== input) return;
+
+            var select = document.createElement("select");
+            select.setAttribute("data-autocomplete-options", "");
+            select.size = Math.max(matches.length, 2);
+            select.style.zIndex = 40;
+            select.style.position = "absolute";
+            matches.forEach(function (option) {
+                select.add(new Option(option[1], option[0]));
+            });
+            results.appendChild(select);
+        });
+    }
+
+    ["focusin", "input"].forEach(function (type) {
+        document.addEventListener(type, function (e) {
+            if (e.target.matches("[data-options-url]")) show(e.target);
+        });
+    });
+})();
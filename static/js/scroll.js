@@ -0,0 +1,34 @@
+"use strict";
+
+// Infinite scroll listings (InfiniteScroll in lib/grid_helpers.py) keep at most
+// data-scroll-window rows in the DOM.  Rows scrolled past are removed and a
+// spacer row of the same height takes their place so the page does not jump.
+document.addEventListener("htmx:afterSettle", function () {
+    Q("tbody[data-scroll-window]").forEach(function (tbody) {
+        var rows = Q("tr.scroll-row", tbody);
+        var extra = rows.length - parseInt(tbody.dataset.scrollWindow);
+        if (extra <= 0) return;
+
+        var spacer = Q("tr.scroll-spacer", tbody)[0];
+        if (!spacer) {
+            spacer = document.createElement("tr");
+            spacer.className = "scroll-spacer";
+            var td = document.createElement("td");
+            td.colSpan = rows[0].cells.length;
+            td.style.verticalAlign = "bottom";
+            td.style.textAlign = "center";
+            td.innerHTML = '<a href="' + window.location.href + '">Earlier rows were unloaded, back to the top</a>';
+            spacer.appendChild(td);
+            spacer.dataset.height = "0";
+            tbody.insertBefore(spacer, tbody.firstChild);
+        }
+
+        var height = parseFloat(spacer.dataset.height);
+        for (var i = 0; i < extra; i++) {
+            height += rows[i].offsetHeight;
+            rows[i].remove();
+        }
+        spacer.dataset.height = height;
+        spacer.style.height = height + "px";
+    });
+});
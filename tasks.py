@@ -1,4 +1,9 @@
 """
+Background jobs refreshing the derived data of the app
+
+Without celery (the default) the jobs run in a thread of the job queue workers (see worker()
+below and ThreadScheduler in lib/jobs.py), or of every web process with settings.RUN_SCHEDULER.
+
 To use celery tasks:
 1) pip install -U "celery[redis]"
 2) In settings.py:
@@ -8,27 +13,152 @@ To use celery tasks:
 4) Start "celery -A apps.{appname}.tasks beat"
 5) Start "celery -A apps.{appname}.tasks worker --loglevel=info" for each worker
 
+Every job takes a lock and records its runs in job_run (see JobRuns), a job still running
+elsewhere is skipped.  Call a job.delay() to run it on demand.
+
+Long work started from an action goes through the durable job_queue instead (see JobQueue):
+@job_queue.task registers a task, task.delay(...) returns the id of the job, shown by the
+jobs/status/<id> action.  Start one or more workers with
+   py4web call apps {appname}.tasks.worker
 """
-from .common import settings, scheduler, db, Field
+from .common import (
+    settings,
+    scheduler,
+    job_runs,
+    job_queue,
+    db,
+    autocomplete_fields,
+    option_sets,
+    row_counts,
+    slow_queries,
+)
+from . import models
+from .htmx import get_search_index
+
+
+@scheduler.task
+@job_runs.job(ttl=3600)
+def refresh_sales_rollup():
+    """
+    Recompute the sales rollup, catching up with writes made without the table callbacks
+    """
+    return models.sales_rollup.rebuild()
+
 
-# example of task that needs db access
 @scheduler.task
-def my_task():
-    try:
-        # this task will be executed in its own thread, connect to db
-        db._adapter.reconnect()
-        # do something here
-        db.commit()
-    except:
-        # rollback on failure
-        db.rollback()
-
-
-# run my_task every 10 seconds
+@job_runs.job(ttl=600)
+def refresh_reorder_alerts():
+    """
+    Materialise the products to reorder shown on the dashboard
+    """
+    return models.refresh_reorder_alerts()
+
+
+@scheduler.task
+@job_runs.job(ttl=600, local=True)
+def refresh_search_indexes():
+    """
+    Build the autocomplete indexes, or catch up with the writes of other processes, so no user
+    request pays for it
+    """
+    for entry in autocomplete_fields.fields.values():
+        get_search_index(entry).warm()
+
+
+@scheduler.task
+@job_runs.job(ttl=600, local=True)
+def refresh_row_counts():
+    """
+    Count the rows of the referenced tables the form widgets are picked by, see reference_widget
+    """
+    tablenames = {
+        entry.fk_table._tablename for entry in autocomplete_fields.fields.values()
+    }
+    tablenames.update(option_sets.tables)
+    for tablename in tablenames:
+        row_counts.count(db[tablename])
+
+
+@job_queue.task(retries=5, retry_delay=30, visibility_timeout=3600)
+def rebuild_sales_rollup():
+    """
+    Rebuild the sales rollup on demand, from the dashboard
+
+    A rebuild already running elsewhere holds the lock of refresh_sales_rollup, the job fails and
+    is retried later (30 s, then 1, 2, 4 and 8 minutes) instead of reporting a rebuild it did not
+    make.
+    """
+    result = refresh_sales_rollup()
+    if result is None:
+        raise RuntimeError("the sales rollup is being rebuilt by another worker")
+    return result
+
+
+@job_queue.task(retries=0, visibility_timeout=3600)
+def run_scheduled_job(entry):
+    """
+    Run an entry of the schedule now, for the jobs page when the web process runs no scheduler
+    """
+    spec = scheduler.conf.beat_schedule[entry]
+    return scheduler.tasks[spec["task"]](*spec.get("args", ()))
+
+
+def worker(poll=1.0, once=False):
+    """
+    Run the jobs of job_queue until interrupted, see the docstring of the module
+
+    Without celery the worker also runs the scheduled jobs, in a thread.
+    """
+    if not settings.USE_CELERY and not settings.RUN_SCHEDULER:
+        scheduler.start()
+    job_queue.work(poll=poll, once=once)
+
+
+def slow_query_report(limit=20):
+    """
+    Print the summary of the slow query log:
+       py4web call apps {appname}.tasks.slow_query_report
+    """
+    for group in slow_queries.summary(limit=limit) if slow_queries else []:
+        print(
+            "%(count)6d x %(mean_ms)10.2f ms = %(total_ms)12.2f ms  max %(max_ms)10.2f ms"
+            % group
+        )
+        print("    %s" % group["sql"])
+        if group["scans"]:
+            print("    scans: %s" % ", ".join(group["scans"]))
+        print("    actions: %s" % ", ".join(group["actions"]))
+
+
 scheduler.conf.beat_schedule = {
-    "my_first_task": {
-        "task": "apps.%s.tasks.my_task" % settings.APP_NAME,
-        "schedule": 10.0,
+    "refresh_sales_rollup": {
+        "task": "apps.%s.tasks.refresh_sales_rollup" % settings.APP_NAME,
+        "schedule": 3600.0,
+        "args": (),
+    },
+    "refresh_reorder_alerts": {
+        "task": "apps.%s.tasks.refresh_reorder_alerts" % settings.APP_NAME,
+        "schedule": 600.0,
         "args": (),
     },
 }
+
+if not settings.USE_CELERY:
+    #  the indexes and the counts live in the memory of the process, warming them from a celery
+    #  worker would not help the web processes
+    scheduler.conf.beat_schedule.update(
+        {
+            "refresh_search_indexes": {
+                "task": "apps.%s.tasks.refresh_search_indexes" % settings.APP_NAME,
+                "schedule": 300.0,
+                "args": (),
+            },
+            "refresh_row_counts": {
+                "task": "apps.%s.tasks.refresh_row_counts" % settings.APP_NAME,
+                "schedule": 60.0,
+                "args": (),
+            },
+        }
+    )
+    if settings.RUN_SCHEDULER:
+        scheduler.start()
@@ -0,0 +1,89 @@
+"""
+Requests per second of the setup and child grid actions, through the WSGI app on a seeded
+SQLite database:
+
+    python tests/bench_grids.py [requests per round] [rounds]
+
+The app is copied to a temporary apps folder, so its databases folder is left alone.  Every
+request gets its own query string, the grid fragment cache never answers for the grid.  The
+best of the rounds is shown.
+"""
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from wsgiref.util import setup_testing_defaults
+
+from pydal.validators import CRYPT
+
+from py4web.core import wsgi
+
+APP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACTIONS = [
+    "setup/sales_regions",
+    "setup/territories",
+    "setup/customer_types",
+    "setup/categories",
+    "setup/shippers",
+    "customer_notes?parent_id=1",
+]
+
+
+def call(app, path, method="GET", body=b"", cookie=""):
+    path, _, query = path.partition("?")
+    environ = dict(PATH_INFO="/southbreeze/" + path, QUERY_STRING=query)
+    environ.update(REQUEST_METHOD=method, HTTP_COOKIE=cookie)
+    environ.update(CONTENT_TYPE="application/json", CONTENT_LENGTH=str(len(body)))
+    setup_testing_defaults(environ)
+    environ["wsgi.input"] = io.BytesIO(body)
+    status = []
+    output = b"".join(app(environ, lambda s, headers: status.append((s, headers))))
+    return status[0][0], dict(status[0][1]), output
+
+
+def seed(db, rows=200):
+    region = db.sales_region.insert(name="region")
+    for i in range(rows):
+        for tablename in ["sales_region", "customer_type", "category", "shipper"]:
+            db[tablename].insert(name="%s %04d" % (tablename, i))
+        db.territory.insert(name="territory %04d" % i, sales_region=region)
+        db.customer.insert(name="customer %04d" % i)
+        db.customer_note.insert(customer=1, note="note %04d" % i)
+    db.auth_user.insert(
+        email="bench@example.com",
+        password=CRYPT()("bench password")[0],
+        first_name="B",
+    )
+    db.commit()
+
+
+def main(count=200, rounds=3):
+    apps = os.path.join(tempfile.mkdtemp(), "apps")
+    ignore = shutil.ignore_patterns("databases", "tests", ".git", "__pycache__")
+    shutil.copytree(APP, os.path.join(apps, "southbreeze"), ignore=ignore)
+    app = wsgi(apps_folder=apps, yes=True)
+    seed(sys.modules["apps.southbreeze.models"].db)
+
+    login = dict(email="bench@example.com", password="bench password")
+    status, headers, _ = call(
+        app, "auth/api/login", "POST", json.dumps(login).encode("utf8")
+    )
+    cookie = headers["Set-Cookie"].split(";")[0]
+    for path in ACTIONS:
+        sep = "&" if "?" in path else "?"
+        elapsed = []
+        for run in range(rounds):
+            start = time.perf_counter()
+            for i in range(count):
+                url = "%s%s_bench=%s.%s" % (path, sep, run, i)
+                status, _, _ = call(app, url, cookie=cookie)
+                assert status.startswith("200"), (path, status)
+            elapsed.append(time.perf_counter() - start)
+        print("%-30s %8.1f req/s" % (path, count / min(elapsed)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
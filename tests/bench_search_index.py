@@ -0,0 +1,89 @@
+"""
+Build time, memory and lookup latency of TrigramIndex on a synthetic table of 1M labels:
+
+    python tests/bench_search_index.py [rows]
+
+The labels are two or three random made-up words, the searches are prefixes of labels and
+labels with one typo.
+"""
+import os
+import random
+import resource
+import statistics
+import string
+import sys
+import time
+
+from pydal import DAL, Field
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.search_index import TrigramIndex  # noqa: E402
+
+
+def word(rand):
+    return "".join(
+        rand.choice("bcdfghklmnprstvz") + rand.choice("aeiou")
+        for _ in range(rand.randint(2, 4))
+    )
+
+
+def typo(rand, text):
+    i = rand.randrange(len(text))
+    return text[:i] + rand.choice(string.ascii_lowercase) + text[i + 1 :]
+
+
+def timings(func, values):
+    result = []
+    for value in values:
+        start = time.perf_counter()
+        func(value)
+        result.append((time.perf_counter() - start) * 1000)
+    result.sort()
+    return statistics.median(result), result[int(len(result) * 0.95)]
+
+
+def main(rows=1000000):
+    rand = random.Random(1)
+    words = [word(rand) for _ in range(20000)]
+    labels = [
+        " ".join(rand.choice(words) for _ in range(rand.randint(2, 3)))
+        for _ in range(rows)
+    ]
+
+    db = DAL("sqlite:memory")
+    db.define_table("customer", Field("name"))
+    db.executesql("BEGIN")
+    db._adapter.cursor.executemany(
+        "INSERT INTO customer (name) VALUES (?)", [(label,) for label in labels]
+    )
+    db.commit()
+
+    index = TrigramIndex(
+        db.customer, "%(name)s", [db.customer.name], label_fields=[db.customer.name]
+    )
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    index.warm()
+    print("build %.1f s" % (time.perf_counter() - start))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        "max rss %.0f MB, %.0f MB more than before the build"
+        % (after / 1024, (after - before) / 1024)
+    )
+
+    samples = [rand.choice(labels) for _ in range(500)]
+    prefixes = [label[: rand.randint(3, 8)] for label in samples]
+    misspelled = [typo(rand, label[:12].strip()) for label in samples]
+    print(
+        "prefix median %.3f ms, p95 %.3f ms"
+        % timings(lambda v: index.search(v, 20), prefixes)
+    )
+    print(
+        "fuzzy  median %.3f ms, p95 %.3f ms"
+        % timings(lambda v: index.fuzzy_search(v, 20), misspelled)
+    )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,39 @@
+import os
+import sys
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+from pydal import DAL
+
+from py4web import request, response
+from py4web.core import Fixture
+
+#  the modules of lib/ are imported as lib.<module>, from the folder of the app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DAL("sqlite://storage.db", folder=str(tmp_path))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def start_request():
+    """
+    Set up the py4web request and response of the thread, as the WSGI app does for a request
+    """
+
+    def start(path="/", query="", method="GET", host="localhost", headers=None):
+        environ = dict(
+            PATH_INFO=path, QUERY_STRING=query, REQUEST_METHOD=method, HTTP_HOST=host
+        )
+        for name, value in (headers or {}).items():
+            environ["HTTP_%s" % name.upper().replace("-", "_")] = value
+        setup_testing_defaults(environ)
+        request.__init__(environ)
+        response.__init__()
+        Fixture.__init_request_ctx__()
+
+    return start
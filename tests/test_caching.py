@@ -0,0 +1,84 @@
+import pytest
+from pydal import Field
+
+from py4web import HTTP
+from py4web.core import Cache
+
+from lib.caching import TableVersions, FragmentCache, conditional_get
+
+
+@pytest.fixture
+def grid_cache(db):
+    db.define_table("shipper", Field("name"))
+    db.define_table("carrier", Field("name"))
+    versions = TableVersions(db)
+    versions.watch(db.shipper)
+    return FragmentCache(Cache(size=100), versions)
+
+
+def render(grid_cache, path="select", html="<table></table>"):
+    """
+    Run a grid action through the fixture: the cached html, or None after storing html
+    """
+    db = grid_cache.versions.db
+    grid_cache.on_request({})
+    cached = grid_cache.lookup("shippers", path, [db.shipper])
+    if cached is None:
+        grid_cache.on_success(dict(output=html))
+    return cached
+
+
+def test_fragment_is_cached(grid_cache, start_request):
+    start_request(path="/southbreeze/shippers/select", query="page=2")
+    assert render(grid_cache, html="<table>1</table>") is None
+    assert render(grid_cache, html="<table>2</table>") == "<table>1</table>"
+
+    #  another page is another fragment
+    start_request(path="/southbreeze/shippers/select", query="page=3")
+    assert render(grid_cache) is None
+
+
+def test_write_to_a_watched_table_invalidates(db, grid_cache, start_request):
+    start_request(path="/southbreeze/shippers/select")
+    render(grid_cache, html="<table>1</table>")
+
+    db.carrier.insert(name="not watched")
+    assert render(grid_cache) == "<table>1</table>"
+
+    db.shipper.insert(name="Speedy Express")
+    assert render(grid_cache, html="<table>2</table>") is None
+    assert render(grid_cache) == "<table>2</table>"
+
+    db(db.shipper.name == "Speedy Express").delete()
+    assert render(grid_cache) is None
+
+
+def test_other_hosts_and_forms_are_not_served(grid_cache, start_request):
+    start_request(path="/southbreeze/shippers/select", host="one.example.com")
+    render(grid_cache)
+
+    start_request(path="/southbreeze/shippers/select", host="two.example.com")
+    assert render(grid_cache) is None
+
+    start_request(path="/southbreeze/shippers/edit/1", host="one.example.com")
+    render(grid_cache, path="edit/1", html="<form></form>")
+    assert render(grid_cache, path="edit/1") is None
+
+    start_request(
+        path="/southbreeze/shippers/select", host="one.example.com", method="POST"
+    )
+    assert render(grid_cache) is None
+
+
+def test_conditional_get(start_request):
+    start_request(path="/southbreeze/customer/1")
+    etag = conditional_get(1, (4,))
+
+    start_request(path="/southbreeze/customer/1", headers={"If-None-Match": etag})
+    with pytest.raises(HTTP) as raised:
+        conditional_get(1, (4,))
+    assert raised.value.status == 304
+
+    #  another version of the tables is another tag
+    start_request(path="/southbreeze/customer/1", headers={"If-None-Match": etag})
+    assert conditional_get(1, (5,)) != etag
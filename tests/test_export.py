@@ -0,0 +1,99 @@
+import csv
+import datetime
+import io
+import json
+from decimal import Decimal
+
+import pytest
+from pydal import Field
+from yatl import CAT, SPAN, TAG
+
+from py4web import response
+
+from lib import export
+from lib.export import stream_export
+
+
+@pytest.fixture
+def product(db):
+    db.define_table(
+        "product",
+        Field("name", label="Product"),
+        Field("unit_price", "decimal(10,2)", label="Unit Price"),
+        Field("added", "date"),
+        Field(
+            "notes",
+            represent=lambda value: CAT(SPAN(value), TAG.br(), "<checked>")
+            if value
+            else "",
+        ),
+    )
+    db.product.insert(
+        name="Chai",
+        unit_price=Decimal("18.00"),
+        added=datetime.date(2024, 3, 1),
+        notes="Tea",
+    )
+    db.product.insert(name='Chef Anton\'s "Cajun", Seasoning', unit_price=22)
+    db.product.insert(name="Tofu", unit_price=Decimal("23.25"))
+    db.commit()
+    return db.product
+
+
+def download(db, product, fmt):
+    columns = [product.name, product.unit_price, product.added, product.notes]
+    body = stream_export(
+        db, fmt, "products", product.id > 0, columns, orderby=product.id
+    )
+    return b"".join(body).decode("utf8")
+
+
+def test_csv(db, product, start_request, monkeypatch):
+    start_request(path="/southbreeze/products/export")
+    #  several batches
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 2)
+    rows = list(csv.reader(io.StringIO(download(db, product, "csv"))))
+
+    assert response.headers["Content-Type"] == "text/csv; charset=utf-8"
+    assert (
+        response.headers["Content-Disposition"] == 'attachment; filename="products.csv"'
+    )
+    assert rows == [
+        ["Product", "Unit Price", "Added", "Notes"],
+        ["Chai", "18.00", "2024-03-01", "Tea\n<checked>"],
+        ['Chef Anton\'s "Cajun", Seasoning', "22.00", "", ""],
+        ["Tofu", "23.25", "", ""],
+    ]
+
+
+def test_ndjson(db, product, start_request):
+    start_request(path="/southbreeze/products/export")
+    lines = download(db, product, "ndjson").splitlines()
+
+    assert response.headers["Content-Type"] == "application/x-ndjson; charset=utf-8"
+    assert [json.loads(line) for line in lines] == [
+        {
+            "Product": "Chai",
+            "Unit Price": "18.00",
+            "Added": "2024-03-01",
+            "Notes": "Tea\n<checked>",
+        },
+        {
+            "Product": 'Chef Anton\'s "Cajun", Seasoning',
+            "Unit Price": "22.00",
+            "Added": "",
+            "Notes": "",
+        },
+        {"Product": "Tofu", "Unit Price": "23.25", "Added": "", "Notes": ""},
+    ]
+
+
+def test_empty_query(db, product, start_request):
+    start_request(path="/southbreeze/products/export")
+    columns = [product.name]
+    assert b"".join(stream_export(db, "csv", "products", product.id < 0, columns)) == (
+        b"Product\r\n"
+    )
+    assert b"".join(
+        stream_export(db, "ndjson", "products", product.id < 0, columns)
+    ) == (b"")
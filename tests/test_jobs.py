@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+
+from lib.jobs import JobQueue
+
+
+@pytest.fixture
+def job_queue(db):
+    job_queue = JobQueue(db)
+    calls = []
+
+    @job_queue.task(name="add")
+    def add(a, b):
+        calls.append((a, b))
+        return a + b
+
+    @job_queue.task(name="fail", retries=1, retry_delay=10)
+    def fail():
+        calls.append("fail")
+        raise ValueError("boom")
+
+    job_queue.calls = calls
+    return job_queue
+
+
+def expire(job_queue, job_id):
+    """
+    Move the end of the visibility timeout (or the retry delay) of a job to the past
+    """
+    past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    job_queue.db(job_queue.table.id == job_id).update(available_at=past)
+    job_queue.db.commit()
+
+
+def test_claim_takes_the_oldest_job_once(job_queue):
+    first = job_queue.enqueue("add", (1, 2))
+    second = job_queue.enqueue("add", (3, 4))
+    job_queue.db.commit()
+
+    job = job_queue.claim("worker-1")
+    assert job.id == first
+    assert (job.status, job.worker, job.attempts) == ("running", "worker-1", 1)
+    assert job_queue.claim("worker-2").id == second
+    assert job_queue.claim("worker-3") is None
+
+
+def test_execute_stores_the_result(job_queue):
+    job_id = job_queue.enqueue("add", (1, 2))
+    job_queue.execute(job_queue.claim("worker-1"))
+
+    job = job_queue.get(job_id)
+    assert (job.status, job.result, job.error) == ("done", 3, None)
+
+
+def test_failed_job_is_retried_then_failed(job_queue):
+    job_id = job_queue.enqueue("fail")
+    job_queue.execute(job_queue.claim("worker-1"))
+
+    job = job_queue.get(job_id)
+    assert job.status == "queued"
+    assert "ValueError: boom" in job.error
+    #  not before its retry delay
+    assert job_queue.claim("worker-1") is None
+
+    expire(job_queue, job_id)
+    job = job_queue.claim("worker-2")
+    assert (job.id, job.attempts) == (job_id, 2)
+    job_queue.execute(job)
+
+    assert job_queue.get(job_id).status == "failed"
+    assert job_queue.calls == ["fail", "fail"]
+
+
+def test_visibility_timeout(job_queue):
+    job_id = job_queue.enqueue("add", (1, 2))
+    stale = job_queue.claim("worker-1")
+    #  hidden from the other workers while it runs
+    assert job_queue.claim("worker-2") is None
+
+    #  worker-1 is assumed dead once the timeout expired, the job is claimed again
+    expire(job_queue, job_id)
+    job = job_queue.claim("worker-2")
+    assert (job.id, job.worker, job.attempts) == (job_id, "worker-2", 2)
+
+    #  the late outcome of the first run is dropped, the second run owns the job
+    job_queue.execute(stale)
+    assert job_queue.get(job_id).status == "running"
+    job_queue.execute(job)
+    job = job_queue.get(job_id)
+    assert (job.status, job.worker, job.result) == ("done", "worker-2", 3)
+
+
+def test_running_job_out_of_attempts_fails(job_queue):
+    job_id = job_queue.enqueue("fail")
+    job_queue.claim("worker-1")
+    expire(job_queue, job_id)
+    job_queue.claim("worker-2")
+    expire(job_queue, job_id)
+
+    assert job_queue.claim("worker-3") is None
+    job = job_queue.get(job_id)
+    assert (job.status, job.error) == ("failed", "visibility timeout expired")
@@ -0,0 +1,71 @@
+import pytest
+from pydal import Field
+
+from lib.search_index import PrefixIndex, TrigramIndex
+
+NAMES = [
+    "North Wind Traders",
+    "Wind River Supply",
+    "Windsor Foods",
+    "Old World Delicatessen",
+    "Great Lakes Food Market",
+]
+
+
+@pytest.fixture
+def customer(db):
+    db.define_table("customer", Field("name"))
+    for name in NAMES:
+        db.customer.insert(name=name)
+    return db.customer
+
+
+def names(matches):
+    return [label for _, label in matches]
+
+
+def test_prefix_matches_come_before_word_matches(customer):
+    index = PrefixIndex(
+        customer, "%(name)s", [customer.name], label_fields=[customer.name]
+    )
+    assert names(index.search("wind", 10)) == [
+        "Wind River Supply",
+        "Windsor Foods",
+        "North Wind Traders",
+    ]
+    assert names(index.search("WIND  riv", 10)) == ["Wind River Supply"]
+    assert names(index.search("wind", 2)) == ["Wind River Supply", "Windsor Foods"]
+    assert index.search("xyz", 10) == []
+
+
+def test_prefix_index_follows_the_writes(customer):
+    index = PrefixIndex(
+        customer, "%(name)s", [customer.name], label_fields=[customer.name]
+    )
+    index.warm()
+    customer.insert(name="Windy City Imports")
+    customer._db(customer.name == "Windsor Foods").update(name="Maple Foods")
+    customer._db(customer.name == "North Wind Traders").delete()
+
+    assert names(index.search("wind", 10)) == [
+        "Wind River Supply",
+        "Windy City Imports",
+    ]
+    assert names(index.search("foods", 10)) == ["Maple Foods"]
+
+
+def test_fuzzy_search_ranks_by_similarity(customer):
+    index = TrigramIndex(
+        customer, "%(name)s", [customer.name], label_fields=[customer.name]
+    )
+    found = names(index.fuzzy_search("old wrld delicatesen", 10))
+    assert found[0] == "Old World Delicatessen"
+
+    found = names(index.fuzzy_search("great lakes food", 10))
+    assert found[0] == "Great Lakes Food Market"
+    assert "Old World Delicatessen" not in found
+
+    #  rows already found by the prefix search are left out
+    row_id = index.search("great", 1)[0][0]
+    found = index.fuzzy_search("great lakes food", 10, exclude=[row_id])
+    assert row_id not in [i for i, _ in found]
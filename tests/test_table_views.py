@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+from pydal import Field
+
+from lib.table_views import table_view, DALView
+
+
+@pytest.fixture
+def customer(db):
+    db.define_table(
+        "customer",
+        Field("name"),
+        Field("city", default="Boston"),
+        Field("region"),
+        Field("credit", "integer"),
+    )
+    return db.customer
+
+
+def flags(table):
+    return {
+        name: (table[name].readable, table[name].writable, table[name].default)
+        for name in table.fields
+    }
+
+
+def test_views_of_two_threads_are_isolated(customer):
+    model = flags(customer)
+    barrier = threading.Barrier(2, timeout=5)
+    seen = dict()
+    errors = []
+
+    def action(key, **options):
+        try:
+            view = table_view(customer, **options)
+            #  both views exist before either is read
+            barrier.wait()
+            seen[key] = flags(view)
+            barrier.wait()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(
+            target=action,
+            args=("detail",),
+            kwargs=dict(fields=["name", "city"], readonly=["city"]),
+        ),
+        threading.Thread(
+            target=action,
+            args=("new",),
+            kwargs=dict(hidden=["id", "credit"], defaults=dict(city="Paris")),
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert seen["detail"] == dict(
+        id=(True, True, None),
+        name=(True, True, None),
+        city=(True, False, "Boston"),
+        region=(False, False, None),
+        credit=(False, False, None),
+    )
+    assert seen["new"] == dict(
+        id=(False, False, None),
+        name=(True, True, None),
+        city=(True, True, "Paris"),
+        region=(True, True, None),
+        credit=(False, False, None),
+    )
+    assert flags(customer) == model
+
+
+def test_view_writes_to_the_table(db, customer):
+    inserted = []
+    customer._after_insert.append(lambda fields, id: inserted.append(id))
+    view = table_view(customer, hidden=["credit"], defaults=dict(city="Paris"))
+
+    row_id = view.insert(name="Alfreds")
+    assert inserted == [row_id]
+    assert customer(row_id).city == "Paris"
+    other_id = customer.insert(name="Bottom-Dollar")
+    assert inserted == [row_id, other_id]
+    assert customer(other_id).city == "Boston"
+
+    #  DALView gives the view to code reading db[tablename], the rest goes to the DAL
+    dal = DALView(db, [view])
+    assert dal.customer is view and dal["customer"] is view
+    assert dal(dal.customer.city == "Paris").count() == 1